@@ -0,0 +1,425 @@
+"""Load test of the API against the local mock OpenAI server.
+
+Indexes the catalog and starts the API in a temporary working directory with every
+OpenAI call pointed at ``benchmarks.mock_openai``, then plays scripted conversations
+at increasing concurrency levels and reports the startup time, the turn latency
+percentiles, the throughput, the errors and the remote calls made per turn. Every
+conversation asks its own mix of products, prices and contact details, and each level
+runs against a freshly restarted API with empty caches (unless --keep-caches), so the
+later levels are not answered from what the earlier ones cached. The results are
+written as JSON, tagged with the git commit, so runs of different commits can be
+compared::
+
+    python -m benchmarks.load_test --concurrency 1 4 16 --output results.json
+    python -m benchmarks.load_test --compare results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from benchmarks.mock_openai import MockOpenAIServer, add_mock_arguments, parse_config
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRODUCTS_FILE = os.path.join(ROOT_DIR, "data", "01_raw", "products.txt")
+GREETINGS = ["Olá, boa tarde!", "Oi, bom dia", "Boa noite!", "Olá, tudo bem?"]
+PRODUCTS = [
+    "celular",
+    "notebook",
+    "smartwatch",
+    "tablet",
+    "fone de ouvido",
+    "câmera",
+    "smart tv",
+    "videogame",
+]
+FEATURES = [
+    "a melhor câmera",
+    "a bateria que dura mais",
+    "a maior tela",
+    "a melhor garantia",
+    "o melhor custo-benefício",
+]
+CHOICES = ["o mais barato", "o mais caro", "o primeiro", "o segundo", "esse"]
+FIRST_NAMES = ["Maria", "João", "Ana", "Pedro", "Julia", "Lucas", "Carla", "Rafael"]
+LAST_NAMES = ["Silva", "Souza", "Oliveira", "Santos", "Lima", "Costa", "Pereira"]
+THANKS = ["Obrigada!", "Obrigado, até mais", "Valeu!", "Muito obrigado"]
+
+
+def conversation(rng: random.Random) -> List[str]:
+    """A scripted purchase with its own product, budget, feature and buyer."""
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    phone = (
+        f"({rng.randint(11, 99)}) 9{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}"
+    )
+    return [
+        rng.choice(GREETINGS),
+        f"Estou procurando um {rng.choice(PRODUCTS)} até R$ {rng.randint(5, 80) * 100}",
+        f"Qual deles tem {rng.choice(FEATURES)}?",
+        f"Quero comprar {rng.choice(CHOICES)}",
+        f"Meu nome é {first} {last}, {first.lower()}.{last.lower()}"
+        f"{rng.randint(1, 999)}@email.com, telefone {phone}",
+        rng.choice(THANKS),
+    ]
+
+
+def git_sha() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "p50": round(float(p50), 1),
+        "p95": round(float(p95), 1),
+        "p99": round(float(p99), 1),
+        "mean": round(float(np.mean(values)), 1),
+        "max": round(float(np.max(values)), 1),
+    }
+
+
+class ApiProcess:
+    """Indexes the catalog and runs the API with uvicorn, isolated in `workdir`."""
+
+    def __init__(self, workdir: str, mock_url: str, port: int, extra_env: Dict):
+        self.workdir = workdir
+        self.port = port
+        self.env = {
+            **os.environ,
+            "PYTHONPATH": ROOT_DIR,
+            "OPENAI_API_KEY": "mock",
+            "OPENAI_BASE_URL": mock_url,
+            "OPENAI_API_BASE": mock_url,
+            "CHROMA_DB_DIR": os.path.join(workdir, "chroma_db"),
+            "NUMPY_STORE_DIR": os.path.join(workdir, "numpy_store"),
+            "TRANSCRIPTS_DB": os.path.join(workdir, "transcripts.sqlite3"),
+            **extra_env,
+        }
+        self._process: Optional[subprocess.Popen] = None
+        self._log = None
+
+    def index(self, products_file: str):
+        with open(os.path.join(self.workdir, "index.log"), "w") as log:
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "src.llm.process_rag_docs",
+                    "--file",
+                    products_file,
+                ],
+                cwd=self.workdir,
+                env=self.env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        if result.returncode != 0:
+            raise RuntimeError(f"Indexing failed, see {log.name}")
+
+    def start(self, timeout: float = 120.0) -> Dict:
+        """
+        Starts the API and waits for it to be ready.
+
+        Returns:
+            Dict: Seconds from spawning the process until /healthz and /readyz answer,
+            and the startup profile reported by /readyz.
+        """
+        self._log = open(os.path.join(self.workdir, "api.log"), "a")
+        spawned = time.perf_counter()
+        self._process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "src.api.llm_api:app",
+                "--port",
+                str(self.port),
+                "--log-level",
+                "warning",
+            ],
+            # The autogen disk cache lives in the working directory, a fresh one per
+            # run keeps the state calls from being answered from a previous run.
+            cwd=self.workdir,
+            env=self.env,
+            stdout=self._log,
+            stderr=subprocess.STDOUT,
+        )
+        startup: Dict = {}
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"The API exited, see {self._log.name}")
+            try:
+                if "live_seconds" not in startup:
+                    httpx.get(f"{self.url}/healthz", timeout=1.0).raise_for_status()
+                    startup["live_seconds"] = round(time.perf_counter() - spawned, 3)
+                response = httpx.get(f"{self.url}/readyz", timeout=1.0)
+                if response.status_code == 200:
+                    startup["ready_seconds"] = round(time.perf_counter() - spawned, 3)
+                    startup["profile"] = response.json()["startup"]
+                    return startup
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise TimeoutError(f"The API did not start in {timeout}s")
+
+    def reset_caches(self):
+        """Removes the autogen disk cache, the other caches are in the API process."""
+        shutil.rmtree(os.path.join(self.workdir, ".cache"), ignore_errors=True)
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        if self._log is not None:
+            self._log.close()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+async def _play_conversation(
+    client: httpx.AsyncClient,
+    stream: bool,
+    questions: List[str],
+    turns: List[Dict],
+    errors: List[str],
+):
+    session_id = uuid.uuid4().hex
+    for question in questions:
+        payload = {"question": question, "session_id": session_id}
+        start = time.perf_counter()
+        first_token = None
+        try:
+            if stream:
+                async with client.stream(
+                    "POST", "/query/stream", json=payload
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        frame = json.loads(line)
+                        if "error" in frame:
+                            raise RuntimeError(frame["error"])
+                        if first_token is None and "token" in frame:
+                            first_token = time.perf_counter() - start
+            else:
+                response = await client.post("/query", json=payload)
+                response.raise_for_status()
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+            return
+        turns.append(
+            {
+                "latency_ms": (time.perf_counter() - start) * 1000,
+                "first_token_ms": first_token * 1000 if first_token else None,
+            }
+        )
+    try:
+        await client.post("/end-session", json={"session_id": session_id})
+    except httpx.HTTPError as e:
+        errors.append(f"{type(e).__name__}: {e}")
+
+
+async def run_level(
+    api_url: str, concurrency: int, conversations: int, stream: bool, seed: int = 0
+) -> Dict:
+    """Plays `conversations` conversations with at most `concurrency` at a time."""
+    turns: List[Dict] = []
+    errors: List[str] = []
+    rng = random.Random(f"{seed}-{concurrency}")
+    scripts = [conversation(rng) for _ in range(conversations)]
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(
+        base_url=api_url, timeout=300.0, limits=limits
+    ) as client:
+
+        async def play(questions: List[str]):
+            async with semaphore:
+                await _play_conversation(client, stream, questions, turns, errors)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(play(questions) for questions in scripts))
+        elapsed = time.perf_counter() - start
+
+    first_tokens = [t["first_token_ms"] for t in turns if t["first_token_ms"]]
+    return {
+        "concurrency": concurrency,
+        "conversations": conversations,
+        "turns": len(turns),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "elapsed_seconds": round(elapsed, 2),
+        "turns_per_second": round(len(turns) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": percentiles([t["latency_ms"] for t in turns]),
+        "first_token_ms": percentiles(first_tokens),
+    }
+
+
+def compare(current: Dict, previous: Dict):
+    """Prints the startup time change and the p95 latency and throughput change of each
+    level shared by both runs."""
+    print(f"\nCompared with {previous.get('git_sha')} ({previous.get('timestamp')}):")
+    if "startup" in current and "startup" in previous:
+        before = previous["startup"]["ready_seconds"]
+        now = current["startup"]["ready_seconds"]
+        print(
+            f"  ready    {before:>8.2f} -> {now:>8.2f} s ({(now - before) / before:+.1%})"
+        )
+    previous_levels = {level["concurrency"]: level for level in previous["levels"]}
+    for level in current["levels"]:
+        before = previous_levels.get(level["concurrency"])
+        if not before or not before["latency_ms"] or not level["latency_ms"]:
+            continue
+        p95_before, p95_now = before["latency_ms"]["p95"], level["latency_ms"]["p95"]
+        tps_before, tps_now = before["turns_per_second"], level["turns_per_second"]
+        print(
+            f"  c={level['concurrency']:<4} p95 {p95_before:>8.1f} -> {p95_now:>8.1f} ms "
+            f"({(p95_now - p95_before) / p95_before:+.1%})  "
+            f"turns/s {tps_before:>6.2f} -> {tps_now:>6.2f} "
+            f"({(tps_now - tps_before) / tps_before if tps_before else 0:+.1%})"
+        )
+
+
+def print_level(level: Dict):
+    latency = level["latency_ms"] or {"p50": 0, "p95": 0, "p99": 0}
+    calls = ", ".join(
+        f"{kind}={count:.2f}" for kind, count in level["calls_per_turn"].items()
+    )
+    print(
+        f"c={level['concurrency']:<4} turns={level['turns']:<5} "
+        f"errors={level['errors']:<3} turns/s={level['turns_per_second']:<7} "
+        f"p50={latency['p50']:.0f}ms p95={latency['p95']:.0f}ms "
+        f"p99={latency['p99']:.0f}ms calls/turn: {calls}"
+    )
+
+
+def main(args: argparse.Namespace) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="marketplace-bench-")
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    server = MockOpenAIServer(parse_config(args))
+    results = {
+        "git_sha": git_sha(),
+        "timestamp": datetime.now().isoformat(),
+        "endpoint": "/query/stream" if args.stream else "/query",
+        "mock": server.config.__dict__,
+        "env": extra_env,
+        "seed": args.seed,
+        "keep_caches": args.keep_caches,
+        "levels": [],
+    }
+    try:
+        with server as mock_url:
+            api = ApiProcess(workdir, mock_url, args.port, extra_env)
+            api.index(args.products_file)
+            results["startup"] = api.start()
+            print(
+                f"API live in {results['startup']['live_seconds']}s, "
+                f"ready in {results['startup']['ready_seconds']}s"
+            )
+            try:
+                for position, concurrency in enumerate(args.concurrency):
+                    if position and not args.keep_caches:
+                        # Starts each level cold, like the first one.
+                        api.stop()
+                        api.reset_caches()
+                        api.start()
+                    server.stats.reset()
+                    level = asyncio.run(
+                        run_level(
+                            api.url,
+                            concurrency,
+                            args.conversations or concurrency * 2,
+                            args.stream,
+                            args.seed,
+                        )
+                    )
+                    mock_stats = server.stats.snapshot()
+                    level["calls_per_turn"] = {
+                        kind: count / max(level["turns"], 1)
+                        for kind, count in mock_stats["calls"].items()
+                    }
+                    level["mock"] = mock_stats
+                    results["levels"].append(level)
+                    print_level(level)
+            finally:
+                api.stop()
+    finally:
+        if args.keep_workdir:
+            print(f"Work directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument(
+        "--conversations",
+        type=int,
+        default=None,
+        help="Conversations per level, twice the concurrency by default.",
+    )
+    parser.add_argument("--stream", action="store_true", help="Use /query/stream.")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seeds the scripted conversations."
+    )
+    parser.add_argument(
+        "--keep-caches",
+        action="store_true",
+        help="Run every level on the same API, with the caches of the previous ones.",
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--products-file", default=PRODUCTS_FILE)
+    parser.add_argument(
+        "--env",
+        nargs="*",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Extra API settings, e.g. STATE_CLASSIFIER_MODE=llm.",
+    )
+    parser.add_argument("--output", default=None, help="Write the results as JSON.")
+    parser.add_argument("--compare", default=None, help="Previous results JSON.")
+    parser.add_argument("--keep-workdir", action="store_true")
+    add_mock_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,321 @@
+"""OpenAI compatible stub server with configurable latency, token rate and failures.
+
+Serves ``/v1/chat/completions`` (plain and streamed) and ``/v1/embeddings`` so the
+API can be benchmarked without network calls or cost, and counts the calls per kind:
+``embedding``, ``state`` (the StateController prompt) and ``chat`` (the main chain).
+
+Run standalone with::
+
+    python -m benchmarks.mock_openai --port 8900 --latency-ms 300 --tokens-per-second 50
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+EMBEDDING_DIMENSIONS = 1536
+ANSWER = (
+    "Olá! Temos o NovoPhone X12 por R$ 3.499,00, com ótima câmera e bateria de longa "
+    "duração. Posso ajudar com mais alguma dúvida sobre o produto ou seguir com a compra?"
+)
+# Keyword of the latest user message -> state answered to the state agent.
+STATE_KEYWORDS = [
+    ("obrigad", "ThankYou"),
+    ("@", "ConfirmPurchase"),
+    ("quero comprar", "CollectInfo"),
+    ("quero", "CollectInfo"),
+    ("?", "ProductQA"),
+    ("celular", "ProductSearch"),
+]
+
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 200.0
+    jitter_ms: float = 50.0
+    tokens_per_second: float = 0.0
+    completion_tokens: int = 40
+    embedding_latency_ms: float = 50.0
+    failure_rate: float = 0.0
+    seed: int = 42
+
+
+class MockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls: Dict[str, int] = {"embedding": 0, "state": 0, "chat": 0}
+            self.failures = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+
+    def count(self, kind: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        with self._lock:
+            self.calls[kind] += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def fail(self):
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "failures": self.failures,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+def _fake_embedding(text: str) -> List[float]:
+    """Deterministic unit vector, so equal texts always get equal embeddings."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    vector = [rng.gauss(0.0, 1.0) for _ in range(EMBEDDING_DIMENSIONS)]
+    norm = sum(value * value for value in vector) ** 0.5
+    return [value / norm for value in vector]
+
+
+def _state_for(prompt: str) -> str:
+    human_lines = [
+        line.strip().removeprefix("Human:")
+        for line in prompt.splitlines()
+        if line.strip().startswith("Human:")
+    ]
+    last_message = (human_lines[-1] if human_lines else prompt).lower()
+    for keyword, state in STATE_KEYWORDS:
+        if keyword in last_message:
+            return state
+    return "Welcome" if len(human_lines) <= 1 else "ProductSearch"
+
+
+def make_handler(config: MockConfig, stats: MockStats):
+    rng = random.Random(config.seed)
+    rng_lock = threading.Lock()
+
+    def random_value() -> float:
+        with rng_lock:
+            return rng.random()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._json(200, {"config": asdict(config), **stats.snapshot()})
+            else:
+                self._json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/stats/reset":
+                stats.reset()
+                return self._json(200, {"ok": True})
+            if config.failure_rate and random_value() < config.failure_rate:
+                stats.fail()
+                return self._json(
+                    500, {"error": {"message": "injected failure", "type": "server"}}
+                )
+            if self.path.endswith("/embeddings"):
+                return self._embeddings(body)
+            if self.path.endswith("/chat/completions"):
+                return self._chat(body)
+            self._json(404, {"error": {"message": "not found"}})
+
+        def _sleep(self, base_ms: float):
+            jitter = (random_value() * 2 - 1) * config.jitter_ms
+            time.sleep(max(0.0, base_ms + jitter) / 1000)
+
+        def _embeddings(self, body: dict):
+            inputs = body.get("input", [])
+            if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+                inputs = [inputs]
+            texts = [
+                text if isinstance(text, str) else json.dumps(text) for text in inputs
+            ]
+            self._sleep(config.embedding_latency_ms)
+            tokens = sum(len(text.split()) for text in texts)
+            stats.count("embedding", prompt_tokens=tokens)
+            self._json(
+                200,
+                {
+                    "object": "list",
+                    "model": body.get("model", "text-embedding-ada-002"),
+                    "data": [
+                        {
+                            "object": "embedding",
+                            "index": i,
+                            "embedding": _fake_embedding(text),
+                        }
+                        for i, text in enumerate(texts)
+                    ],
+                    "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+                },
+            )
+
+        def _chat(self, body: dict):
+            prompt = "\n".join(
+                str(message.get("content", "")) for message in body.get("messages", [])
+            )
+            prompt_tokens = len(prompt.split())
+            if "Determine the current stage" in prompt:
+                kind, content = "state", _state_for(prompt)
+            else:
+                words = ANSWER.split()
+                kind = "chat"
+                content = " ".join(
+                    words[i % len(words)] for i in range(config.completion_tokens)
+                )
+            tokens = content.split(" ")
+            stats.count(kind, prompt_tokens, len(tokens))
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+            model = body.get("model", "gpt-3.5-turbo")
+            self._sleep(config.latency_ms)
+
+            if not body.get("stream"):
+                if config.tokens_per_second:
+                    time.sleep(len(tokens) / config.tokens_per_second)
+                return self._json(
+                    200,
+                    {
+                        "id": completion_id,
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": content},
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": len(tokens),
+                            "total_tokens": prompt_tokens + len(tokens),
+                        },
+                    },
+                )
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, token in enumerate(tokens):
+                if config.tokens_per_second:
+                    time.sleep(1 / config.tokens_per_second)
+                delta = {"content": token if i == 0 else f" {token}"}
+                if i == 0:
+                    delta["role"] = "assistant"
+                self._chunk(completion_id, model, delta, None)
+            self._chunk(completion_id, model, {}, "stop")
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+
+        def _chunk(self, completion_id, model, delta, finish_reason):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            self._write_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def _json(self, status_code: int, payload: dict):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+class MockOpenAIServer:
+    """Runs the stub in a background thread, e.g. ``with MockOpenAIServer(config) as url:``."""
+
+    def __init__(self, config: MockConfig, host: str = "127.0.0.1", port: int = 0):
+        self.config = config
+        self.stats = MockStats()
+        self._server = ThreadingHTTPServer(
+            (host, port), make_handler(config, self.stats)
+        )
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> str:
+        self._thread.start()
+        return self.url
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def parse_config(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        embedding_latency_ms=args.embedding_latency_ms,
+        failure_rate=args.failure_rate,
+    )
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=MockConfig.latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=MockConfig.jitter_ms)
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=MockConfig.tokens_per_second
+    )
+    parser.add_argument(
+        "--completion-tokens", type=int, default=MockConfig.completion_tokens
+    )
+    parser.add_argument(
+        "--embedding-latency-ms", type=float, default=MockConfig.embedding_latency_ms
+    )
+    parser.add_argument("--failure-rate", type=float, default=MockConfig.failure_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8900)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    server = MockOpenAIServer(parse_config(args), port=args.port)
+    with server as url:
+        print(f"Mock OpenAI server listening on {url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,409 @@
+"""Replays recorded conversations through the state pipeline to catch regressions.
+
+Each session of the CSV exports and of the SQLite transcripts is played again through
+a MarketplaceJourney, turn by turn: the user message goes through the StateController
+and the recorded answer, instead of a new one, is added to the history, so every
+turn is classified from the same history it had when it was recorded. Sessions are
+spread over worker processes.
+
+The state LLM answers are stored by prompt. With ``--llm-mode record`` the missing
+ones are asked and saved; with the default ``cached`` mode nothing is sent to OpenAI
+and a missing answer keeps the current state, counted as a miss, so thousands of
+sessions replay in seconds. The transcripts record the state of each answer, which is
+the expected state of the turn. The results are written as JSON, tagged with the git
+commit, so the state sequences of two versions of the pipeline can be compared::
+
+    python -m benchmarks.replay --llm-mode record --output before.json
+    python -m benchmarks.replay --output after.json --compare before.json
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.load_test import PRODUCTS_FILE, ROOT_DIR, git_sha
+from src.llm.transcripts import TRANSCRIPTS_DB, load_transcripts
+
+TRANSCRIPTS_DIR = os.path.join(ROOT_DIR, "data", "07_model_output")
+RESPONSES_DB = os.path.join(TRANSCRIPTS_DIR, "state_llm_responses.sqlite3")
+LLM_MODES = ("cached", "record", "live")
+
+
+class RecordedLLM:
+    """
+    State LLM answers stored by prompt.
+
+    Attributes:
+        mode (str): "cached" only answers from the stored responses, "record" asks the
+            LLM for the missing ones and keeps them, "live" always asks the LLM.
+        responses (Dict[str, str]): The answers, keyed by the hash of the prompt.
+        recorded (Dict[str, str]): The answers asked since the last drain.
+        counts (Counter): Hits, misses and LLM calls since the last drain.
+    """
+
+    def __init__(self, mode: str = "cached", responses: Optional[Dict] = None):
+        if mode not in LLM_MODES:
+            raise ValueError(f"Unknown LLM mode '{mode}', expected one of {LLM_MODES}")
+        self.mode = mode
+        self.responses = responses or {}
+        self.recorded: Dict[str, str] = {}
+        self.counts: Counter = Counter()
+
+    @staticmethod
+    def key(prompt: str) -> str:
+        from src.llm.dinamic_state import STATE_MODEL
+
+        return hashlib.sha256(f"{STATE_MODEL}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def wrap(self, ask: Callable[[str], str]) -> Callable[[str], str]:
+        """A state LLM answering from the stored responses, falling back on `ask`."""
+
+        def answer(prompt: str) -> str:
+            key = self.key(prompt)
+            if self.mode != "live" and key in self.responses:
+                self.counts["hits"] += 1
+                return self.responses[key]
+            if self.mode == "cached":
+                self.counts["misses"] += 1
+                return ""
+            self.counts["calls"] += 1
+            response = ask(prompt)
+            if self.mode == "record":
+                self.responses[key] = self.recorded[key] = response
+            return response
+
+        return answer
+
+    def drain(self) -> Dict:
+        drained = {"recorded": self.recorded, "counts": dict(self.counts)}
+        self.recorded = {}
+        self.counts = Counter()
+        return drained
+
+
+def read_responses(db_path: str) -> Dict[str, str]:
+    if not os.path.exists(db_path):
+        return {}
+    with sqlite3.connect(db_path) as connection:
+        return dict(connection.execute("SELECT key, response FROM responses"))
+
+
+def save_responses(db_path: str, responses: Dict[str, str]):
+    if not responses:
+        return
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    with sqlite3.connect(db_path) as connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)"
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?)", responses.items()
+        )
+
+
+def _dedupe(messages: List[Dict]) -> List[Dict]:
+    """Collapses consecutive copies of a message, older versions stored each twice."""
+    deduped: List[Dict] = []
+    for message in messages:
+        if deduped and (deduped[-1]["sender"], deduped[-1]["message"]) == (
+            message["sender"],
+            message["message"],
+        ):
+            continue
+        deduped.append(message)
+    return deduped
+
+
+def to_turns(messages: List[Dict]) -> List[Dict]:
+    """
+    Groups the messages of a session into turns.
+
+    Parameters:
+        messages (List[Dict]): The messages in order, with the sender, message and,
+            from the transcripts, the state.
+
+    Returns:
+        List[Dict]: One turn per user message, with the question, the answers that
+        followed it and, when recorded, the state of the answer as the expected state.
+    """
+    turns: List[Dict] = []
+    for message in _dedupe(messages):
+        if message["sender"] == "Human":
+            turns.append({"question": message["message"], "answers": []})
+        elif turns:
+            turns[-1]["answers"].append(message["message"])
+            turns[-1]["expected"] = message.get("state")
+    return turns
+
+
+def load_sessions(transcripts_dir: Optional[str], db_path: Optional[str]) -> List[Dict]:
+    """
+    Reads the sessions of the CSV exports and of the SQLite transcripts, the latter
+    winning when a session is in both.
+
+    Returns:
+        List[Dict]: One dict per session with the session_id, source and turns.
+    """
+    sessions: Dict[str, Dict] = {}
+    if transcripts_dir:
+        for filepath in sorted(glob.glob(os.path.join(transcripts_dir, "*.csv"))):
+            with open(filepath, "r", encoding="utf-8", newline="") as file:
+                rows = list(csv.DictReader(file))
+            for session_id in dict.fromkeys(row["session_id"] for row in rows):
+                messages = [row for row in rows if row["session_id"] == session_id]
+                sessions[session_id] = {
+                    "session_id": session_id,
+                    "source": os.path.basename(filepath),
+                    "turns": to_turns(messages),
+                }
+    if db_path and os.path.exists(db_path):
+        by_session: Dict[str, List[Dict]] = {}
+        for message in load_transcripts(db_path):
+            by_session.setdefault(message["session_id"], []).append(message)
+        for session_id, messages in by_session.items():
+            sessions[session_id] = {
+                "session_id": session_id,
+                "source": os.path.basename(db_path),
+                "turns": to_turns(messages),
+            }
+    return [session for session in sessions.values() if session["turns"]]
+
+
+# Built once per worker process by _init_worker.
+_worker: Dict = {}
+
+
+def _init_worker(options: Dict):
+    if options["llm_mode"] == "cached":
+        # Nothing is sent to OpenAI, the chat model only needs a key to be built.
+        os.environ.setdefault("OPENAI_API_KEY", "replay")
+    from src.llm.llm_model import MarketplaceJourney
+    from src.llm.process_rag_docs import iter_documents
+    from src.llm.product_index import ProductIndex
+    from src.llm.state_classifier import RuleBasedStateClassifier
+
+    product_index = None
+    if options["products_file"] and os.path.exists(options["products_file"]):
+        product_index = ProductIndex(
+            [document for _, document in iter_documents(options["products_file"])]
+        )
+    _worker.update(
+        journey_class=MarketplaceJourney,
+        product_index=product_index,
+        state_classifier=RuleBasedStateClassifier(),
+        llm=RecordedLLM(options["llm_mode"], read_responses(options["responses_db"])),
+        options=options,
+    )
+
+
+def _replay_session(session: Dict) -> Dict:
+    options = _worker["options"]
+    journey = _worker["journey_class"](
+        retriever=None,
+        session_id=session["session_id"],
+        state_classifier_mode=options["classifier_mode"],
+        state_classifier=_worker["state_classifier"],
+        product_index=_worker["product_index"],
+        state_history_tokens=options["state_history_tokens"],
+    )
+    journey.state_agent.state_llm = _worker["llm"].wrap(journey.state_agent.ask_agents)
+    result = {
+        "session_id": session["session_id"],
+        "source": session["source"],
+        "questions": [],
+        "states": [],
+        "expected": [],
+    }
+    try:
+        for turn in session["turns"]:
+            journey.add_to_history("user", turn["question"])
+            journey.state_agent.handle_input(journey.history)
+            result["questions"].append(turn["question"])
+            result["states"].append(journey.chatbot.state)
+            result["expected"].append(turn.get("expected"))
+            for answer in turn["answers"]:
+                journey.add_to_history("ai", answer)
+    except Exception as e:
+        result["error"] = str(e)
+    result.update(_worker["llm"].drain())
+    return result
+
+
+def replay(sessions: List[Dict], options: Dict, workers: int) -> List[Dict]:
+    """Replays the sessions over `workers` processes, in the calling one when 1."""
+    if workers <= 1:
+        _init_worker(options)
+        return [_replay_session(session) for session in sessions]
+    chunksize = max(1, len(sessions) // (workers * 4))
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(options,)
+    ) as pool:
+        return list(pool.map(_replay_session, sessions, chunksize=chunksize))
+
+
+def summarize(results: List[Dict], elapsed: float) -> Dict:
+    turns = sum(len(result["states"]) for result in results)
+    labelled = correct = 0
+    confusions: Counter = Counter()
+    llm_counts: Counter = Counter()
+    for result in results:
+        llm_counts.update(result["counts"])
+        for expected, state in zip(result["expected"], result["states"]):
+            if expected is None:
+                continue
+            labelled += 1
+            correct += expected == state
+            if expected != state:
+                confusions[f"{expected} -> {state}"] += 1
+    return {
+        "sessions": len(results),
+        "errors": sum("error" in result for result in results),
+        "turns": turns,
+        "elapsed_seconds": round(elapsed, 2),
+        "turns_per_second": round(turns / elapsed, 2) if elapsed else 0.0,
+        "labelled_turns": labelled,
+        "accuracy": round(correct / labelled, 4) if labelled else None,
+        "confusions": dict(confusions.most_common()),
+        "state_llm": {kind: llm_counts[kind] for kind in ("hits", "misses", "calls")},
+    }
+
+
+def compare(current: Dict, previous: Dict, show: int = 10):
+    """Prints the sessions whose state sequence changed since the previous run, with the
+    first turn each one diverges at, and the state changes over every shared turn."""
+    print(f"\nCompared with {previous.get('git_sha')} ({previous.get('timestamp')}):")
+    shared = current["sessions"].keys() & previous["sessions"].keys()
+    changed = []
+    compared = agreeing = 0
+    transitions: Counter = Counter()
+    for session_id in sorted(shared):
+        before = previous["sessions"][session_id]["states"]
+        now = current["sessions"][session_id]["states"]
+        pairs = list(zip(before, now))
+        compared += len(pairs)
+        agreeing += sum(old == new for old, new in pairs)
+        transitions.update(f"{old} -> {new}" for old, new in pairs if old != new)
+        if before != now:
+            turn = next(
+                (i for i, (old, new) in enumerate(pairs) if old != new), len(pairs)
+            )
+            changed.append((session_id, turn))
+    print(
+        f"  {len(changed)} of {len(shared)} sessions changed, "
+        f"{agreeing}/{compared} turns agree "
+        f"({agreeing / compared if compared else 1:.1%})"
+    )
+    for change, count in transitions.most_common():
+        print(f"  {count:>5}x {change}")
+    for session_id, turn in changed[:show]:
+        before = previous["sessions"][session_id]["states"]
+        now = current["sessions"][session_id]["states"]
+        questions = current["sessions"][session_id]["questions"]
+        question = questions[turn] if turn < len(questions) else ""
+        print(
+            f"  {session_id} turn {turn + 1}: {question[:60]!r} "
+            f"{' > '.join(before[turn:turn + 3])} => {' > '.join(now[turn:turn + 3])}"
+        )
+    previous_accuracy = previous["summary"].get("accuracy")
+    accuracy = current["summary"].get("accuracy")
+    if previous_accuracy is not None and accuracy is not None:
+        print(f"  accuracy {previous_accuracy:.1%} -> {accuracy:.1%}")
+
+
+def main(args: argparse.Namespace) -> Dict:
+    sessions = load_sessions(args.transcripts_dir, args.transcripts_db)
+    if args.limit:
+        sessions = sessions[: args.limit]
+    options = {
+        "llm_mode": args.llm_mode,
+        "classifier_mode": args.classifier_mode,
+        "state_history_tokens": args.state_history_tokens,
+        "products_file": args.products_file,
+        "responses_db": args.responses_db,
+    }
+    start = time.perf_counter()
+    results = replay(sessions, options, args.workers)
+    elapsed = time.perf_counter() - start
+    recorded: Dict[str, str] = {}
+    for result in results:
+        recorded.update(result.pop("recorded"))
+    save_responses(args.responses_db, recorded)
+
+    summary = summarize(results, elapsed)
+    report = {
+        "git_sha": git_sha(),
+        "timestamp": datetime.now().isoformat(),
+        "options": {**options, "workers": args.workers},
+        "summary": summary,
+        "sessions": {
+            result["session_id"]: {
+                key: result[key]
+                for key in ("source", "questions", "states", "expected", "error")
+                if key in result
+            }
+            for result in results
+        },
+    }
+    accuracy = summary["accuracy"]
+    print(
+        f"{summary['sessions']} sessions, {summary['turns']} turns, "
+        f"{summary['errors']} errors in {summary['elapsed_seconds']:.2f}s "
+        f"({summary['turns_per_second']:.1f} turns/s), state LLM "
+        + ", ".join(f"{kind}={count}" for kind, count in summary["state_llm"].items())
+    )
+    if accuracy is not None:
+        print(
+            f"State accuracy {accuracy:.1%} over {summary['labelled_turns']} "
+            "labelled turns"
+        )
+        for confusion, count in list(summary["confusions"].items())[:10]:
+            print(f"  {count:>5}x {confusion}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['session_id']}: {result['error']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            compare(report, json.load(file), args.show)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transcripts-dir", default=TRANSCRIPTS_DIR)
+    parser.add_argument(
+        "--transcripts-db", default=os.path.join(ROOT_DIR, TRANSCRIPTS_DB)
+    )
+    parser.add_argument("--responses-db", default=RESPONSES_DB)
+    parser.add_argument("--llm-mode", choices=LLM_MODES, default="cached")
+    parser.add_argument(
+        "--classifier-mode",
+        choices=("llm", "hybrid", "local"),
+        default=os.getenv("STATE_CLASSIFIER_MODE", "hybrid"),
+    )
+    parser.add_argument(
+        "--state-history-tokens",
+        type=int,
+        default=int(os.getenv("STATE_HISTORY_TOKENS", "800")),
+    )
+    parser.add_argument("--products-file", default=PRODUCTS_FILE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--limit", type=int, default=None, help="Sessions replayed.")
+    parser.add_argument("--output", default=None, help="Write the results as JSON.")
+    parser.add_argument("--compare", default=None, help="Previous results JSON.")
+    parser.add_argument(
+        "--show", type=int, default=10, help="Changed sessions printed by --compare."
+    )
+    main(parser.parse_args())
@@ -0,0 +1,231 @@
+"""Benchmark of the NumPy vector store against Chroma.
+
+Builds each store from the same synthetic catalog, with clustered random embeddings so
+no embedding model is called, then reports the build time, the time to open the store
+and answer a first query, the query latency percentiles, the throughput, the disk size
+and the recall of the approximate (IVF) search against the exact one::
+
+    python -m benchmarks.vector_store --products 1000 20000 --ivf-lists 64
+    python -m benchmarks.vector_store --products 100000 --dim 384 --output vs.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import numpy as np
+from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import Embeddings
+
+from benchmarks.load_test import git_sha, percentiles
+from src.llm.vector_store import NumpyVectorStore
+
+
+class VectorOnlyEmbeddings(Embeddings):
+    """The stores are only queried by vector, nothing is ever embedded."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError("The benchmark queries by vector")
+
+    def embed_query(self, text: str) -> List[float]:
+        raise NotImplementedError("The benchmark queries by vector")
+
+
+def synthetic_catalog(products: int, dim: int, seed: int = 0):
+    """Products around one center per category, like embeddings of a real catalog."""
+    rng = np.random.default_rng(seed)
+    categories = max(1, products // 200)
+    centers = rng.standard_normal((categories, dim)).astype(np.float32)
+    category = rng.integers(0, categories, products)
+    vectors = centers[category] + rng.standard_normal((products, dim)).astype(
+        np.float32
+    )
+    # Normalized like OpenAI embeddings, so Chroma's L2 ranks as the cosine does.
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [f"p{i}" for i in range(products)]
+    documents = [
+        f"Categoria {c}: Produto {i} - R$ {10 + i % 5000},00"
+        for i, c in enumerate(category)
+    ]
+    metadatas = [
+        {"category": f"Categoria {c}", "product_name": f"Produto {i}"}
+        for i, c in enumerate(category)
+    ]
+    return ids, vectors, documents, metadatas, centers
+
+
+def queries_near(centers: np.ndarray, count: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    picked = centers[rng.integers(0, len(centers), count)]
+    return picked + rng.standard_normal(picked.shape).astype(np.float32)
+
+
+def build_chroma(directory: str, ids, vectors, documents, metadatas) -> Chroma:
+    store = Chroma(
+        persist_directory=directory, embedding_function=VectorOnlyEmbeddings()
+    )
+    for start in range(0, len(ids), 1000):
+        end = start + 1000
+        store._collection.upsert(
+            ids=ids[start:end],
+            embeddings=vectors[start:end].tolist(),
+            metadatas=metadatas[start:end],
+            documents=documents[start:end],
+        )
+    return store
+
+
+def build_numpy(directory: str, ivf_lists: int, ids, vectors, documents, metadatas):
+    store = NumpyVectorStore(directory, VectorOnlyEmbeddings(), ivf_lists=ivf_lists)
+    for start in range(0, len(ids), 1000):
+        end = start + 1000
+        store.upsert(
+            ids[start:end],
+            vectors[start:end],
+            metadatas[start:end],
+            documents[start:end],
+        )
+    store.persist()
+    return store
+
+
+def directory_mb(directory: str) -> float:
+    size = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+    return round(size / 1e6, 2)
+
+
+def run_store(
+    name: str,
+    build: Callable[[str], None],
+    open_store: Callable[[str], object],
+    queries: np.ndarray,
+    k: int,
+) -> Dict:
+    directory = tempfile.mkdtemp(prefix=f"vector-bench-{name}-")
+    try:
+        start = time.perf_counter()
+        build(directory)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = open_store(directory)
+        store.similarity_search_by_vector(queries[0].tolist(), k=k)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        latencies, results = [], []
+        started = time.perf_counter()
+        for query in queries:
+            start = time.perf_counter()
+            docs = store.similarity_search_by_vector(query.tolist(), k=k)
+            latencies.append((time.perf_counter() - start) * 1e6)
+            results.append([doc.page_content for doc in docs])
+        elapsed = time.perf_counter() - started
+        return {
+            "store": name,
+            "build_seconds": round(build_seconds, 2),
+            "open_and_first_query_ms": round(open_ms, 1),
+            "latency_us": percentiles(latencies),
+            "queries_per_second": round(len(queries) / elapsed, 1),
+            "disk_mb": directory_mb(directory),
+            "results": results,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def recall(results: List[List[str]], exact: List[List[str]]) -> float:
+    found = sum(len(set(got) & set(want)) for got, want in zip(results, exact))
+    return round(found / max(sum(len(want) for want in exact), 1), 4)
+
+
+def run_size(args: argparse.Namespace, products: int) -> List[Dict]:
+    ids, vectors, documents, metadatas, centers = synthetic_catalog(products, args.dim)
+    queries = queries_near(centers, args.queries)
+    catalog = (ids, vectors, documents, metadatas)
+    stores = [
+        (
+            "numpy",
+            lambda d: build_numpy(d, 0, *catalog),
+            lambda d: NumpyVectorStore(d, VectorOnlyEmbeddings()),
+        ),
+        (
+            "chroma",
+            lambda d: build_chroma(d, *catalog),
+            lambda d: Chroma(
+                persist_directory=d, embedding_function=VectorOnlyEmbeddings()
+            ),
+        ),
+    ]
+    if args.ivf_lists:
+        stores.append(
+            (
+                f"numpy-ivf{args.ivf_lists}",
+                lambda d: build_numpy(d, args.ivf_lists, *catalog),
+                lambda d: NumpyVectorStore(
+                    d, VectorOnlyEmbeddings(), ivf_probe=args.ivf_probe
+                ),
+            )
+        )
+    rows = [
+        run_store(name, build, open_store, queries, args.k)
+        for name, build, open_store in stores
+    ]
+    exact = rows[0]["results"]
+    for row in rows:
+        row["products"] = products
+        row["recall_at_k"] = recall(row.pop("results"), exact)
+        latency = row["latency_us"]
+        print(
+            f"{products:>8} {row['store']:<14} build {row['build_seconds']:>7.2f}s  "
+            f"open {row['open_and_first_query_ms']:>8.1f}ms  "
+            f"p50 {latency['p50']:>8.1f}us  p95 {latency['p95']:>8.1f}us  "
+            f"{row['queries_per_second']:>8.1f} q/s  {row['disk_mb']:>8.2f}MB  "
+            f"recall {row['recall_at_k']:.3f}"
+        )
+    return rows
+
+
+def main(args: argparse.Namespace) -> Dict:
+    results = {
+        "git_sha": git_sha(),
+        "timestamp": datetime.now().isoformat(),
+        "dim": args.dim,
+        "k": args.k,
+        "queries": args.queries,
+        "runs": [],
+    }
+    for products in args.products:
+        results["runs"].extend(run_size(args, products))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, nargs="+", default=[1000, 20000])
+    parser.add_argument(
+        "--dim", type=int, default=1536, help="1536 for OpenAI, 384 for local models."
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument(
+        "--ivf-lists",
+        type=int,
+        default=0,
+        help="Also benchmark the IVF search with this many lists.",
+    )
+    parser.add_argument("--ivf-probe", type=int, default=8)
+    parser.add_argument("--output", default=None, help="Write the results as JSON.")
+    main(parser.parse_args())
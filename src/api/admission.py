@@ -0,0 +1,179 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from src.llm.instrumentation import ADMISSION_REJECTIONS, QUEUE_SECONDS, annotate
+
+BATCH_PRIORITY = -1
+NORMAL_PRIORITY = 0
+HIGH_PRIORITY = 1
+PRIORITY_STATES = ("CollectInfo", "ConfirmPurchase")
+
+
+def _label(priority: int) -> str:
+    if priority < NORMAL_PRIORITY:
+        return "batch"
+    return "high" if priority > NORMAL_PRIORITY else "normal"
+
+
+class QueueFull(Exception):
+    """No admission slot and no room in the queue, retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Admission queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the turns answered at the same time and queues the next ones by priority.
+
+    A turn takes one of the max_concurrency slots, or waits in the queue for one.
+    When a slot is released it goes to the waiting turn with the highest priority,
+    the oldest first, so the sessions close to a purchase (PRIORITY_STATES) skip ahead
+    of the others. Once max_queue turns are waiting new ones are rejected with an
+    estimate of when to retry, instead of every turn slowing down together. A turn
+    arriving at a full queue takes the place of the newest waiting turn of a lower
+    priority, if any, which is rejected instead, so the offline batches
+    (BATCH_PRIORITY) never cause the interactive sessions to be rejected.
+
+    It is only used from the event loop, so it needs no locks.
+
+    Attributes:
+        max_concurrency (int): Turns answered at the same time.
+        max_queue (int): Turns allowed to wait for a slot.
+        priority_states (frozenset): States whose turns are served first.
+        in_flight (int): Slots taken.
+        admitted (int): Turns admitted since startup.
+        rejected (int): Turns rejected since startup.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 32,
+        max_queue: int = 64,
+        priority_states: Iterable[str] = PRIORITY_STATES,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.priority_states = frozenset(priority_states)
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        # Moving average of the time a slot is held, to estimate the Retry-After.
+        self._slot_seconds = 1.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    def priority_for(self, state: str) -> int:
+        return HIGH_PRIORITY if state in self.priority_states else NORMAL_PRIORITY
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int = NORMAL_PRIORITY) -> float:
+        """
+        Takes a slot, waiting in the queue when none is free.
+
+        Parameters:
+            priority (int): HIGH_PRIORITY turns are served before NORMAL_PRIORITY ones.
+
+        Returns:
+            float: The time waited, in seconds.
+
+        Raises:
+            QueueFull: The queue is full.
+        """
+        start = time.perf_counter()
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self.in_flight += 1
+        else:
+            self.check(priority)
+            if self._full():
+                self._preempt()
+            waiter = (
+                -priority,
+                next(self._order),
+                asyncio.get_running_loop().create_future(),
+            )
+            heapq.heappush(self._waiters, waiter)
+            try:
+                await waiter[2]
+            except asyncio.CancelledError:
+                if waiter[2].done() and not waiter[2].cancelled():
+                    # The slot was handed over as the request went away.
+                    self.release()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                raise
+        waited = time.perf_counter() - start
+        self.admitted += 1
+        QUEUE_SECONDS.observe(waited, priority=_label(priority))
+        annotate(queue_ms=round(waited * 1000, 2))
+        return waited
+
+    def check(self, priority: int = NORMAL_PRIORITY):
+        """
+        Raises QueueFull when a turn would be rejected now, for the streams that must
+        answer 429 before their response starts, while the slot is taken later.
+        """
+        if self._full() and not (self._waiters and -max(self._waiters)[0] < priority):
+            self.rejected += 1
+            ADMISSION_REJECTIONS.inc(priority=_label(priority))
+            raise QueueFull(self.retry_after())
+
+    def _full(self) -> bool:
+        return self.in_flight >= self.max_concurrency and self.queued >= self.max_queue
+
+    def _preempt(self):
+        """Rejects the newest waiting turn of the lowest priority to make room."""
+        waiter = max(self._waiters)
+        self._waiters.remove(waiter)
+        heapq.heapify(self._waiters)
+        self.rejected += 1
+        ADMISSION_REJECTIONS.inc(priority=_label(-waiter[0]))
+        if not waiter[2].done():
+            waiter[2].set_exception(QueueFull(self.retry_after()))
+
+    def release(self, held_seconds: Optional[float] = None):
+        """Hands the slot over to the next waiting turn, or frees it."""
+        if held_seconds is not None:
+            self._slot_seconds = 0.8 * self._slot_seconds + 0.2 * held_seconds
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self, priority: int = NORMAL_PRIORITY) -> AsyncIterator[None]:
+        """Holds a slot for the duration of the block, see acquire."""
+        await self.acquire(priority)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    def retry_after(self) -> int:
+        """Seconds until the queue is expected to have drained, at least 1."""
+        waves = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, math.ceil(waves * self._slot_seconds))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "slot_seconds": round(self._slot_seconds, 3),
+        }
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+from src.api.admission import BATCH_PRIORITY, AdmissionController, QueueFull
+from src.api.session_store import SESSION_ID_PATTERN
+
+if TYPE_CHECKING:
+    from src.llm.llm_model import MarketplaceJourney
+
+
+class BatchConversation(BaseModel):
+    id: Optional[str] = Field(
+        None,
+        pattern=SESSION_ID_PATTERN,
+        example="qa-001",
+        description="Identifies the conversation in the results, generated when missing.",
+    )
+    turns: List[str] = Field(
+        ...,
+        example=["Olá", "Quais celulares vocês têm?"],
+        description="The user's messages, sent in order.",
+    )
+
+
+class BatchRequest(BaseModel):
+    conversations: List[BatchConversation]
+    concurrency: Optional[int] = Field(
+        None,
+        example=8,
+        description="Conversations run at the same time, capped by BATCH_MAX_CONCURRENCY.",
+    )
+
+
+async def _answer(
+    journey: "MarketplaceJourney", question: str, admission: AdmissionController
+) -> Dict:
+    # Batch turns share the admission slots with the live ones, behind them, and wait
+    # for the queue to drain instead of failing the conversation when it is full.
+    while True:
+        try:
+            async with admission.admit(BATCH_PRIORITY):
+                return await journey.get_answer_async(question=question)
+        except QueueFull as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def _play(
+    conversation: BatchConversation,
+    journey_factory: Callable[[str], "MarketplaceJourney"],
+    admission: AdmissionController,
+    batch_id: str,
+) -> Dict:
+    conversation_id = conversation.id or uuid.uuid4().hex
+    result = {"conversation_id": conversation_id, "turns": []}
+    journey = None
+    try:
+        journey = journey_factory(f"batch-{batch_id}-{conversation_id}")
+        for question in conversation.turns:
+            start = time.perf_counter()
+            response = await _answer(journey, question, admission)
+            result["turns"].append(
+                {
+                    "question": question,
+                    "answer": response["text"],
+                    "state": journey.chatbot.state,
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+                }
+            )
+    except Exception as e:
+        logging.error(f"Erro na conversa {conversation_id} do lote: {str(e)}")
+        result["error"] = str(e)
+    if journey is None:
+        return result
+    try:
+        await asyncio.to_thread(journey.end_session)
+    except Exception as e:
+        logging.error(f"Failed to flush session {journey.session_id}: {str(e)}")
+    return result
+
+
+async def run_batch(
+    conversations: List[BatchConversation],
+    journey_factory: Callable[[str], "MarketplaceJourney"],
+    admission: AdmissionController,
+    concurrency: int,
+) -> AsyncIterator[Dict]:
+    """
+    Plays the conversations with at most `concurrency` of them at a time.
+
+    Each conversation gets a journey of its own, outside the live sessions, and its
+    turns are sent one after the other. A fixed number of workers pull the next
+    conversation as they finish one, so the memory and the throughput depend on the
+    concurrency, not on the size of the batch. Each turn is admitted like a live one,
+    at BATCH_PRIORITY, so a batch never answers more turns at once than the admission
+    controller allows and yields to the interactive sessions. Results are yielded in
+    completion order.
+
+    Parameters:
+        conversations (List[BatchConversation]): The conversations to play.
+        journey_factory (Callable[[str], MarketplaceJourney]): Builds a journey for a
+            session id.
+        admission (AdmissionController): Bounds the turns answered at the same time.
+        concurrency (int): Maximum number of conversations played at the same time.
+
+    Yields:
+        Dict: One result per conversation, with the answer, state and latency of each
+        turn, and a final summary with "done" set.
+    """
+    batch_id = uuid.uuid4().hex[:8]
+    pending: "asyncio.Queue[BatchConversation]" = asyncio.Queue()
+    for conversation in conversations:
+        pending.put_nowait(conversation)
+    results: "asyncio.Queue[Dict]" = asyncio.Queue()
+
+    async def worker():
+        while True:
+            try:
+                conversation = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await results.put(
+                await _play(conversation, journey_factory, admission, batch_id)
+            )
+
+    start = time.perf_counter()
+    workers = [
+        asyncio.create_task(worker())
+        for _ in range(max(1, min(concurrency, len(conversations))))
+    ]
+    errors = turns = 0
+    try:
+        for _ in range(len(conversations)):
+            result = await results.get()
+            errors += "error" in result
+            turns += len(result["turns"])
+            yield result
+    finally:
+        # Stops the workers when the client goes away before the end of the batch.
+        for task in workers:
+            task.cancel()
+    elapsed = time.perf_counter() - start
+    yield {
+        "done": True,
+        "conversations": len(conversations),
+        "errors": errors,
+        "turns": turns,
+        "elapsed_seconds": round(elapsed, 2),
+        "turns_per_second": round(turns / elapsed, 2) if elapsed else 0.0,
+    }
@@ -1,11 +1,28 @@
+import asyncio
+import json
 import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
-from src.llm.create_rag_db import update_chroma_db
-from src.llm.llm_model import MarketplaceJourney
+from src.api.admission import QueueFull
+from src.api.batch import BatchRequest, run_batch
+from src.api.services import Services, StartupProfile, build_services
+from src.api.session_store import SESSION_ID_PATTERN, VersionConflict
+from src.llm.instrumentation import (
+    REQUEST_SECONDS,
+    REQUESTS,
+    annotate,
+    log_request,
+    metrics,
+    request_trace,
+)
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -34,6 +51,8 @@ reaches a conclusion phase.
 - URL: `/query`
 - Body (JSON):
   - `question` (str): The user's question.
+  - `session_id` (str, optional): The conversation identifier, up to 64 letters, digits,
+  `-` or `_`. A new session is created when it is missing or unknown.
 
 #### Response
 
@@ -41,6 +60,33 @@ reaches a conclusion phase.
 - Body (JSON):
   - `message` (str): The response message from the assistant.
   - `end_session` (bool, optional): Indicates whether the session should be ended after the response.
+  - `session_id` (str): The conversation identifier to be sent on the next questions.
+
+### `POST /query/stream`
+
+Same request body as `/query`, but the answer is streamed as newline delimited JSON
+(`application/x-ndjson`) while the LLM generates it.
+
+- One `{"token": "..."}` frame per generated token.
+- A final `{"done": true, "end_session": bool, "session_id": "..."}` frame.
+- On failure, an `{"error": "..."}` frame ends the stream.
+
+### `POST /query/batch`
+
+Plays many scripted conversations for QA and A/B evaluation, each one isolated from
+the live sessions and from each other, with its turns sent in order. At most
+`concurrency` conversations run at the same time (default `BATCH_CONCURRENCY`, capped
+by `BATCH_MAX_CONCURRENCY`). Results are streamed as newline delimited JSON as each
+conversation finishes. `python -m src.batch_eval` sends a JSONL file of conversations.
+
+- Body (JSON):
+  - `conversations` (list): `{"id": str (optional), "turns": [str, ...]}` items, the
+  `id` in the same format as a `session_id`.
+  - `concurrency` (int, optional): Conversations run at the same time.
+- One `{"conversation_id", "turns": [{"question", "answer", "state", "latency_ms"}]}`
+  frame per conversation, with an `error` when it failed.
+- A final `{"done": true, "conversations", "errors", "turns", "elapsed_seconds",
+  "turns_per_second"}` frame.
 
 ### `POST /end-session`
 
@@ -50,6 +96,8 @@ This endpoint is used to explicitly end a session, ensuring that all resources a
 
 - Method: `POST`
 - URL: `/end-session`
+- Body (JSON):
+  - `session_id` (str): The conversation identifier to end, same format as in `/query`.
 
 #### Response
 
@@ -62,14 +110,259 @@ This endpoint is used to explicitly end a session, ensuring that all resources a
 ```bash
 curl -X POST "http://localhost:8000/query" -H "Content-Type: application/json"
 -d '{"question": "Qual celular possui a venda?",
-"stage": "main"}'
+"session_id": "4f1c2b3a-demo"}'
 ```
+
+### Admission control
+
+At most `ADMISSION_MAX_CONCURRENCY` turns of `/query`, `/query/stream` and
+`/query/batch` are answered at the same time and up to `ADMISSION_MAX_QUEUE` more wait
+for a slot, the sessions in CollectInfo or ConfirmPurchase first. Beyond that the
+request is answered with `429 Too Many Requests` and a `Retry-After` header. Batch
+turns come after every live turn and give up their place in a full queue to them,
+then wait and try again, so a batch never causes a 429 for a chat user.
+`GET /admission/stats` returns the turns in flight, queued, admitted and rejected; the
+queue wait is in the `marketplace_queue_wait_seconds` metric.
+
+### Turn deadline
+
+Each turn is answered within `TURN_DEADLINE_SECONDS` (default 15, `0` disables it). The
+state LLM may use 35% of it and retrieval 25%, generation gets what is left. A stage out
+of time falls back instead of failing the turn: the state from the local rules or the
+current one, a lexical only product search and, for the answer, the cached answer of the
+question or a message asking the user to repeat it. The state and generation LLM calls
+slower than their recent p95 are hedged with a duplicate call, the first answer wins.
+Misses are counted in `marketplace_deadline_misses_total` and hedged calls in
+`marketplace_hedged_calls_total`.
+
+### `GET /sessions/stats`
+
+Returns the number of live sessions and how many were evicted by the LRU
+(`MAX_SESSIONS`) or idle TTL (`SESSION_TTL_SECONDS`) policies. The state of each
+session is saved after every turn to the store selected by `SESSION_BACKEND`: `memory`
+(default, a single worker) or `sqlite` (the `SESSIONS_DB` file, shared by every worker
+of the host, so the API can run with `uvicorn --workers N`). A turn that started before
+another turn of the same session was saved is answered with `409 Conflict`.
+
+### `GET /state-classifier/stats`
+
+Returns how many turns had their state decided by the local rules and how many fell
+back to the LLM. The mode is selected with `STATE_CLASSIFIER_MODE`: `llm`, `hybrid`
+(default) or `local`.
+
+### `GET /retrieval-cache/stats`
+
+Returns the hit and miss counters of the query embedding and retrieval result caches.
+The in-memory layer is bounded by `RETRIEVAL_CACHE_SIZE` and `RETRIEVAL_CACHE_PATH`
+enables the SQLite layer. Cached results are dropped when the vector store changes.
+
+### `GET /response-cache/stats`
+
+Returns the hit, miss and coalesced counters of the answer cache. Answers are cached
+only for the states listed in `RESPONSE_CACHE_STATES` (e.g. `Welcome,ThankYou`, none
+by default), whose answer must not depend on the rest of the conversation, keyed by
+state, normalized question and retrieved product details, for
+`RESPONSE_CACHE_TTL_SECONDS` and up to `RESPONSE_CACHE_SIZE` answers. Identical
+questions arriving while the answer is generated wait for it instead of calling the LLM.
+
+### `GET /healthz` and `GET /readyz`
+
+Liveness and readiness probes. The server starts listening before the vector store,
+the LLM clients and the state agents are loaded, `/healthz` answers as soon as the
+process is up while `/readyz` answers `503` until the warmup is done and then `200`
+with the duration of each startup step. Requests received during the warmup wait
+for it to finish.
+
+### `GET /metrics`
+
+Prometheus text format metrics: latency histograms of the retrieval, state and
+generation stages and of each endpoint, prompt and completion tokens per model and
+conversation state, LLM calls per chain, state transitions, cache and state classifier
+hit counters and live sessions. Setting `STRUCTURED_LOGS=true` also logs one JSON line
+per request with its spans, token counts and final state.
 """
 
-app = FastAPI(title="MarketplaceJourney API", description=description, version="1.0.0")
 
-retriever = update_chroma_db()
-study_journey = MarketplaceJourney(retriever=retriever)
+profile = StartupProfile(started_at=time.perf_counter())
+services: Optional[Services] = None
+warmup: Optional[asyncio.Task] = None
+structured_logs = os.getenv("STRUCTURED_LOGS", "false").lower() in ("1", "true", "yes")
+
+
+async def _warmup():
+    global services
+    try:
+        services = await asyncio.to_thread(build_services, profile)
+    except Exception as e:
+        logging.error(f"Falha ao iniciar a API: {str(e)}")
+        raise
+    profile.ready()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global warmup
+    # The warmup runs in the background so the liveness probe answers right away,
+    # /readyz reports when the API can take traffic.
+    warmup = asyncio.create_task(_warmup())
+    yield
+    if not warmup.done():
+        warmup.cancel()
+    if services is not None:
+        await services.aclose()
+
+
+app = FastAPI(
+    title="MarketplaceJourney API",
+    description=description,
+    version="1.0.0",
+    lifespan=lifespan,
+)
+
+
+async def get_services() -> Services:
+    """The shared components, waiting for the warmup when it is still running."""
+    if services is None:
+        if warmup is None:
+            raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Not started.")
+        try:
+            await asyncio.shield(warmup)
+        except asyncio.CancelledError:
+            # Only the warmup was cancelled, e.g. on shutdown, not this request.
+            if not warmup.cancelled():
+                raise
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE, "Startup cancelled."
+            )
+        except Exception as e:
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE, f"Startup failed: {str(e)}"
+            )
+    return services
+
+
+def _retrieval_cache_samples():
+    if services is None:
+        return []
+    stats = services.retrieval_cache.get_stats()
+    return [
+        ({"cache": cache, "result": result}, stats[f"{cache}_{key}"])
+        for cache in ("embedding", "result")
+        for key, result in (
+            ("hits", "hit"),
+            ("disk_hits", "disk_hit"),
+            ("misses", "miss"),
+        )
+    ]
+
+
+def _response_cache_samples():
+    if services is None:
+        return []
+    stats = services.response_cache.get_stats()
+    return [
+        ({"result": result}, stats[key])
+        for key, result in (
+            ("hits", "hit"),
+            ("misses", "miss"),
+            ("coalesced", "coalesced"),
+        )
+    ]
+
+
+def _state_classifier_samples():
+    if services is None:
+        return []
+    classifier = services.state_classifier
+    return [
+        ({"result": "local_hit"}, classifier.local_hits),
+        ({"result": "fallback"}, classifier.fallbacks),
+    ]
+
+
+def _session_samples(key: str):
+    if services is None:
+        return []
+    return [({}, services.sessions.stats()[key])]
+
+
+metrics.callback(
+    "marketplace_retrieval_cache_lookups_total",
+    "Embedding and retrieval result cache lookups, per outcome.",
+    _retrieval_cache_samples,
+    type_name="counter",
+)
+metrics.callback(
+    "marketplace_response_cache_lookups_total",
+    "Answer cache lookups, per outcome: hit, miss or coalesced with an identical call.",
+    _response_cache_samples,
+    type_name="counter",
+)
+metrics.callback(
+    "marketplace_state_classifier_decisions_total",
+    "Turns whose state was decided by the local rules or fell back to the LLM.",
+    _state_classifier_samples,
+    type_name="counter",
+)
+metrics.callback(
+    "marketplace_live_sessions",
+    "Sessions in the session store.",
+    lambda: _session_samples("live_sessions"),
+)
+metrics.callback(
+    "marketplace_session_evictions_total",
+    "Sessions evicted by the LRU or idle TTL policies.",
+    lambda: _session_samples("evictions"),
+    type_name="counter",
+)
+metrics.callback(
+    "marketplace_admission_turns",
+    "Turns being answered and waiting for a slot.",
+    lambda: (
+        [
+            ({"status": "in_flight"}, services.admission.in_flight),
+            ({"status": "queued"}, services.admission.queued),
+        ]
+        if services is not None
+        else []
+    ),
+)
+metrics.callback(
+    "marketplace_startup_seconds",
+    "Duration of each startup step.",
+    lambda: [({"step": name}, seconds) for name, seconds in profile.steps.items()],
+)
+
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    routes = {route.path for route in app.routes}
+    endpoint = request.url.path if request.url.path in routes else "other"
+    start = time.perf_counter()
+    with request_trace(method=request.method, endpoint=endpoint) as trace:
+        response = await call_next(request)
+
+    def finish():
+        elapsed = time.perf_counter() - start
+        REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+        REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+        if structured_logs and endpoint != "/metrics":
+            trace.update(status=response.status_code, duration_ms=elapsed * 1000)
+            log_request(trace)
+
+    # Streamed answers are still being generated when the headers are sent, the
+    # request is only done once the body is.
+    body = response.body_iterator
+
+    async def observed_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            finish()
+
+    response.body_iterator = observed_body()
+    return response
 
 
 class QueryRequest(BaseModel):
@@ -78,34 +371,159 @@ class QueryRequest(BaseModel):
         example="What smartphones do you have?",
         description="The question to ask the chatbot.",
     )
+    session_id: Optional[str] = Field(
+        None,
+        pattern=SESSION_ID_PATTERN,
+        example="4f1c2b3a-demo",
+        description="The conversation identifier, a new one is created when missing.",
+    )
 
 
 class QueryResponse(BaseModel):
     message: str
     end_session: bool = False
+    session_id: str
+
+
+class EndSessionRequest(BaseModel):
+    session_id: str = Field(
+        ...,
+        pattern=SESSION_ID_PATTERN,
+        example="4f1c2b3a-demo",
+        description="The conversation identifier to end.",
+    )
+
+
+def _busy(error: QueueFull) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(error.retry_after)},
+        content={
+            "message": "The server is busy, send the question again later.",
+            "retry_after": error.retry_after,
+        },
+    )
+
+
+def _failed(error: Exception) -> JSONResponse:
+    logging.error(f"Erro ao processar a requisição: {str(error)}")
+    return JSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={
+            "message": "An error occurred while processing your request.",
+            "details": str(error),
+        },
+    )
 
 
 @app.post("/query", response_model=QueryResponse)
-def query_model(request: QueryRequest):
+async def query_model(request: QueryRequest):
+    current = await get_services()
+    sessions, admission = current.sessions, current.admission
+    journey = None
     try:
-        message = study_journey.get_answer(question=request.question)
-        end_session = study_journey.chatbot.state == "ThankYou"
-        return QueryResponse(message=message["text"], end_session=end_session)
-    except Exception as e:
-        logging.error(f"Erro ao processar a requisição: {str(e)}")
+        session_id = request.session_id or str(uuid.uuid4())
+        annotate(session_id=session_id)
+        journey = await asyncio.to_thread(sessions.get, session_id)
+        async with admission.admit(admission.priority_for(journey.chatbot.state)):
+            message = await journey.get_answer_async(question=request.question)
+            await asyncio.to_thread(sessions.save, session_id, journey)
+        end_session = journey.chatbot.state == "ThankYou"
+        return QueryResponse(
+            message=message["text"], end_session=end_session, session_id=session_id
+        )
+    except QueueFull as e:
+        logging.warning(f"Fila cheia, sessão {session_id} recusada: {str(e)}")
+        return _busy(e)
+    except VersionConflict as e:
+        logging.error(f"Turno concorrente na sessão {session_id}: {str(e)}")
         return JSONResponse(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            status_code=status.HTTP_409_CONFLICT,
             content={
-                "message": "An error occurred while processing your request.",
+                "message": "The session was updated by another request, "
+                "send the question again.",
                 "details": str(e),
             },
         )
+    except Exception as e:
+        return _failed(e)
+    finally:
+        if journey is not None:
+            sessions.release(session_id, journey)
+
+
+@app.post("/query/stream")
+async def query_model_stream(request: QueryRequest):
+    current = await get_services()
+    sessions, admission = current.sessions, current.admission
+    session_id = request.session_id or str(uuid.uuid4())
+    annotate(session_id=session_id)
+    journey = None
+    try:
+        journey = await asyncio.to_thread(sessions.get, session_id)
+        priority = admission.priority_for(journey.chatbot.state)
+        admission.check(priority)
+    except Exception as e:
+        if journey is not None:
+            sessions.release(session_id, journey)
+        if isinstance(e, QueueFull):
+            logging.warning(f"Fila cheia, sessão {session_id} recusada: {str(e)}")
+            return _busy(e)
+        return _failed(e)
+
+    async def frames():
+        # The slot is taken once the stream starts, so a stream that never starts
+        # cannot hold one.
+        try:
+            async with admission.admit(priority):
+                async for token in journey.stream_answer(question=request.question):
+                    yield json.dumps({"token": token}) + "\n"
+                await asyncio.to_thread(sessions.save, session_id, journey)
+            end_session = journey.chatbot.state == "ThankYou"
+            yield json.dumps(
+                {"done": True, "end_session": end_session, "session_id": session_id}
+            ) + "\n"
+        except QueueFull as e:
+            yield json.dumps({"error": str(e), "retry_after": e.retry_after}) + "\n"
+        except Exception as e:
+            logging.error(f"Erro ao processar a requisição: {str(e)}")
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            # Also when the client went away before the end of the stream.
+            sessions.release(session_id, journey)
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+
+@app.post("/query/batch")
+async def query_batch(request: BatchRequest):
+    current = await get_services()
+    concurrency = min(
+        request.concurrency or int(os.getenv("BATCH_CONCURRENCY", "8")),
+        int(os.getenv("BATCH_MAX_CONCURRENCY", "32")),
+    )
+
+    async def frames():
+        async for result in run_batch(
+            request.conversations,
+            current.sessions.factory,
+            current.admission,
+            concurrency,
+        ):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
 
 
 @app.post("/end-session")
-def end_session():
+async def end_session(request: EndSessionRequest):
+    sessions = (await get_services()).sessions
     try:
-        study_journey.end_session()
+        if not await asyncio.to_thread(sessions.end, request.session_id):
+            return JSONResponse(
+                status_code=status.HTTP_404_NOT_FOUND,
+                content={"message": "Session not found."},
+            )
         return {"message": "Session ended successfully"}
     except Exception as e:
         logging.error(f"Erro ao tentar finalizar a sessão: {str(e)}")
@@ -113,3 +531,55 @@ def end_session():
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"message": "Failed to end session.", "details": str(e)},
         )
+
+
+@app.get("/sessions/stats")
+async def sessions_stats():
+    return (await get_services()).sessions.stats()
+
+
+@app.get("/state-classifier/stats")
+async def state_classifier_stats():
+    return (await get_services()).state_classifier.stats()
+
+
+@app.get("/retrieval-cache/stats")
+async def retrieval_cache_stats():
+    return (await get_services()).retrieval_cache.get_stats()
+
+
+@app.get("/response-cache/stats")
+async def response_cache_stats():
+    return (await get_services()).response_cache.get_stats()
+
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return (await get_services()).admission.stats()
+
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    if services is not None:
+        return {"status": "ready", "startup": profile.to_dict()}
+    if warmup is not None and warmup.cancelled():
+        content = {"status": "cancelled"}
+    elif warmup is not None and warmup.done() and warmup.exception() is not None:
+        content = {"status": "failed", "error": str(warmup.exception())}
+    else:
+        content = {"status": "starting", "startup": profile.to_dict()}
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=content
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
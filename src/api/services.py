@@ -0,0 +1,165 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional
+
+from src.api.admission import AdmissionController
+from src.api.session_manager import SessionManager
+from src.api.session_store import SESSIONS_DB, build_session_store
+from src.llm.transcripts import TRANSCRIPTS_DB, TranscriptSink
+
+if TYPE_CHECKING:
+    from src.llm.product_index import RefreshingProductIndex
+    from src.llm.response_cache import ResponseCache
+    from src.llm.retrieval_cache import RetrievalCache
+    from src.llm.state_classifier import RuleBasedStateClassifier
+
+
+@dataclass
+class StartupProfile:
+    """
+    Time spent on each startup step, in seconds.
+
+    Attributes:
+        started_at (float): perf_counter when the API module was loaded.
+        steps (Dict[str, float]): Duration of each step, in the order they ran.
+        ready_seconds (Optional[float]): From started_at to ready.
+    """
+
+    started_at: float
+    steps: Dict[str, float] = field(default_factory=dict)
+    ready_seconds: Optional[float] = None
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = round(time.perf_counter() - start, 4)
+
+    def ready(self):
+        self.ready_seconds = round(time.perf_counter() - self.started_at, 4)
+        steps = ", ".join(
+            f"{name}={seconds:.2f}s" for name, seconds in self.steps.items()
+        )
+        logging.info(f"API ready in {self.ready_seconds:.2f}s ({steps})")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"steps": dict(self.steps), "ready_seconds": self.ready_seconds}
+
+
+@dataclass
+class Services:
+    """The components shared by every request, built once by build_services."""
+
+    retriever: Any
+    product_index: "RefreshingProductIndex"
+    state_classifier: "RuleBasedStateClassifier"
+    retrieval_cache: "RetrievalCache"
+    response_cache: "ResponseCache"
+    transcript_sink: TranscriptSink
+    sessions: SessionManager
+    admission: AdmissionController
+
+    async def aclose(self):
+        from src.llm.clients import close_clients
+
+        self.transcript_sink.close()
+        self.sessions.store.close()
+        await close_clients()
+
+
+def build_services(profile: StartupProfile) -> Services:
+    """
+    Opens the vector store and builds the shared components, warming up the LLM
+    clients, chains and state agents so the first request does not pay for them.
+
+    The LangChain, autogen and Chroma modules are imported here rather than when the
+    API module is, so the server starts listening, and answering the liveness probe,
+    before they are loaded.
+
+    Parameters:
+        profile (StartupProfile): Records the duration of each step.
+
+    Returns:
+        Services: The components shared by every request.
+    """
+    with profile.step("imports"):
+        from src.llm.chain_registry import get_chain_registry
+        from src.llm.create_rag_db import update_chroma_db, vector_store_fingerprint
+        from src.llm.dinamic_state import get_state_agent_pool
+        from src.llm.embeddings import embedding_signature
+        from src.llm.llm_model import MarketplaceJourney
+        from src.llm.product_index import RefreshingProductIndex
+        from src.llm.response_cache import ResponseCache
+        from src.llm.retrieval_cache import RetrievalCache
+        from src.llm.state_classifier import RuleBasedStateClassifier
+
+    with profile.step("vector_store"):
+        retriever = update_chroma_db()
+    with profile.step("product_index"):
+        product_index = RefreshingProductIndex(
+            retriever.vectorstore, vector_store_fingerprint
+        )
+    with profile.step("caches"):
+        state_classifier = RuleBasedStateClassifier()
+        transcript_sink = TranscriptSink(os.getenv("TRANSCRIPTS_DB", TRANSCRIPTS_DB))
+        retrieval_cache = RetrievalCache(
+            fingerprint=vector_store_fingerprint,
+            max_size=int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024")),
+            db_path=os.getenv("RETRIEVAL_CACHE_PATH"),
+            namespace=embedding_signature(),
+        )
+        response_cache = ResponseCache(
+            states=[
+                state.strip()
+                for state in os.getenv("RESPONSE_CACHE_STATES", "").split(",")
+                if state.strip()
+            ],
+            max_size=int(os.getenv("RESPONSE_CACHE_SIZE", "1024")),
+            ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+        )
+    with profile.step("chains"):
+        get_chain_registry()
+    with profile.step("state_agents"):
+        with get_state_agent_pool().acquire():
+            pass
+
+    sessions = SessionManager(
+        factory=lambda session_id: MarketplaceJourney(
+            retriever=retriever,
+            session_id=session_id,
+            state_classifier_mode=os.getenv("STATE_CLASSIFIER_MODE", "hybrid"),
+            state_classifier=state_classifier,
+            retrieval_cache=retrieval_cache,
+            product_index=product_index,
+            state_history_tokens=int(os.getenv("STATE_HISTORY_TOKENS", "800")),
+            main_history_tokens=int(os.getenv("MAIN_HISTORY_TOKENS", "1500")),
+            transcript_sink=transcript_sink,
+            response_cache=response_cache,
+            turn_deadline_seconds=float(os.getenv("TURN_DEADLINE_SECONDS", "15"))
+            or None,
+        ),
+        max_sessions=int(os.getenv("MAX_SESSIONS", "1000")),
+        ttl_seconds=float(os.getenv("SESSION_TTL_SECONDS", "1800")),
+        store=build_session_store(
+            os.getenv("SESSION_BACKEND", "memory"),
+            os.getenv("SESSIONS_DB", SESSIONS_DB),
+        ),
+    )
+    return Services(
+        retriever=retriever,
+        product_index=product_index,
+        state_classifier=state_classifier,
+        retrieval_cache=retrieval_cache,
+        response_cache=response_cache,
+        transcript_sink=transcript_sink,
+        sessions=sessions,
+        admission=AdmissionController(
+            max_concurrency=int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32")),
+            max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "64")),
+        ),
+    )
@@ -0,0 +1,234 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from src.api.session_store import InMemorySessionStore, SessionStore, VersionConflict
+
+if TYPE_CHECKING:
+    from src.llm.llm_model import MarketplaceJourney
+
+
+class SessionManager:
+    """
+    Serves one MarketplaceJourney per session id, with the session state kept in a
+    SessionStore between turns.
+
+    After each turn the journey state is saved to the store under a new version, and
+    only then are the messages of the turn recorded in the transcripts. The journeys of
+    this process are kept in access order (LRU) as a cache and reused while their
+    version is the stored one; when another worker served the session since, the
+    journey is rebuilt from the store, so with a store shared by the workers any of them
+    can serve any turn. Saving a turn that started from an outdated version raises
+    VersionConflict instead of overwriting the other turn.
+
+    A cached journey is leased to one turn at a time, from get until save or release.
+    A concurrent turn of the same session gets its own journey, restored from the
+    store, so the two turns never share a history and the second one to save gets the
+    VersionConflict, in this worker as in any other.
+
+    Sessions not saved for longer than the TTL, and the least recently saved ones
+    beyond max_sessions, are removed from the store and have their history flushed to
+    disk, the same way an explicit end of session does.
+
+    Attributes:
+        factory (Callable[[str], MarketplaceJourney]): Builds the journey for a new session id.
+        store (SessionStore): Where the session states are kept.
+        max_sessions (int): Maximum number of stored sessions, and of cached journeys.
+        ttl_seconds (float): Idle time, in seconds, after which a session is evicted.
+        created (int): Number of sessions created since startup.
+        restored (int): Number of journeys rebuilt from the store.
+        evictions (int): Number of sessions evicted by the LRU or TTL policies.
+        conflicts (int): Number of turns not saved because of a version conflict.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], "MarketplaceJourney"],
+        max_sessions: int = 1000,
+        ttl_seconds: float = 1800.0,
+        store: Optional[SessionStore] = None,
+    ):
+        self.factory = factory
+        self.store = store or InMemorySessionStore()
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.created = 0
+        self.restored = 0
+        self.evictions = 0
+        self.conflicts = 0
+        self._journeys: "OrderedDict[str, MarketplaceJourney]" = OrderedDict()
+        # The journey each session's turn in progress is using, until save or release.
+        self._leased: Dict[str, "MarketplaceJourney"] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> "MarketplaceJourney":
+        """
+        Returns the journey for the session, creating it if it does not exist yet.
+
+        The journey is leased to the caller's turn, which must end with save or
+        release.
+
+        Parameters:
+            session_id (str): The client provided session identifier.
+
+        Returns:
+            MarketplaceJourney: The journey bound to the session.
+        """
+        evicted = self._expire()
+        version = self.store.version(session_id) or 0
+        with self._lock:
+            journey = self._journeys.get(session_id)
+            if (
+                journey is not None
+                and journey.version == version
+                and session_id not in self._leased
+            ):
+                self._journeys.move_to_end(session_id)
+                self._leased[session_id] = journey
+            else:
+                # Not cached, another worker saved a turn of the session since, or
+                # another turn of the session is in progress here.
+                journey = None
+        if journey is None:
+            journey = self._build(session_id, version)
+            with self._lock:
+                # With a turn in progress, this one only uses a copy of its own.
+                if session_id not in self._leased:
+                    self._leased[session_id] = journey
+                    self._cache(session_id, journey)
+        self._flush(evicted)
+        return journey
+
+    def save(self, session_id: str, journey: "MarketplaceJourney"):
+        """
+        Stores the journey state after a turn.
+
+        Parameters:
+            session_id (str): The session identifier.
+            journey (MarketplaceJourney): The journey returned by get.
+
+        Raises:
+            VersionConflict: Another turn of the session was saved since this one
+            started, the journey is dropped so the next turn starts from the store.
+        """
+        try:
+            journey.version = self.store.save(
+                session_id, journey.dump_state(), journey.version
+            )
+        except VersionConflict:
+            with self._lock:
+                self.conflicts += 1
+            self.release(session_id, journey)
+            raise
+        with self._lock:
+            if self._leased.get(session_id) is journey:
+                del self._leased[session_id]
+            # A copy saved first becomes the cached journey, the leased one will
+            # conflict when saved.
+            self._cache(session_id, journey)
+        journey.record_transcript()
+
+    def release(self, session_id: str, journey: "MarketplaceJourney"):
+        """
+        Ends a turn that was not saved, e.g. because it failed. Its journey holds
+        changes that are not in the store, so it is dropped and the next turn of the
+        session starts from the store. Does nothing once the turn was saved.
+
+        Parameters:
+            session_id (str): The session identifier.
+            journey (MarketplaceJourney): The journey returned by get.
+        """
+        with self._lock:
+            if self._leased.get(session_id) is not journey:
+                return
+            del self._leased[session_id]
+            if self._journeys.get(session_id) is journey:
+                del self._journeys[session_id]
+
+    def end(self, session_id: str) -> bool:
+        """
+        Ends the session, saving its history and releasing it from memory.
+
+        Parameters:
+            session_id (str): The session identifier to end.
+
+        Returns:
+            bool: False when the session was not found.
+        """
+        with self._lock:
+            journey = self._journeys.pop(session_id, None)
+        record = self.store.pop(session_id)
+        if record is not None and (journey is None or journey.version != record[1]):
+            journey = self._restore(session_id, *record)
+        if journey is None:
+            return False
+        journey.end_session()
+        return True
+
+    def evict_expired(self) -> int:
+        """Evicts every session idle for longer than the TTL and returns how many were evicted."""
+        evicted = self._expire()
+        self._flush(evicted)
+        return len(evicted)
+
+    def stats(self) -> Dict[str, float]:
+        live_sessions = self.store.count()
+        with self._lock:
+            return {
+                "backend": self.store.name,
+                "live_sessions": live_sessions,
+                "cached_journeys": len(self._journeys),
+                "created": self.created,
+                "restored": self.restored,
+                "evictions": self.evictions,
+                "conflicts": self.conflicts,
+                "max_sessions": self.max_sessions,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+    def _cache(self, session_id: str, journey: "MarketplaceJourney"):
+        """Caches the journey as the most recent one, called with the lock held."""
+        self._journeys[session_id] = journey
+        self._journeys.move_to_end(session_id)
+        while len(self._journeys) > self.max_sessions:
+            self._journeys.popitem(last=False)
+
+    def _build(self, session_id: str, version: int) -> "MarketplaceJourney":
+        record = self.store.load(session_id) if version else None
+        if record is None:
+            with self._lock:
+                self.created += 1
+            return self.factory(session_id)
+        return self._restore(session_id, *record)
+
+    def _restore(
+        self, session_id: str, state: Dict, version: int
+    ) -> "MarketplaceJourney":
+        journey = self.factory(session_id)
+        journey.load_state(state, version)
+        with self._lock:
+            self.restored += 1
+        return journey
+
+    def _expire(self) -> List["MarketplaceJourney"]:
+        expired: List[Tuple[str, Dict]] = self.store.expire(
+            self.ttl_seconds, self.max_sessions
+        )
+        journeys = []
+        for session_id, state in expired:
+            with self._lock:
+                self._journeys.pop(session_id, None)
+            journey = self.factory(session_id)
+            journey.load_state(state)
+            journeys.append(journey)
+        with self._lock:
+            self.evictions += len(journeys)
+        return journeys
+
+    def _flush(self, journeys: List["MarketplaceJourney"]):
+        for journey in journeys:
+            try:
+                journey.end_session()
+            except Exception as e:
+                logging.error(f"Failed to flush session {journey.session_id}: {str(e)}")
@@ -0,0 +1,249 @@
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+SESSIONS_DB = "data/07_model_output/sessions.sqlite3"
+# Session ids come from the clients and end up in keys and file names.
+SESSION_ID_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
+# The stored state of a session and its version.
+SessionRecord = Tuple[Dict, int]
+
+
+class VersionConflict(Exception):
+    """The session was saved by another turn since the version being replaced."""
+
+
+class SessionStore(abc.ABC):
+    """
+    Where the state of the sessions is kept between turns.
+
+    Each save replaces the state only if the stored version is still the one the turn
+    started from and returns the next version (optimistic concurrency), so two turns of
+    the same session served by different workers cannot silently overwrite each other.
+    A session that was never saved has version 0.
+    """
+
+    name = "base"
+
+    @abc.abstractmethod
+    def version(self, session_id: str) -> Optional[int]:
+        """The stored version of the session, None when it is not stored."""
+
+    @abc.abstractmethod
+    def load(self, session_id: str) -> Optional[SessionRecord]:
+        """The stored state of the session and its version, None when it is not stored."""
+
+    @abc.abstractmethod
+    def save(self, session_id: str, state: Dict, version: int) -> int:
+        """
+        Stores the state of the session if its stored version is `version`.
+
+        Parameters:
+            session_id (str): The session identifier.
+            state (Dict): The JSON serializable journey state.
+            version (int): The version the state was loaded from, 0 for a new session.
+
+        Returns:
+            int: The new version.
+
+        Raises:
+            VersionConflict: The session was saved, or removed, since that version.
+        """
+
+    @abc.abstractmethod
+    def pop(self, session_id: str) -> Optional[SessionRecord]:
+        """Removes the session and returns what was stored, None when it was not."""
+
+    @abc.abstractmethod
+    def expire(self, ttl_seconds: float, max_sessions: int) -> List[Tuple[str, Dict]]:
+        """
+        Removes the sessions not saved for longer than the TTL and the least recently
+        saved ones beyond max_sessions.
+
+        Returns:
+            List[Tuple[str, Dict]]: The session id and state of each removed session.
+        """
+
+    @abc.abstractmethod
+    def count(self) -> int:
+        """The number of stored sessions."""
+
+    def close(self):
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """Keeps the sessions in this process, for a single worker."""
+
+    name = "memory"
+
+    def __init__(self):
+        # session_id -> (state, version, saved_at), least recently saved first.
+        self._sessions: "OrderedDict[str, Tuple[Dict, int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self, session_id: str) -> Optional[int]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        return entry[1] if entry else None
+
+    def load(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        return (entry[0], entry[1]) if entry else None
+
+    def save(self, session_id: str, state: Dict, version: int) -> int:
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            stored = entry[1] if entry else 0
+            if stored != version:
+                if entry:
+                    self._sessions[session_id] = entry
+                raise VersionConflict(
+                    f"Session {session_id} is at version {stored}, not {version}"
+                )
+            self._sessions[session_id] = (state, version + 1, time.time())
+        return version + 1
+
+    def pop(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+        return (entry[0], entry[1]) if entry else None
+
+    def expire(self, ttl_seconds: float, max_sessions: int) -> List[Tuple[str, Dict]]:
+        deadline = time.time() - ttl_seconds
+        expired = []
+        with self._lock:
+            while self._sessions:
+                session_id, (state, _, saved_at) = next(iter(self._sessions.items()))
+                if saved_at > deadline and len(self._sessions) <= max_sessions:
+                    break
+                del self._sessions[session_id]
+                expired.append((session_id, state))
+        return expired
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a SQLite database shared by the workers of the host.
+
+    Attributes:
+        db_path (str): The SQLite database file.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str = SESSIONS_DB):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # One connection per process, the lock serializes its use by the threads.
+        self._connection = sqlite3.connect(
+            db_path, timeout=10, check_same_thread=False, isolation_level=None
+        )
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, version INTEGER, state TEXT, "
+                "saved_at REAL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_saved_at ON sessions (saved_at)"
+            )
+
+    def version(self, session_id: str) -> Optional[int]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def load(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state, version FROM sessions WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def save(self, session_id: str, state: Dict, version: int) -> int:
+        payload = json.dumps(state, ensure_ascii=False)
+        with self._lock:
+            if version == 0:
+                try:
+                    self._connection.execute(
+                        "INSERT INTO sessions VALUES (?, 1, ?, ?)",
+                        (session_id, payload, time.time()),
+                    )
+                except sqlite3.IntegrityError:
+                    raise VersionConflict(f"Session {session_id} was already saved")
+                return 1
+            updated = self._connection.execute(
+                "UPDATE sessions SET version = version + 1, state = ?, saved_at = ? "
+                "WHERE session_id = ? AND version = ?",
+                (payload, time.time(), session_id, version),
+            ).rowcount
+        if not updated:
+            raise VersionConflict(f"Session {session_id} is no longer at {version}")
+        return version + 1
+
+    def pop(self, session_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            # fetchall steps the statement to the end, which commits the delete.
+            rows = self._connection.execute(
+                "DELETE FROM sessions WHERE session_id = ? RETURNING state, version",
+                (session_id,),
+            ).fetchall()
+        return (json.loads(rows[0][0]), rows[0][1]) if rows else None
+
+    def expire(self, ttl_seconds: float, max_sessions: int) -> List[Tuple[str, Dict]]:
+        deadline = time.time() - ttl_seconds
+        with self._lock:
+            # Most turns find nothing to expire, checked without taking the write lock.
+            stale = self._connection.execute(
+                "SELECT EXISTS (SELECT 1 FROM sessions WHERE saved_at <= ?) "
+                "OR (SELECT COUNT(*) FROM sessions) > ?",
+                (deadline, max_sessions),
+            ).fetchone()[0]
+            if not stale:
+                return []
+            rows = self._connection.execute(
+                "DELETE FROM sessions WHERE saved_at <= ? OR session_id IN ("
+                "SELECT session_id FROM sessions ORDER BY saved_at DESC "
+                "LIMIT -1 OFFSET ?) RETURNING session_id, state",
+                (deadline, max_sessions),
+            ).fetchall()
+        return [(session_id, json.loads(state)) for session_id, state in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM sessions"
+            ).fetchone()
+        return count
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def build_session_store(backend: str = "memory", db_path: str = SESSIONS_DB):
+    """The session store of the SESSION_BACKEND: "memory" or "sqlite"."""
+    if backend == "memory":
+        return InMemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore(db_path)
+    raise ValueError(
+        f"Unknown session backend '{backend}', expected 'memory' or 'sqlite'"
+    )
@@ -0,0 +1,94 @@
+"""
+Sends scripted conversations to the API's /query/batch endpoint and saves the results.
+
+The input is a JSONL file with one {"id": ..., "turns": [...]} conversation per line
+(a JSON list of them is accepted too). Large files are sent in chunks, one request
+per chunk, and the NDJSON results are appended to the output file as they arrive:
+
+    python -m src.batch_eval conversations.jsonl --output results.jsonl --concurrency 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from typing import Dict, Iterator, List
+
+import httpx
+
+API_URL = os.getenv("API_URL", "http://localhost:8000")
+
+
+def read_conversations(filepath: str) -> List[Dict]:
+    with open(filepath, "r", encoding="utf-8") as file:
+        content = file.read().strip()
+    if content.startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def _chunks(items: List[Dict], size: int) -> Iterator[List[Dict]]:
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+async def run(
+    conversations: List[Dict],
+    output: str,
+    concurrency: int,
+    chunk_size: int,
+    api_url: str = API_URL,
+):
+    totals = {"conversations": 0, "errors": 0, "turns": 0, "elapsed_seconds": 0.0}
+    # No timeout between frames: a frame only comes once a whole conversation ends.
+    async with httpx.AsyncClient(base_url=api_url, timeout=None) as client:
+        with open(output, "w", encoding="utf-8") as file:
+            for chunk in _chunks(conversations, chunk_size):
+                async with client.stream(
+                    "POST",
+                    "/query/batch",
+                    json={"conversations": chunk, "concurrency": concurrency},
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        frame = json.loads(line)
+                        if frame.get("done"):
+                            for key in totals:
+                                totals[key] += frame[key]
+                            continue
+                        file.write(line + "\n")
+                        if "error" in frame:
+                            print(f"{frame['conversation_id']}: {frame['error']}")
+    elapsed = totals["elapsed_seconds"]
+    print(
+        f"{totals['conversations']} conversations, {totals['turns']} turns, "
+        f"{totals['errors']} errors in {elapsed:.1f}s "
+        f"({totals['turns'] / elapsed if elapsed else 0:.2f} turns/s)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run scripted conversations.")
+    parser.add_argument("conversations", help="JSONL file of conversations.")
+    parser.add_argument("--output", default="batch_results.jsonl")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=500,
+        help="Conversations sent per request.",
+    )
+    parser.add_argument("--api-url", default=API_URL)
+    args = parser.parse_args()
+    asyncio.run(
+        run(
+            read_conversations(args.conversations),
+            args.output,
+            args.concurrency,
+            args.chunk_size,
+            args.api_url,
+        )
+    )
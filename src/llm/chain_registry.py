@@ -0,0 +1,54 @@
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Mapping
+
+from langchain.chains.llm import LLMChain
+from langchain.prompts import PromptTemplate
+from langchain_core.language_models import BaseChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable
+
+from src.llm.clients import get_chat_model
+from src.llm.dinamic_state import STATE_PROMPTS
+
+
+class ChainRegistry:
+    """
+    The chains of every conversation state, built once and shared by all sessions.
+
+    Nothing session specific is stored in the chains: the compacted history of the turn
+    is one of the inputs of each call, the "chat_history" of the state prompts, and the
+    session callbacks are passed in its config, so concurrent turns of different
+    sessions never share mutable state.
+
+    Attributes:
+        llm (BaseChatModel): The chat model behind every chain.
+        chains (Mapping[str, Runnable]): Per state, the LLMChain returning a dict with
+            the "text" of the answer.
+        streaming_chains (Mapping[str, Runnable]): Per state, the prompt piped into the
+            LLM, streaming the answer tokens.
+    """
+
+    def __init__(
+        self,
+        llm: BaseChatModel,
+        prompts: Mapping[str, PromptTemplate] = STATE_PROMPTS,
+    ):
+        self.llm = llm
+        self.chains: Mapping[str, Runnable] = MappingProxyType(
+            {
+                state: LLMChain(prompt=prompt, llm=llm, output_parser=StrOutputParser())
+                for state, prompt in prompts.items()
+            }
+        )
+        self.streaming_chains: Mapping[str, Runnable] = MappingProxyType(
+            {
+                state: prompt | llm | StrOutputParser()
+                for state, prompt in prompts.items()
+            }
+        )
+
+
+@lru_cache(maxsize=None)
+def get_chain_registry(model_name: str = "gpt-3.5-turbo") -> ChainRegistry:
+    return ChainRegistry(get_chat_model(model_name))
@@ -0,0 +1,68 @@
+import os
+from functools import lru_cache
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+
+def pool_limits() -> httpx.Limits:
+    """Connection pool limits, configured by HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS and HTTP_KEEPALIVE_EXPIRY."""
+    return httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(
+            os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")
+        ),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),
+    )
+
+
+class SharedHTTPClient(httpx.Client):
+    """
+    A pooled client that survives deep copies.
+
+    autogen deep copies the llm_config of every agent, which would otherwise give each
+    agent its own connection pool.
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+@lru_cache(maxsize=None)
+def get_http_client() -> SharedHTTPClient:
+    """The keep-alive client shared by every synchronous OpenAI call of the process."""
+    return SharedHTTPClient(limits=pool_limits())
+
+
+@lru_cache(maxsize=None)
+def get_async_http_client() -> httpx.AsyncClient:
+    """The keep-alive client shared by every asynchronous OpenAI call of the process."""
+    return httpx.AsyncClient(limits=pool_limits())
+
+
+@lru_cache(maxsize=None)
+def get_chat_model(model_name: str = "gpt-3.5-turbo") -> ChatOpenAI:
+    """
+    The chat model shared by every session.
+
+    The model holds no conversation state, so a single instance per model name is
+    enough; per session callbacks are passed in the config of each call.
+    """
+    return ChatOpenAI(
+        model_name=model_name,
+        temperature=0,
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client(),
+    )
+
+
+async def close_clients():
+    """Closes the pooled clients when the process shuts down."""
+    if get_async_http_client.cache_info().currsize:
+        await get_async_http_client().aclose()
+    if get_http_client.cache_info().currsize:
+        get_http_client().close()
+    get_chat_model.cache_clear()
+    get_async_http_client.cache_clear()
+    get_http_client.cache_clear()
@@ -1,15 +1,56 @@
+import os
+from typing import Union
+
 from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
 
+from src.llm.embeddings import check_index_backend, get_embeddings
+from src.llm.retrieval_cache import collection_fingerprint
+from src.llm.vector_store import NumpyVectorStore
 
-def update_chroma_db() -> Chroma:
-    chroma_db_dir = "data/03_primary/chroma_db"
-    docsearch = Chroma(
-        persist_directory=chroma_db_dir,
-        embedding_function=OpenAIEmbeddings(model="text-embedding-ada-002"),
+CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "data/03_primary/chroma_db")
+NUMPY_STORE_DIR = os.getenv("NUMPY_STORE_DIR", "data/03_primary/numpy_store")
+
+
+def vector_store_backend() -> str:
+    """The configured vector store, "chroma" (default) or "numpy"."""
+    backend = os.getenv("VECTOR_STORE", "chroma")
+    if backend not in ("chroma", "numpy"):
+        raise ValueError(
+            f"Unknown vector store '{backend}', expected 'chroma' or 'numpy'"
+        )
+    return backend
+
+
+def vector_store_dir() -> str:
+    """Where the configured vector store is persisted."""
+    return NUMPY_STORE_DIR if vector_store_backend() == "numpy" else CHROMA_DB_DIR
+
+
+def vector_store_fingerprint() -> str:
+    """Changes whenever the products of the configured vector store change."""
+    if vector_store_backend() == "numpy":
+        return NumpyVectorStore.fingerprint_of(NUMPY_STORE_DIR)
+    return collection_fingerprint(CHROMA_DB_DIR)
+
+
+def open_vector_store() -> Union[Chroma, NumpyVectorStore]:
+    """Opens the vector store selected by VECTOR_STORE."""
+    if vector_store_backend() == "numpy":
+        return NumpyVectorStore(
+            NUMPY_STORE_DIR,
+            get_embeddings(),
+            ivf_lists=int(os.getenv("NUMPY_STORE_IVF_LISTS", "0")),
+            ivf_probe=int(os.getenv("NUMPY_STORE_IVF_PROBE", "8")),
+        )
+    return Chroma(
+        persist_directory=CHROMA_DB_DIR,
+        embedding_function=get_embeddings(),
     )
 
-    docsearch.persist()
+
+def update_chroma_db() -> Chroma:
+    check_index_backend(vector_store_dir())
+    docsearch = open_vector_store()
     retriever = docsearch.as_retriever()
 
     return retriever
@@ -0,0 +1,204 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import numpy as np
+
+from src.llm.instrumentation import DEADLINE_MISSES, HEDGED_CALLS
+
+T = TypeVar("T")
+
+# Share of the turn deadline each stage may use before falling back. Retrieval and
+# state run at the same time, generation gets whatever is left.
+STAGE_SHARES = {"retrieval": 0.25, "state": 0.35}
+
+
+class DeadlineExceeded(Exception):
+    """A stage did not finish within its share of the turn deadline."""
+
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"{stage} did not finish within {timeout:.2f}s")
+        self.stage = stage
+        self.timeout = timeout
+
+
+class LatencyTracker:
+    """
+    Recent durations of a call, to send a hedged duplicate once a call is slower than
+    most (the quantile, p95 by default).
+
+    Attributes:
+        quantile (float): The quantile after which a call is hedged.
+        min_samples (int): Durations needed before hedging starts.
+    """
+
+    def __init__(
+        self, window: int = 200, quantile: float = 0.95, min_samples: int = 20
+    ):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._durations: "deque[float]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._durations.append(seconds)
+
+    def threshold(self) -> Optional[float]:
+        """The hedging delay, None while there are too few durations."""
+        with self._lock:
+            if len(self._durations) < self.min_samples:
+                return None
+            durations = list(self._durations)
+        return float(np.quantile(durations, self.quantile))
+
+
+# Process-wide, so every session learns from the latencies of the others.
+LATENCY = {"state": LatencyTracker(), "generation": LatencyTracker()}
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("HEDGE_WORKERS", "64")), thread_name_prefix="hedged"
+)
+
+
+class TurnBudget:
+    """
+    The deadline of a turn, split across its retrieval, state and generation stages.
+
+    Attributes:
+        total_seconds (float): The whole turn budget.
+        started_at (float): monotonic time the turn started.
+    """
+
+    def __init__(self, total_seconds: float):
+        self.total_seconds = total_seconds
+        self.started_at = time.monotonic()
+
+    def remaining(self) -> float:
+        return max(0.0, self.total_seconds - (time.monotonic() - self.started_at))
+
+    def for_stage(self, stage: str) -> float:
+        """Time the stage may take: its share of the budget, or all that is left."""
+        share = STAGE_SHARES.get(stage)
+        if share is None:
+            return self.remaining()
+        return min(self.remaining(), self.total_seconds * share)
+
+    def deadline(self, stage: str) -> float:
+        """monotonic time by which the stage, starting now, must finish."""
+        return time.monotonic() + self.for_stage(stage)
+
+
+def call_with_deadline(
+    stage: str, call: Callable[[], T], timeout: Optional[float]
+) -> T:
+    """
+    Runs a blocking call within a timeout, without hedging.
+
+    Raises:
+        DeadlineExceeded: The call did not finish within the timeout, it is left to
+        finish in the background.
+    """
+    if timeout is None:
+        return call()
+    future = _executor.submit(contextvars.copy_context().run, call)
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        DEADLINE_MISSES.inc(stage=stage)
+        raise DeadlineExceeded(stage, timeout)
+
+
+def hedged_call(stage: str, call: Callable[[], T], timeout: Optional[float]) -> T:
+    """
+    Runs a blocking call, sending a duplicate when it is slower than the recent p95,
+    and returns the first result.
+
+    Parameters:
+        stage (str): The stage of the call, selecting its LatencyTracker.
+        call (Callable[[], T]): The call, safe to run twice at the same time.
+        timeout (Optional[float]): Time to wait for a result, without limit when None.
+
+    Returns:
+        T: The result of whichever call finished first.
+
+    Raises:
+        DeadlineExceeded: No call finished within the timeout. The calls are left to
+        finish in the background.
+    """
+    tracker = LATENCY[stage]
+    start = time.monotonic()
+    hedge_after = tracker.threshold()
+    if timeout is None and hedge_after is None:
+        result = call()
+        _record(stage, start, hedged=False)
+        return result
+    context = contextvars.copy_context()
+    pending = {_executor.submit(context.copy().run, call)}
+    if hedge_after is not None and (timeout is None or hedge_after < timeout):
+        done, _ = wait(pending, timeout=hedge_after)
+        if not done:
+            pending.add(_executor.submit(context.copy().run, call))
+    hedged = len(pending) > 1
+    while pending:
+        remaining = None if timeout is None else timeout - (time.monotonic() - start)
+        if remaining is not None and remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            # A failed call only counts once the other one failed too.
+            if future.exception() is None or not pending:
+                _record(stage, start, hedged)
+                return future.result()
+    _missed(stage, start)
+    raise DeadlineExceeded(stage, timeout)
+
+
+async def hedged_acall(
+    stage: str, call: Callable[[], Awaitable[T]], timeout: Optional[float]
+) -> T:
+    """Async counterpart of hedged_call, cancelling the slower call."""
+    tracker = LATENCY[stage]
+    start = time.monotonic()
+    pending = {asyncio.ensure_future(call())}
+    hedge_after = tracker.threshold()
+    try:
+        if hedge_after is not None and (timeout is None or hedge_after < timeout):
+            done, _ = await asyncio.wait(pending, timeout=hedge_after)
+            if not done:
+                pending.add(asyncio.ensure_future(call()))
+        hedged = len(pending) > 1
+        while pending:
+            remaining = (
+                None if timeout is None else timeout - (time.monotonic() - start)
+            )
+            if remaining is not None and remaining <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None or not pending:
+                    _record(stage, start, hedged)
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+    _missed(stage, start)
+    raise DeadlineExceeded(stage, timeout)
+
+
+def _record(stage: str, start: float, hedged: bool):
+    LATENCY[stage].observe(time.monotonic() - start)
+    HEDGED_CALLS.inc(stage=stage, hedged=str(hedged).lower())
+
+
+def _missed(stage: str, start: float):
+    # The time waited is a lower bound of the duration, kept so misses raise the p95.
+    LATENCY[stage].observe(time.monotonic() - start)
+    DEADLINE_MISSES.inc(stage=stage)
@@ -1,13 +1,39 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Callable, Iterator, List, Mapping, Optional, Tuple
+
 from autogen.agentchat.contrib.retrieve_assistant_agent import RetrieveAssistantAgent
 from autogen.agentchat.contrib.retrieve_user_proxy_agent import UserProxyAgent
+from langchain.docstore.document import Document as LangchainDocument
 from langchain.memory import ChatMessageHistory
 from langchain.prompts import PromptTemplate
 from langchain_community.vectorstores import Chroma
 
+from src.llm.clients import get_http_client
+from src.llm.deadlines import DeadlineExceeded, hedged_call
+from src.llm.history import ConversationMemory, count_tokens
+from src.llm.instrumentation import LLM_CALLS, record_tokens, record_transition, stage
+from src.llm.product_index import ProductIndex
+from src.llm.retrieval_cache import RetrievalCache
+from src.llm.state_classifier import STATES, RuleBasedStateClassifier
+
+STATE_MODEL = "gpt-3.5-turbo"
+
 
 class ProductRetrievalManager:
-    def __init__(self, retriever: Chroma):
+    def __init__(
+        self,
+        retriever: Chroma,
+        cache: Optional[RetrievalCache] = None,
+        product_index: Optional[ProductIndex] = None,
+    ):
         self.retriever = retriever
+        self.cache = cache
+        self.product_index = product_index
 
     def get_product_details(self, query: str) -> str:
         """
@@ -23,109 +49,189 @@ class ProductRetrievalManager:
         str
             String with product details.
         """
-        retrieved_docs = self.retriever.get_relevant_documents(query)
-        return retrieved_docs
+        with stage("retrieval"):
+            if self.cache is None and self.product_index is None:
+                return self.retriever.get_relevant_documents(query)
 
+            if self.cache is not None:
+                retrieved_docs = self.cache.get_results(query)
+                if retrieved_docs is not None:
+                    return retrieved_docs
+            top_k = self.retriever.search_kwargs.get("k", 4)
+            if self.product_index is not None:
+                retrieved_docs = self.product_index.search(
+                    query, k=top_k, vector_search=self._vector_search
+                )
+            else:
+                retrieved_docs = self._vector_search(query, top_k)
+            if self.cache is not None:
+                self.cache.set_results(query, retrieved_docs)
+            return retrieved_docs
 
-class ConversationCoordinator:
-    """
-    A chatbot class designed for managing interactions within a marketplace environment.
-    This chatbot assists users by providing information on products based on their queries
-    and guiding them through various stages of the buying process.
+    def get_product_details_offline(self, query: str) -> List[LangchainDocument]:
+        """
+        Lexical only search of the product index, without the embedding call, for a
+        turn that ran out of time to retrieve. Empty without a product index.
+        """
+        if self.product_index is None:
+            return []
+        return self.product_index.search(
+            query, k=self.retriever.search_kwargs.get("k", 4)
+        )
 
-    Attributes:
-        state (str): Represents the current state of the chatbot in the conversation flow.
-        document_manager (ProductRetrievalManager): Manages retrieval and formatting of product
-                                           details from a document database.
-        prompts (dict): A dictionary mapping conversation states to their respective
-                        prompt templates, which are used to generate responses based on
-                        user inputs and document data.
+    def _vector_search(self, query: str, k: int) -> List[LangchainDocument]:
+        vectorstore = self.retriever.vectorstore
+        embedding = None
+        if self.cache is not None:
+            embedding = self.cache.get_embedding(query)
+        if embedding is None:
+            embedding = vectorstore.embeddings.embed_query(query)
+            if self.cache is not None:
+                self.cache.set_embedding(query, embedding)
+        return vectorstore.similarity_search_by_vector(embedding, k=k)
 
-    Methods:
-        __init__: Initializes the chatbot with a document retriever.
-    """
 
-    def __init__(self, retriever: Chroma):
-        self.state = "Welcome"
-        self.document_manager = ProductRetrievalManager(retriever)
-        self.prompts = {
-            "Welcome": PromptTemplate(
-                template="""
+# The prompt of each conversation state, built once and shared by every session. The
+# chat_history is the conversation compacted by ConversationMemory.
+STATE_PROMPTS: Mapping[str, PromptTemplate] = MappingProxyType(
+    {
+        "Welcome": PromptTemplate(
+            template="""
                     Você é um assistente de marketplace. Seu objetivo é ajudar os usuários a encontrar os produtos que eles estão interessados.
                     Se apresente como tal e responda qualquer dúvida do usuário.
+                    Histórico da conversa: \n\n {chat_history} \n\n
                     Aqui está a questão do usuário: {question}
                 """,
-                input_variables=["question"],
-            ),
-            "ProductSearch": PromptTemplate(
-                template="""
+            input_variables=["question", "chat_history"],
+        ),
+        "ProductSearch": PromptTemplate(
+            template="""
                     Você é um assistente de marketplace, seu objetivo é ajudar usuários a encontrar os produtos.
                     Quando o usuário perguntar sobre produtos querendo detalhes, você pode usar a seguinte
                     informação abaixo e deverá responder apenas se o produto conter aqui: \n\n {document} \n\n.
+                    Histórico da conversa: \n\n {chat_history} \n\n
                     Aqui está a questão do usuário: {question}
                 """,
-                input_variables=["question", "document"],
-            ),
-            "ProductQA": PromptTemplate(
-                template="""
+            input_variables=["question", "document", "chat_history"],
+        ),
+        "ProductQA": PromptTemplate(
+            template="""
                     Se o usuário tiver dúvidas sobre o produto você irá dar detalhes do mesmo, utilizando a informação disponível: \n\n {document} \n\n.
                     Importante notar que deve utilizar apenas as informações disponibilizadas, senão tiver diga que não possui maiores detalhes sobre
                     o produto.
+                    Histórico da conversa: \n\n {chat_history} \n\n
                     Aqui está a questão do usuário: {question}
                 """,
-                input_variables=["question", "document"],
-            ),
-            "CollectInfo": PromptTemplate(
-                template="""
+            input_variables=["question", "document", "chat_history"],
+        ),
+        "CollectInfo": PromptTemplate(
+            template="""
                     Com as dúvidas satisfeitas, agora você vai pedir os dados do usuário.
                     Primeiro peça o Nome completo, e-mail e telefone.
                     É obrigatório que o usuário passe essas três informações para continuar a próxima etapa.
+                    Histórico da conversa: \n\n {chat_history} \n\n
                     Aqui está a questão do usuário: {question}
                 """,
-                input_variables=["question"],
-            ),
-            "ConfirmPurchase": PromptTemplate(
-                template="""
+            input_variables=["question", "chat_history"],
+        ),
+        "ConfirmPurchase": PromptTemplate(
+            template="""
                     Agora, você vai finalizar a compra. Por favor, confirme o pedido e gere o link de finalização: <http://www.test-markeplace.com.br>.
+                    Histórico da conversa: \n\n {chat_history} \n\n
                     Aqui está a questão do usuário: {question}
                 """,
-                input_variables=["question"],
-            ),
-            "ThankYou": PromptTemplate(
-                template="""
+            input_variables=["question", "chat_history"],
+        ),
+        "ThankYou": PromptTemplate(
+            template="""
                     Finalize o atendimento e agradeça o usuário, pedindo um feedback positivo ou negativo.
+                    Histórico da conversa: \n\n {chat_history} \n\n
                     Aqui está a questão do usuário: {question}
                 """,
-                input_variables=["question"],
-            ),
-        }
+            input_variables=["question", "chat_history"],
+        ),
+    }
+)
 
 
-class StateController:
+class ConversationCoordinator:
     """
-    Manages conversation state transitions within a marketplace environment, utilizing
-    a state machine approach with an LLM to determine and update states based on user interaction.
+    A chatbot class designed for managing interactions within a marketplace environment.
+    This chatbot assists users by providing information on products based on their queries
+    and guiding them through various stages of the buying process.
 
     Attributes:
-        chatbot (ConversationCoordinator): The chatbot instance managing the conversation.
-        llm (RetrieveAssistantAgent): LLM agent used to determine conversation state.
-        visited_states (List[str]): A list of states the conversation has already visited.
-        user_proxy (UserProxyAgent): Proxy agent that manages communication with the LLM.
+        state (str): Represents the current state of the chatbot in the conversation flow.
+        document_manager (ProductRetrievalManager): Manages retrieval and formatting of product
+                                           details from a document database.
+        prompts (Mapping[str, PromptTemplate]): The shared, read-only STATE_PROMPTS mapping
+                        each conversation state to the prompt template used to generate
+                        responses based on user inputs and document data.
+
+    Methods:
+        __init__: Initializes the chatbot with a document manager.
     """
 
-    def __init__(self, chatbot: ConversationCoordinator):
-        self.chatbot = chatbot
-        self.llm = RetrieveAssistantAgent(
+    def __init__(self, document_manager: ProductRetrievalManager):
+        self.state = "Welcome"
+        self.document_manager = document_manager
+        self.prompts = STATE_PROMPTS
+
+
+class StateAgentPool:
+    """
+    Process-wide pool of the autogen agent pairs that ask the LLM for the state.
+
+    The agents keep the messages of the chat they are in, so a pair serves one turn at
+    a time: it is borrowed for the turn and returned afterwards, and building agents
+    is left to the first turns that find the pool empty instead of to every session.
+
+    Attributes:
+        max_idle (int): Maximum number of idle agent pairs kept for reuse.
+        created (int): Number of agent pairs built since startup.
+    """
+
+    def __init__(self, max_idle: int = 16):
+        self.max_idle = max_idle
+        self.created = 0
+        self._idle: List[Tuple[RetrieveAssistantAgent, UserProxyAgent]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self) -> Iterator[Tuple[RetrieveAssistantAgent, UserProxyAgent]]:
+        """Borrows an (assistant, user proxy) pair, building one when none is idle."""
+        with self._lock:
+            agents = self._idle.pop() if self._idle else None
+        if agents is None:
+            agents = self._build()
+        try:
+            yield agents
+        finally:
+            for agent in agents:
+                agent.reset()
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(agents)
+
+    def _build(self) -> Tuple[RetrieveAssistantAgent, UserProxyAgent]:
+        assistant = RetrieveAssistantAgent(
             name="MarketplaceStateAgent",
             system_message="Determine the current state of the conversation based on the history provided.",
             llm_config={
-                "timeout": 600,
+                # Turns have a deadline of their own, a call still running long
+                # after it only holds the agents and a connection.
+                "timeout": float(os.getenv("STATE_LLM_TIMEOUT", "10")),
                 "cache_seed": 42,
-                "config_list": [{"model": "gpt-3.5-turbo", "temperature": 0}],
+                "config_list": [
+                    {
+                        "model": STATE_MODEL,
+                        "temperature": 0,
+                        "http_client": get_http_client(),
+                    }
+                ],
             },
         )
-        self.visited_states = []
-        self.user_proxy = UserProxyAgent(
+        user_proxy = UserProxyAgent(
             name="state_agent",
             human_input_mode="NEVER",
             max_consecutive_auto_reply=0,
@@ -137,23 +243,134 @@ class StateController:
                 "use_docker": False,
             },
         )
+        with self._lock:
+            self.created += 1
+        return assistant, user_proxy
+
+
+@lru_cache(maxsize=None)
+def get_state_agent_pool() -> StateAgentPool:
+    return StateAgentPool()
+
+
+class StateController:
+    """
+    Manages conversation state transitions within a marketplace environment, utilizing
+    a state machine approach with an LLM to determine and update states based on user interaction.
 
-    def determine_state(self, history: ChatMessageHistory) -> str:
+    Attributes:
+        chatbot (ConversationCoordinator): The chatbot instance managing the conversation.
+        agent_pool (StateAgentPool): Process-wide pool of the autogen agents used to ask
+            the LLM for the state.
+        visited_states (List[str]): A list of states the conversation has already visited.
+        classifier (RuleBasedStateClassifier): Local classifier for the obvious transitions.
+        classifier_mode (str): "llm" always asks the LLM, "hybrid" asks it only when the
+            local classifier is not confident and "local" never asks it, keeping the
+            current state when unsure.
+        confidence_threshold (float): Minimum confidence to accept a local prediction.
+        memory (Optional[ConversationMemory]): Compacts the history sent to the LLM,
+            the full history is interpolated when None.
+        history_tokens (int): Token budget of the history in the state prompt.
+        state_llm (Callable[[str], str]): Answers the state prompt, ask_agents unless
+            another is given, e.g. the recorded answers of a transcript replay.
+    """
+
+    CLASSIFIER_MODES = ("llm", "hybrid", "local")
+
+    def __init__(
+        self,
+        chatbot: ConversationCoordinator,
+        classifier_mode: str = "llm",
+        classifier: Optional[RuleBasedStateClassifier] = None,
+        confidence_threshold: float = 0.8,
+        memory: Optional[ConversationMemory] = None,
+        history_tokens: int = 800,
+        agent_pool: Optional["StateAgentPool"] = None,
+        state_llm: Optional[Callable[[str], str]] = None,
+    ):
+        if classifier_mode not in self.CLASSIFIER_MODES:
+            raise ValueError(
+                f"Unknown classifier mode '{classifier_mode}', "
+                f"expected one of {self.CLASSIFIER_MODES}"
+            )
+        self.chatbot = chatbot
+        self.classifier_mode = classifier_mode
+        self.classifier = classifier or RuleBasedStateClassifier()
+        self.confidence_threshold = confidence_threshold
+        self.memory = memory
+        self.history_tokens = history_tokens
+        self.agent_pool = agent_pool or get_state_agent_pool()
+        self.state_llm = state_llm or self.ask_agents
+        self.visited_states = []
+
+    def determine_state(
+        self, history: ChatMessageHistory, timeout: Optional[float] = None
+    ) -> str:
         """
         Determines the current conversation state based on the provided history.
 
+        The LLM call is hedged with a duplicate once it is slower than the recent p95.
+        When no answer arrives within the timeout, the local classifier's best guess,
+        or else the current state, is used instead.
+
         Parameters:
             history (ChatMessageHistory): The historical record of the conversation.
+            timeout (Optional[float]): Time the LLM may take, in seconds.
 
         Returns:
             str: The predicted current state of the conversation.
         """
+        if self.classifier_mode != "llm":
+            prediction = self.classifier.predict(
+                history.messages, self.chatbot.state, self.visited_states
+            )
+            if prediction and prediction.confidence >= self.confidence_threshold:
+                self.classifier.record(local_hit=True)
+                return prediction.state
+            self.classifier.record(local_hit=False)
+            if self.classifier_mode == "local":
+                return self.chatbot.state
+
         prompt = self.generate_prompt(history)
-        state_prediction = self.user_proxy.initiate_chat(self.llm, message=prompt)
-        return state_prediction
+        try:
+            reply = hedged_call("state", lambda: self.state_llm(prompt), timeout)
+        except DeadlineExceeded as e:
+            logging.warning(f"State LLM timed out, falling back: {str(e)}")
+            return self._fallback_state(history)
+        return self._parse_state(reply)
+
+    def _fallback_state(self, history: ChatMessageHistory) -> str:
+        """The local classifier's guess, however unsure, or the current state."""
+        prediction = self.classifier.predict(
+            history.messages, self.chatbot.state, self.visited_states
+        )
+        return prediction.state if prediction else self.chatbot.state
+
+    def ask_agents(self, prompt: str) -> str:
+        """Sends the state prompt to the LLM through a pooled autogen agent pair."""
+        with self.agent_pool.acquire() as (assistant, user_proxy):
+            state_prediction = user_proxy.initiate_chat(assistant, message=prompt)
+        summary = state_prediction.summary or ""
+        LLM_CALLS.inc(model=STATE_MODEL, chain="state")
+        record_tokens(
+            STATE_MODEL,
+            self.chatbot.state,
+            count_tokens(prompt, STATE_MODEL),
+            count_tokens(summary, STATE_MODEL),
+        )
+        return summary
+
+    def _parse_state(self, llm_response: str) -> str:
+        """Maps the LLM reply to a known state, keeping the current one if none is found."""
+        for state in STATES:
+            if state.lower() in llm_response.lower():
+                return state
+        return self.chatbot.state
 
     def generate_prompt(self, history: ChatMessageHistory) -> str:
         visited_states = ", ".join(self.visited_states)
+        if self.memory is not None:
+            history = self.memory.render(history.messages, self.history_tokens)
         prompt = f"""
         Given the conversation history:
         '{history}'
@@ -183,22 +400,28 @@ class StateController:
         """
         return prompt
 
-    def update_chatbot_state(self, history: ChatMessageHistory) -> str:
+    def update_chatbot_state(
+        self, history: ChatMessageHistory, timeout: Optional[float] = None
+    ) -> str:
         """
         Updates the chatbot's state based on the conversation history.
 
         Parameters:
             history (ChatMessageHistory): The historical record of the conversation.
+            timeout (Optional[float]): Time the state LLM may take, in seconds.
 
         Returns:
             str: The chatbot's prompt for the newly updated state.
         """
-        predicted_state = self.determine_state(history)
-        llm_response = predicted_state.summary
-        if llm_response not in self.chatbot.state:
-            self.visited_states.append(llm_response)
-            self.chatbot.state = llm_response
-        return self.chatbot.prompts[llm_response]
-
-    def handle_input(self, history: ChatMessageHistory) -> str:
-        return self.update_chatbot_state(history)
+        with stage("state"):
+            predicted_state = self.determine_state(history, timeout)
+        record_transition(self.chatbot.state, predicted_state)
+        if predicted_state not in self.chatbot.state:
+            self.visited_states.append(predicted_state)
+            self.chatbot.state = predicted_state
+        return self.chatbot.prompts[predicted_state]
+
+    def handle_input(
+        self, history: ChatMessageHistory, timeout: Optional[float] = None
+    ) -> str:
+        return self.update_chatbot_state(history, timeout)
@@ -0,0 +1,126 @@
+import json
+import os
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from src.llm.clients import get_async_http_client, get_http_client
+
+OPENAI_EMBEDDING_MODEL = "text-embedding-ada-002"
+LOCAL_EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+BACKEND_FILE = "embedding_backend.json"
+
+
+@lru_cache(maxsize=None)
+def _load_sentence_transformer(model_name: str, device: str):
+    # Imported here so the OpenAI backend does not pay for loading torch.
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name, device=device)
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Embeds texts offline with a sentence-transformers model.
+
+    The model is loaded once per process and shared by every instance, and texts are
+    encoded in batches straight into normalized float32 NumPy arrays.
+
+    Attributes:
+        model_name (str): The sentence-transformers model name or path.
+        device (str): The torch device the model runs on.
+        batch_size (int): Number of texts encoded per forward pass.
+    """
+
+    def __init__(
+        self,
+        model_name: str = LOCAL_EMBEDDING_MODEL,
+        device: str = "cpu",
+        batch_size: int = 64,
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        model = _load_sentence_transformer(self.model_name, self.device)
+        return model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        ).astype(np.float32, copy=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+def embedding_backend() -> str:
+    """The configured backend, "openai" (default) or "local"."""
+    backend = os.getenv("EMBEDDING_BACKEND", "openai")
+    if backend not in ("openai", "local"):
+        raise ValueError(
+            f"Unknown embedding backend '{backend}', expected 'openai' or 'local'"
+        )
+    return backend
+
+
+def embedding_signature() -> str:
+    """Identifies the configured backend and model, e.g. "openai:text-embedding-ada-002"."""
+    if embedding_backend() == "local":
+        return f"local:{os.getenv('LOCAL_EMBEDDING_MODEL', LOCAL_EMBEDDING_MODEL)}"
+    return f"openai:{OPENAI_EMBEDDING_MODEL}"
+
+
+def get_embeddings() -> Embeddings:
+    """The embedding function of the configured backend, shared by the whole process."""
+    return _build_embeddings(embedding_signature())
+
+
+@lru_cache(maxsize=None)
+def _build_embeddings(signature: str) -> Embeddings:
+    if signature.startswith("local:"):
+        return LocalEmbeddings(
+            model_name=os.getenv("LOCAL_EMBEDDING_MODEL", LOCAL_EMBEDDING_MODEL),
+            device=os.getenv("LOCAL_EMBEDDING_DEVICE", "cpu"),
+        )
+    return OpenAIEmbeddings(
+        model=OPENAI_EMBEDDING_MODEL,
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client(),
+    )
+
+
+def read_index_backend(index_dir: str) -> Optional[str]:
+    """The signature of the backend that built the index, None for unknown or new indexes."""
+    path = os.path.join(index_dir, BACKEND_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)["embedding"]
+
+
+def record_index_backend(index_dir: str):
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, BACKEND_FILE), "w", encoding="utf-8") as file:
+        json.dump({"embedding": embedding_signature()}, file)
+
+
+def check_index_backend(index_dir: str):
+    """
+    Raises ValueError when the index was built by a different embedding backend,
+    as its vectors would not be comparable with the query embeddings.
+    """
+    built_with = read_index_backend(index_dir)
+    if built_with is not None and built_with != embedding_signature():
+        raise ValueError(
+            f"The index in '{index_dir}' was built with '{built_with}' but the "
+            f"configured embedding backend is '{embedding_signature()}'. "
+            "Rebuild it with 'python -m src.llm.process_rag_docs'."
+        )
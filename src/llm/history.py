@@ -0,0 +1,164 @@
+import threading
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+import tiktoken
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from src.llm.state_classifier import extract_contact_info
+
+FACT_LABELS = {
+    "product": "Produto escolhido",
+    "name": "Nome",
+    "email": "E-mail",
+    "phone": "Telefone",
+}
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    return len(_encoding(model).encode(text))
+
+
+def _speaker(message: BaseMessage) -> str:
+    return "Human" if isinstance(message, HumanMessage) else "AI"
+
+
+class ConversationMemory:
+    """
+    Keeps the conversation context sent to the LLMs within a token budget.
+
+    The most recent messages are kept verbatim, older ones are folded into a rolling
+    extractive summary as they leave the window, and the facts needed to close the
+    purchase (chosen product, name, email and phone) are extracted once and always
+    kept, however old the message that carried them. Each chain asks for the context
+    with its own token budget; the recent messages that do not fit it are summarized
+    too, for that chain, instead of being left out.
+
+    Attributes:
+        recent_messages (int): Number of latest messages kept verbatim.
+        summary_chars (int): Characters kept from each summarized message.
+        product_lookup (Optional[Callable[[str], List[str]]]): Returns the catalog
+            product names mentioned in a text.
+        model (str): Model whose tokenizer counts the tokens.
+        facts (Dict[str, str]): The structured facts collected so far.
+    """
+
+    def __init__(
+        self,
+        recent_messages: int = 6,
+        summary_chars: int = 120,
+        product_lookup: Optional[Callable[[str], List[str]]] = None,
+        model: str = "gpt-3.5-turbo",
+    ):
+        self.recent_messages = recent_messages
+        self.summary_chars = summary_chars
+        self.product_lookup = product_lookup
+        self.model = model
+        self.facts: Dict[str, str] = {}
+        self._summary: List[str] = []
+        self._summarized = 0
+        self._facts_seen = 0
+        self._lock = threading.Lock()
+
+    def update(self, messages: List[BaseMessage]):
+        """Folds the messages that left the recent window and extracts the new facts."""
+        with self._lock:
+            if len(messages) < self._facts_seen:
+                # The history was cleared, start over.
+                self._reset()
+            facts_seen, summarized = self._facts_seen, self._summarized
+            for message in messages[facts_seen:]:
+                if isinstance(message, HumanMessage):
+                    self._extract_facts(message.content)
+            self._facts_seen = len(messages)
+            window_start = max(0, len(messages) - self.recent_messages)
+            for message in messages[summarized:window_start]:
+                self._summary.append(self._summary_line(message))
+            self._summarized = max(self._summarized, window_start)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self.facts = {}
+        self._summary = []
+        self._summarized = 0
+        self._facts_seen = 0
+
+    def render(self, messages: List[BaseMessage], max_tokens: int) -> str:
+        """
+        Renders the facts, the summary and the recent messages as text within the budget.
+
+        Parameters:
+            messages (List[BaseMessage]): The full conversation history.
+            max_tokens (int): Maximum number of tokens of the rendered text.
+
+        Returns:
+            str: The compacted conversation.
+        """
+        context, window = self._fit(messages, max_tokens)
+        lines = [context] if context else []
+        lines.extend(f"{_speaker(message)}: {message.content}" for message in window)
+        return "\n".join(lines)
+
+    def _fit(self, messages: List[BaseMessage], max_tokens: int):
+        self.update(messages)
+        with self._lock:
+            facts = "\n".join(
+                f"{FACT_LABELS[key]}: {value}"
+                for key, value in self.facts.items()
+                if key in FACT_LABELS
+            )
+            summary = list(self._summary)
+            window_start = self._summarized
+
+        budget = max_tokens - count_tokens(facts, self.model)
+        window = []
+        for message in reversed(messages[window_start:]):
+            tokens = count_tokens(message.content, self.model) + 2
+            if window and tokens > budget:
+                break
+            window.insert(0, message)
+            budget -= tokens
+        # Recent messages left out of the window are summarized like older ones.
+        window_end = len(messages) - len(window)
+        summary.extend(
+            self._summary_line(message) for message in messages[window_start:window_end]
+        )
+        # The newest summary lines are the most relevant, older ones go first.
+        kept = []
+        for line in reversed(summary):
+            tokens = count_tokens(line, self.model) + 1
+            if tokens > budget:
+                break
+            kept.insert(0, line)
+            budget -= tokens
+
+        sections = []
+        if facts:
+            sections.append(f"Dados coletados:\n{facts}")
+        if kept:
+            sections.append("Resumo da conversa anterior:\n" + "\n".join(kept))
+        return "\n\n".join(sections), window
+
+    def _summary_line(self, message: BaseMessage) -> str:
+        content = " ".join(message.content.split())
+        if len(content) > self.summary_chars:
+            content = content[: self.summary_chars].rstrip() + "..."
+        return f"- {_speaker(message)}: {content}"
+
+    def _extract_facts(self, text: str):
+        self.facts.update(extract_contact_info(text))
+        if self.product_lookup is not None:
+            products = self.product_lookup(text)
+            if products:
+                self.facts["product"] = products[-1]
@@ -0,0 +1,316 @@
+import abc
+import bisect
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[Dict[str, str], float]
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"),
+        )
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(abc.ABC):
+    """Base of the metric types, a named family of samples keyed by label values."""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}"
+            )
+        return lines
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        """The (name suffix, labels, value) of each sample of the family."""
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield "", dict(zip(self.labelnames, key)), value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: the count of each bucket (not cumulative), the sum and the count.
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0, 0)
+            )
+            counts[position] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            }
+        for key, (counts, total, count) in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class CallbackMetric(Metric):
+    """A metric read at scrape time from the stats some component already keeps."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable[[], List[Sample]],
+        type_name: str = "gauge",
+    ):
+        super().__init__(name, documentation)
+        self.collect = collect
+        self.type_name = type_name
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield "", labels, value
+
+
+class MetricsRegistry:
+    """Holds the metrics of the process and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable[[], List[Sample]],
+        type_name: str = "gauge",
+    ) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, collect, type_name))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logging.error(f"Failed to collect the metric {metric.name}: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    "marketplace_stage_seconds",
+    "Time spent in each stage of a turn.",
+    ("stage",),
+)
+LLM_TOKENS = metrics.counter(
+    "marketplace_llm_tokens_total",
+    "Prompt and completion tokens sent to and received from the LLMs.",
+    ("model", "state", "kind"),
+)
+LLM_CALLS = metrics.counter(
+    "marketplace_llm_calls_total",
+    "Calls made to the LLMs, per chain.",
+    ("model", "chain"),
+)
+STATE_TRANSITIONS = metrics.counter(
+    "marketplace_state_transitions_total",
+    "Conversation state transitions.",
+    ("from_state", "to_state"),
+)
+REQUESTS = metrics.counter(
+    "marketplace_requests_total",
+    "HTTP requests handled, per endpoint and status code.",
+    ("endpoint", "status"),
+)
+REQUEST_SECONDS = metrics.histogram(
+    "marketplace_request_seconds",
+    "HTTP request latency, per endpoint.",
+    ("endpoint",),
+)
+QUEUE_SECONDS = metrics.histogram(
+    "marketplace_queue_wait_seconds",
+    "Time turns waited for an admission slot, per priority.",
+    ("priority",),
+)
+DEADLINE_MISSES = metrics.counter(
+    "marketplace_deadline_misses_total",
+    "Turn stages that ran out of their share of the turn deadline and fell back.",
+    ("stage",),
+)
+HEDGED_CALLS = metrics.counter(
+    "marketplace_hedged_calls_total",
+    "LLM calls answered in time, per stage and whether a duplicate was sent.",
+    ("stage", "hedged"),
+)
+ADMISSION_REJECTIONS = metrics.counter(
+    "marketplace_admission_rejections_total",
+    "Turns rejected with 429 because the admission queue was full, per priority.",
+    ("priority",),
+)
+
+# The spans and token counts of the request being handled, for the structured logs.
+_request_trace: ContextVar[Optional[Dict[str, Any]]] = ContextVar(
+    "request_trace", default=None
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Times a stage of the turn ("retrieval", "state", "generation").
+
+    The duration is observed in the marketplace_stage_seconds histogram and, inside a
+    request_trace, added to the spans of the request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        trace = _request_trace.get()
+        if trace is not None:
+            spans = trace["spans"]
+            spans[name] = round(spans.get(name, 0.0) + elapsed * 1000, 2)
+
+
+@contextmanager
+def request_trace(**fields) -> Iterator[Dict[str, Any]]:
+    """
+    Collects the spans and token counts of a request into a dict.
+
+    The context is copied into the threads started with asyncio.to_thread, so the
+    stages run there are recorded in the same trace.
+    """
+    trace = {**fields, "spans": {}, "tokens": {"prompt": 0, "completion": 0}}
+    token = _request_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _request_trace.reset(token)
+
+
+def annotate(**fields):
+    """Adds fields, e.g. the session id, to the trace of the current request."""
+    trace = _request_trace.get()
+    if trace is not None:
+        trace.update(fields)
+
+
+def record_tokens(model: str, state: str, prompt_tokens: int, completion_tokens: int):
+    LLM_TOKENS.inc(prompt_tokens, model=model, state=state, kind="prompt")
+    LLM_TOKENS.inc(completion_tokens, model=model, state=state, kind="completion")
+    trace = _request_trace.get()
+    if trace is not None:
+        trace["tokens"]["prompt"] += prompt_tokens
+        trace["tokens"]["completion"] += completion_tokens
+
+
+def record_transition(from_state: str, to_state: str):
+    STATE_TRANSITIONS.inc(from_state=from_state, to_state=to_state)
+    trace = _request_trace.get()
+    if trace is not None:
+        trace["state"] = to_state
+
+
+def log_request(trace: Dict[str, Any]):
+    """Writes the request trace as a single JSON line."""
+    logging.getLogger("marketplace.requests").info(
+        json.dumps(trace, ensure_ascii=False, default=str)
+    )
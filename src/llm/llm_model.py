@@ -1,25 +1,41 @@
+import asyncio
+import csv
 import logging
 import os
+import re
+import time
 import uuid
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 
-import pandas as pd
 from dotenv import load_dotenv
-from langchain.chains.llm import LLMChain
+from langchain.docstore.document import Document as LangchainDocument
 from langchain.memory import ChatMessageHistory
 from langchain.prompts import PromptTemplate
 from langchain_community.vectorstores import Chroma
-from langchain_core.messages import HumanMessage
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_openai import ChatOpenAI
+from langchain_core.messages import HumanMessage, messages_from_dict, messages_to_dict
 
+from src.llm.chain_registry import get_chain_registry
+from src.llm.deadlines import (
+    DeadlineExceeded,
+    TurnBudget,
+    call_with_deadline,
+    hedged_acall,
+    hedged_call,
+)
 from src.llm.dinamic_state import (
     ConversationCoordinator,
     ProductRetrievalManager,
     StateController,
 )
+from src.llm.history import ConversationMemory
+from src.llm.instrumentation import DEADLINE_MISSES, stage
+from src.llm.product_index import ProductIndex
+from src.llm.response_cache import ResponseCache
+from src.llm.retrieval_cache import RetrievalCache
+from src.llm.state_classifier import RuleBasedStateClassifier
+from src.llm.token_usage import TokenUsageCallback
+from src.llm.transcripts import TranscriptSink
 
 load_dotenv()
 
@@ -29,6 +45,12 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Sent when the answer is not generated within the turn deadline.
+FALLBACK_ANSWER = (
+    "Desculpe, estou demorando mais do que o esperado para responder. "
+    "Pode repetir a sua mensagem?"
+)
+
 
 class MarketplaceJourney:
     """
@@ -36,95 +58,291 @@ class MarketplaceJourney:
 
     This class orchestrates the interaction flow, handling user queries about products,
     managing state transitions based on those queries, and logging the conversation history.
+    The chains, prompts and state agents are shared by every session, a journey only
+    holds the session state: history, memory, current and visited states.
 
     Attributes:
-        llm (ChatOpenAI): The language model used for generating text-based responses.
+        llm (ChatOpenAI): The language model used for generating text-based responses,
+        shared by every session.
+        callbacks (List[BaseCallbackHandler]): Callbacks of this session, passed to each
+        LLM call.
         session_id (str): A unique identifier for the session.
         history (ChatMessageHistory): Records the history of messages in the session.
+        transcript_sink (Optional[TranscriptSink]): Persists the messages of each turn
+        once it is saved, see record_transcript.
+        response_cache (Optional[ResponseCache]): Shared answers of the states whose
+        answer does not depend on the conversation.
         document_manager (ProductRetrievalManager): Manages the retrieval and formatting of product details.
         chatbot (ConversationCoordinator): The chatbot handling the conversation logic.
         state_agent (StateController): Manages state transitions within the conversation.
-        main_prompt_template (PromptTemplate): The template for generating conversation prompts.
-        main_chain (LLMChain): The chain that processes the main interaction logic.
-        chain_with_history (RunnableWithMessageHistory): A runnable chain that
-        incorporates message history.
+        main_prompt_template (PromptTemplate): The prompt of the current state.
+        memory (ConversationMemory): Compacts the history sent to the LLMs within
+        per chain token budgets.
+        chain_registry (ChainRegistry): The shared, pre-built chains of each state.
+        version (int): Version of the stored session state the journey was restored
+        from or last saved as, 0 for a session never saved.
+        turn_deadline_seconds (Optional[float]): Time to answer a turn, split across
+        its stages, each falling back to a degraded result when out of time. No
+        deadline when None.
     """
 
-    def __init__(self, retriever: Chroma, llm_type="gpt-3.5-turbo"):
-        self.llm = ChatOpenAI(model_name=llm_type, temperature=0)
-        self.session_id = str(uuid.uuid4())
+    def __init__(
+        self,
+        retriever: Chroma,
+        llm_type="gpt-3.5-turbo",
+        session_id: Optional[str] = None,
+        state_classifier_mode: str = "llm",
+        state_classifier: Optional[RuleBasedStateClassifier] = None,
+        retrieval_cache: Optional[RetrievalCache] = None,
+        product_index: Optional[ProductIndex] = None,
+        state_history_tokens: int = 800,
+        main_history_tokens: int = 1500,
+        transcript_sink: Optional[TranscriptSink] = None,
+        response_cache: Optional[ResponseCache] = None,
+        turn_deadline_seconds: Optional[float] = None,
+    ):
+        self.llm_type = llm_type
+        self.chain_registry = get_chain_registry(llm_type)
+        self.llm = self.chain_registry.llm
+        self.callbacks = [
+            TokenUsageCallback(llm_type, state=lambda: self.chatbot.state)
+        ]
+        self.session_id = session_id or str(uuid.uuid4())
         self.history = ChatMessageHistory()
-        self.document_manager = ProductRetrievalManager(retriever)
-        self.chatbot = ConversationCoordinator(self.document_manager)
-        self.state_agent = StateController(self.chatbot)
-
-        self.main_prompt_template = PromptTemplate(
-            template="""Você é um assistente de marketplace. Seu objetivo é ajudar os usuários a
-            encontrar os produtos que eles estão interessados. Aqui está a questão do usuário:
-            {question}""",
-            input_variables=["question", "document"],
+        self.transcript_sink = transcript_sink
+        # Messages added since the last record_transcript, not in the sink yet.
+        self._unrecorded: List[Dict] = []
+        self.response_cache = response_cache
+        self.document_manager = ProductRetrievalManager(
+            retriever, retrieval_cache, product_index
         )
-
-        self.main_chain = LLMChain(
-            prompt=self.main_prompt_template,
-            llm=self.llm,
-            output_parser=StrOutputParser(),
+        self.chatbot = ConversationCoordinator(self.document_manager)
+        self.memory = ConversationMemory(
+            product_lookup=product_index.product_names if product_index else None,
+            model=llm_type,
         )
-        self.chain_with_history = RunnableWithMessageHistory(
-            self.main_chain,
-            get_session_history=lambda session_id: self.history,
-            input_messages_key="question",
-            history_messages_key="chat_history",
+        self.main_history_tokens = main_history_tokens
+        self.state_agent = StateController(
+            self.chatbot,
+            classifier_mode=state_classifier_mode,
+            classifier=state_classifier,
+            memory=self.memory,
+            history_tokens=state_history_tokens,
         )
+        self.version = 0
+        self.turn_deadline_seconds = turn_deadline_seconds
+
+    @property
+    def main_prompt_template(self) -> PromptTemplate:
+        """The prompt of the current state."""
+        return self.chatbot.prompts[self.chatbot.state]
+
+    def chat_history(self) -> str:
+        """The history for the main chain, compacted within main_history_tokens."""
+        return self.memory.render(self.history.messages, self.main_history_tokens)
+
+    def _chain_inputs(
+        self, question: str, document: Union[str, List[LangchainDocument]]
+    ) -> dict:
+        return {
+            "question": question,
+            "document": document,
+            "chat_history": self.chat_history(),
+        }
+
+    def dump_state(self) -> Dict:
+        """
+        The session state as JSON serializable data, restored by load_state.
+
+        Only the history and the states are stored, the memory is rebuilt from the
+        history on the next turn.
+        """
+        return {
+            "history": messages_to_dict(self.history.messages),
+            "state": self.chatbot.state,
+            "visited_states": list(self.state_agent.visited_states),
+        }
+
+    def load_state(self, state: Dict, version: int = 0):
+        """
+        Restores a session state saved by dump_state.
+
+        Parameters:
+            state (Dict): The saved session state.
+            version (int): The stored version of the state.
+        """
+        self.history.messages = messages_from_dict(state["history"])
+        self.memory.clear()
+        self.chatbot.state = state["state"]
+        self.state_agent.visited_states = list(state["visited_states"])
+        self.version = version
 
     def add_to_history(self, sender: str, message: str):
         if sender == "user":
             self.history.add_user_message(message)
         else:
             self.history.add_ai_message(message)
-
-    def save_history_to_file(self):
-        df = pd.DataFrame(
-            [
+        if self.transcript_sink is not None:
+            self._unrecorded.append(
                 {
                     "session_id": self.session_id,
+                    "seq": len(self.history.messages) - 1,
+                    "sender": "Human" if sender == "user" else "AI",
+                    "message": message,
+                    "state": self.chatbot.state,
                     "timestamp": datetime.now().isoformat(),
-                    "sender": "Human" if isinstance(message, HumanMessage) else "AI",
-                    "message": message.content,
                 }
-                for message in self.history.messages
-            ]
-        )
+            )
+
+    def record_transcript(self):
+        """
+        Sends the messages added since the last call to the transcript sink. Called
+        once the turn is saved, so a turn rejected with 409 never reaches the sink.
+        """
+        if self.transcript_sink is None:
+            return
+        for message in self._unrecorded:
+            self.transcript_sink.record(**message)
+        self._unrecorded.clear()
+
+    def save_history_to_file(self):
+        """Writes the session history to a CSV file, used when no transcript sink is set."""
+        if not self.history.messages:
+            return
         output_dir = "./data/07_model_output"
         os.makedirs(output_dir, exist_ok=True)
-        filename = f"{output_dir}/{self.session_id}.csv"
-        df.to_csv(filename, index=False, encoding="utf-8")
+        # The session id may come from a client, keep it inside the output directory.
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", self.session_id)
+        filename = f"{output_dir}/{name}.csv"
+        with open(filename, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["session_id", "timestamp", "sender", "message"])
+            timestamp = datetime.now().isoformat()
+            for message in self.history.messages:
+                sender = "Human" if isinstance(message, HumanMessage) else "AI"
+                writer.writerow([self.session_id, timestamp, sender, message.content])
         logging.info(f"Memory saved to {filename}")
 
     def clear_history(self):
         self.history.clear()
+        self.memory.clear()
 
-    def run_interaction(self, question: str, document: str) -> Optional[str]:
+    def run_interaction(
+        self, question: str, document: str, timeout: Optional[float] = None
+    ) -> Optional[str]:
         """Executes the interaction with the LLM, processing the given question and document details."""
-        try:
-            response = self.chain_with_history.invoke(
-                {"question": question, "document": document},
-                {"configurable": {"session_id": self.session_id}},
+
+        def call():
+            return hedged_call(
+                "generation", lambda: self._invoke(question, document), timeout
             )
+
+        try:
+            with stage("generation"):
+                cache_key = self._response_cache_key(question, document)
+                if cache_key is None:
+                    response = call()
+                else:
+                    response = self.response_cache.get_or_call(
+                        cache_key, lambda: self._answer(call())
+                    )
+        except DeadlineExceeded as e:
+            response = self._fallback_answer(question, document, e)
         except AttributeError as e:
             logging.error(f"Error during LLM interaction: {str(e)}")
             response = "No response available."
             raise
         return response
 
+    async def run_interaction_async(
+        self, question: str, document: str, timeout: Optional[float] = None
+    ) -> Optional[str]:
+        """Async counterpart of run_interaction, awaiting the LLM without blocking the event loop."""
+
+        async def call():
+            return await hedged_acall(
+                "generation", lambda: self._ainvoke(question, document), timeout
+            )
+
+        async def cached_call():
+            return self._answer(await call())
+
+        try:
+            with stage("generation"):
+                cache_key = self._response_cache_key(question, document)
+                if cache_key is None:
+                    response = await call()
+                else:
+                    response = await self.response_cache.aget_or_call(
+                        cache_key, cached_call
+                    )
+        except DeadlineExceeded as e:
+            response = self._fallback_answer(question, document, e)
+        except AttributeError as e:
+            logging.error(f"Error during LLM interaction: {str(e)}")
+            raise
+        return response
+
+    def _invoke(self, question: str, document: str) -> dict:
+        return self.chain_registry.chains[self.chatbot.state].invoke(
+            self._chain_inputs(question, document), {"callbacks": self.callbacks}
+        )
+
+    async def _ainvoke(self, question: str, document: str) -> dict:
+        return await self.chain_registry.chains[self.chatbot.state].ainvoke(
+            self._chain_inputs(question, document), {"callbacks": self.callbacks}
+        )
+
+    def _response_cache_key(
+        self, question: str, documents: Union[str, List[LangchainDocument]]
+    ) -> Optional[str]:
+        """The response cache key of the turn, None when the state is not cached."""
+        if self.response_cache is None or not self.response_cache.enabled_for(
+            self.chatbot.state
+        ):
+            return None
+        return ResponseCache.key(self.llm_type, self.chatbot.state, question, documents)
+
+    def _fallback_answer(
+        self, question: str, document: str, error: DeadlineExceeded
+    ) -> dict:
+        """
+        The answer of a turn out of time: the cached answer of the question when its
+        state is cached, even if expired for the TTL, or else FALLBACK_ANSWER.
+        """
+        logging.warning(f"Answer generation timed out, falling back: {str(error)}")
+        cache_key = self._response_cache_key(question, document)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key, allow_stale=True)
+            if cached is not None:
+                return cached
+        return {"text": FALLBACK_ANSWER}
+
+    def _budget(self) -> Optional[TurnBudget]:
+        if self.turn_deadline_seconds is None:
+            return None
+        return TurnBudget(self.turn_deadline_seconds)
+
+    @staticmethod
+    def _stage_timeout(budget: Optional[TurnBudget], name: str) -> Optional[float]:
+        return budget.for_stage(name) if budget is not None else None
+
+    @staticmethod
+    def _stage_deadline(budget: Optional[TurnBudget], name: str) -> Optional[float]:
+        return budget.deadline(name) if budget is not None else None
+
+    @staticmethod
+    def _answer(response: dict) -> dict:
+        """Only the text is shared through the cache, not the history of the turn."""
+        return {"text": response["text"]}
+
     def end_session(self):
-        self.save_history_to_file()
+        if self.transcript_sink is None:
+            self.save_history_to_file()
+        else:
+            self.record_transcript()
         self.clear_history()
 
-    def update_prompt(self, next_prompt: PromptTemplate):
-        self.main_prompt_template = next_prompt
-        self.main_chain.prompt = self.main_prompt_template
-
     def get_answer(self, question: str) -> Tuple[str, Optional[str]]:
         """
         Retrieves an answer from the LLM based on the stage of interaction.
@@ -137,11 +355,180 @@ class MarketplaceJourney:
             message and the formatted documents.
         """
         self.add_to_history("user", question)
-        formatted_docs = self.document_manager.get_product_details(question)
-        next_prompt = self.state_agent.handle_input(self.history)
-        self.update_prompt(next_prompt)
-        response = self.run_interaction(question, formatted_docs)
+        budget = self._budget()
+        next_prompt = self.state_agent.handle_input(
+            self.history, self._stage_timeout(budget, "state")
+        )
+        formatted_docs = ""
+        if self._uses_documents(next_prompt):
+            try:
+                formatted_docs = call_with_deadline(
+                    "retrieval",
+                    lambda: self.document_manager.get_product_details(question),
+                    self._stage_timeout(budget, "retrieval"),
+                )
+            except DeadlineExceeded as e:
+                formatted_docs = self._fallback_documents(question, e)
+        response = self.run_interaction(
+            question, formatted_docs, self._stage_timeout(budget, "generation")
+        )
         response_text = response.get("text", "Sem resposta disponível.")
         self.add_to_history("ai", response_text)
 
         return response
+
+    async def get_answer_async(self, question: str) -> Tuple[str, Optional[str]]:
+        """
+        Async version of get_answer that does not block the event loop while the
+        state is determined and the product details are retrieved.
+
+        Parameters:
+            question (str): The question asked by the user.
+
+        Returns:
+            Tuple[str, Optional[str]]: A tuple containing the response
+            message and the formatted documents.
+        """
+        self.add_to_history("user", question)
+        budget = self._budget()
+        formatted_docs = await self._prepare_turn_async(question, budget)
+        response = await self.run_interaction_async(
+            question, formatted_docs, self._stage_timeout(budget, "generation")
+        )
+        response_text = response.get("text", "Sem resposta disponível.")
+        self.add_to_history("ai", response_text)
+
+        return response
+
+    async def stream_answer(self, question: str) -> AsyncIterator[str]:
+        """
+        Streams the answer tokens as the LLM produces them.
+
+        Retrieval and state selection run as in get_answer_async, then the prompt of
+        the selected state is piped straight into the LLM so each token is yielded
+        as soon as it arrives. The full answer is added to the history at the end.
+        A cached answer is sent as a single token; streamed answers are cached but,
+        unlike get_answer_async, concurrent identical streams are not coalesced.
+        Streams are not hedged: the turn deadline only bounds the wait for the first
+        token, after which the fallback answer is sent instead.
+
+        Parameters:
+            question (str): The question asked by the user.
+
+        Yields:
+            str: The answer tokens.
+        """
+        self.add_to_history("user", question)
+        budget = self._budget()
+        formatted_docs = await self._prepare_turn_async(question, budget)
+        cache_key = self._response_cache_key(question, formatted_docs)
+        cached = self.response_cache.lookup(cache_key) if cache_key else None
+        if cached is not None:
+            yield cached["text"]
+            self.add_to_history("ai", cached["text"])
+            return
+        chain = self.chain_registry.streaming_chains[self.chatbot.state]
+        tokens = []
+        with stage("generation"):
+            stream = chain.astream(
+                self._chain_inputs(question, formatted_docs),
+                {"callbacks": self.callbacks},
+            )
+            try:
+                first = await asyncio.wait_for(
+                    stream.__anext__(), self._stage_timeout(budget, "generation")
+                )
+            except StopAsyncIteration:
+                first = None
+            except asyncio.TimeoutError:
+                await stream.aclose()
+                DEADLINE_MISSES.inc(stage="generation")
+                answer = self._fallback_answer(
+                    question,
+                    formatted_docs,
+                    DeadlineExceeded("generation", budget.total_seconds),
+                )["text"]
+                yield answer
+                self.add_to_history("ai", answer)
+                return
+            if first is not None:
+                tokens.append(first)
+                yield first
+                async for token in stream:
+                    tokens.append(token)
+                    yield token
+        answer = "".join(tokens)
+        if cache_key:
+            self.response_cache.put(cache_key, {"text": answer})
+        self.add_to_history("ai", answer)
+
+    async def _prepare_turn_async(
+        self, question: str, budget: Optional[TurnBudget] = None
+    ) -> str:
+        """
+        Determines the state of the turn and retrieves the product details only when
+        the state prompt uses them.
+
+        When the conversation is already in a state that uses documents, the next turn
+        will most likely need them too, so retrieval starts speculatively alongside the
+        state determination and its result is dropped if the new state does not use it.
+        Retrieval out of its share of the budget, counted from when it started, falls
+        back to a lexical only search.
+        """
+        prefetch = retrieval_deadline = None
+        if self._uses_documents(self.chatbot.prompts[self.chatbot.state]):
+            prefetch = asyncio.ensure_future(
+                asyncio.to_thread(self.document_manager.get_product_details, question)
+            )
+            retrieval_deadline = self._stage_deadline(budget, "retrieval")
+        needs_documents = False
+        try:
+            next_prompt = await asyncio.to_thread(
+                self.state_agent.handle_input,
+                self.history,
+                self._stage_timeout(budget, "state"),
+            )
+            needs_documents = self._uses_documents(next_prompt)
+        finally:
+            # Also when the state determination failed, so the prefetch is not leaked.
+            if prefetch is not None and not needs_documents:
+                self._drop(prefetch)
+        if not needs_documents:
+            return ""
+        if prefetch is None:
+            prefetch = asyncio.ensure_future(
+                asyncio.to_thread(self.document_manager.get_product_details, question)
+            )
+            retrieval_deadline = self._stage_deadline(budget, "retrieval")
+        timeout = None
+        if retrieval_deadline is not None:
+            timeout = max(0.0, retrieval_deadline - time.monotonic())
+        try:
+            return await asyncio.wait_for(prefetch, timeout)
+        except asyncio.TimeoutError:
+            DEADLINE_MISSES.inc(stage="retrieval")
+            return await asyncio.to_thread(
+                self._fallback_documents,
+                question,
+                DeadlineExceeded("retrieval", timeout),
+            )
+
+    @staticmethod
+    def _drop(prefetch: asyncio.Future):
+        """
+        Drops a speculative retrieval that is no longer needed. The worker thread cannot
+        be interrupted and finishes in the background, so its outcome is still retrieved
+        when it ends, otherwise asyncio logs a failed retrieval as never retrieved.
+        """
+        prefetch.cancel()
+        prefetch.add_done_callback(
+            lambda future: future.cancelled() or future.exception()
+        )
+
+    def _fallback_documents(self, question: str, error: DeadlineExceeded):
+        logging.warning(f"Product retrieval timed out, falling back: {str(error)}")
+        return self.document_manager.get_product_details_offline(question)
+
+    @staticmethod
+    def _uses_documents(prompt: PromptTemplate) -> bool:
+        return "document" in prompt.input_variables
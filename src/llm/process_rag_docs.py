@@ -1,90 +1,347 @@
-import pickle
-from typing import List
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 from dotenv import load_dotenv
 from langchain.docstore.document import Document as LangchainDocument
 from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
+
+from src.llm.create_rag_db import (
+    CHROMA_DB_DIR,
+    open_vector_store,
+    vector_store_backend,
+    vector_store_dir,
+)
+from src.llm.embeddings import (
+    embedding_signature,
+    read_index_backend,
+    record_index_backend,
+)
+from src.llm.vector_store import NumpyVectorStore
 
 load_dotenv()
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
 
+PRODUCTS_FILE = "data/01_raw/products.txt"
+CHECKPOINT_FILE = os.path.join(CHROMA_DB_DIR, "ingest_checkpoint.json")
 
-def _save_to_file(obj: any, filename: str) -> None:
-    """Save an object to a file using pickle.
+# "<category>: <product name> - <price>", the price being whatever follows the last
+# " - " so product names may contain dashes, colons or quotes.
+PRODUCT_LINE_PATTERN = re.compile(
+    r"^(?P<category>[^:]+):\s*(?P<product_name>.+)\s+-\s+(?P<price>[^-]+?)\s*$"
+)
+
+
+@dataclass
+class IndexReport:
+    """What an indexing run changed in the collection and how fast it went."""
+
+    added: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    resumed_from_line: int = 0
+    errors: List[str] = field(default_factory=list)
+    elapsed_seconds: float = 0.0
+
+    @property
+    def products(self) -> int:
+        return self.added + self.updated + self.unchanged
+
+    @property
+    def products_per_second(self) -> float:
+        return self.products / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.added} added, {self.updated} updated, "
+            f"{self.removed} removed, {self.unchanged} unchanged, "
+            f"{len(self.errors)} invalid lines, "
+            f"{self.products_per_second:.1f} products/sec"
+        )
 
-    Parameters
-    ----------
-    obj : any
-        The object to be saved.
-    filename : str
-        The filename where the object will be saved.
-    """
-    with open(filename, "wb") as file:
-        pickle.dump(obj, file)
 
+def _product_id(category: str, product_name: str) -> str:
+    """Stable id of a product, which does not change when its price or description does."""
+    key = f"{category.strip().lower()}|{product_name.strip().lower()}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
 
-def _load_from_file(filename: str) -> any:
-    """Load an object from a file using pickle.
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def parse_product_line(line: str) -> LangchainDocument:
+    """Parse one catalog line into a document.
 
     Parameters
     ----------
-    filename : str
-        The filename where the object is saved.
+    line : str
+        A line formatted as "<category>: <product name> - <price>".
 
     Returns
     -------
-    any
-        The object loaded from the file.
+    LangchainDocument
+        The product document with its metadata, id and content hash.
+
+    Raises
+    ------
+    ValueError
+        If the line does not follow the catalog format.
     """
-    with open(filename, "rb") as file:
-        return pickle.load(file)
+    content = line.strip()
+    match = PRODUCT_LINE_PATTERN.match(content)
+    if match is None:
+        raise ValueError("expected '<category>: <product name> - <price>'")
+    category = match.group("category").strip()
+    product_name = match.group("product_name").strip()
+    metadata = {
+        "category": category,
+        "product_name": product_name,
+        "price": match.group("price").strip(),
+        "product_id": _product_id(category, product_name),
+        "content_hash": _content_hash(content),
+    }
+    return LangchainDocument(page_content=content, metadata=metadata)
 
 
-def _load_text() -> List[LangchainDocument]:
-    """Load and process text files.
+def iter_documents(
+    filepath: str = PRODUCTS_FILE,
+    start_line: int = 0,
+    errors: Optional[List[str]] = None,
+) -> Iterator[Tuple[int, LangchainDocument]]:
+    """Stream the catalog documents one line at a time.
 
-    Returns
-    -------
-    List[LangchainDocument]
-        The updated list of documents including text files.
+    Parameters
+    ----------
+    filepath : str
+        The catalog file.
+    start_line : int
+        Lines up to this number (1-based) are skipped, to resume an interrupted run.
+    errors : Optional[List[str]]
+        Receives one message per invalid line, which is skipped.
+
+    Yields
+    ------
+    Tuple[int, LangchainDocument]
+        The line number and the parsed document.
     """
-    filepath = "data/01_raw/products.txt"
     with open(filepath, "r", encoding="utf-8") as file:
-        lines = file.readlines()
+        for line_number, line in enumerate(file, start=1):
+            if line_number <= start_line or not line.strip():
+                continue
+            try:
+                yield line_number, parse_product_line(line)
+            except ValueError as e:
+                message = f"{filepath}:{line_number}: {e}: {line.strip()!r}"
+                logging.warning(f"Skipping invalid catalog line {message}")
+                if errors is not None:
+                    errors.append(message)
 
-    documents = []
-    for line in lines:
-        parts = line.split(":")
-        category = parts[0].strip()
-        product_info = parts[1].split("-")
-        product_name = product_info[0].strip()
-        price = product_info[1].strip()
 
-        metadata = {"category": category, "product_name": product_name, "price": price}
-        doc = LangchainDocument(page_content=line.strip(), metadata=metadata)
-        documents.append(doc)
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
-    return documents
 
+def _file_signature(filepath: str) -> dict:
+    stat = os.stat(filepath)
+    return {"source": filepath, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
 
-def load_data():
-    docs = _load_text()
 
-    compress_documents_files = "data/03_primary/compress_documents.pkl"
+def _read_checkpoint(checkpoint_path: Optional[str], filepath: str) -> int:
+    """Last ingested line of an interrupted run, if the catalog did not change since."""
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path, "r", encoding="utf-8") as file:
+        checkpoint = json.load(file)
+    if checkpoint.get("file") != _file_signature(filepath):
+        return 0
+    return checkpoint.get("line", 0)
 
-    _save_to_file(docs, compress_documents_files)
 
-    docs = _load_from_file(compress_documents_files)
+def _write_checkpoint(checkpoint_path: Optional[str], filepath: str, line: int):
+    if not checkpoint_path:
+        return
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"file": _file_signature(filepath), "line": line}, file)
+    os.replace(tmp_path, checkpoint_path)
 
-    chroma_db_dir = "data/03_primary/chroma_db"
-    docsearch = Chroma.from_documents(
-        docs,
-        OpenAIEmbeddings(model="text-embedding-ada-002"),
-        persist_directory=chroma_db_dir,
+
+def _changed_documents(
+    docsearch: Chroma, docs: List[LangchainDocument], report: IndexReport
+) -> List[LangchainDocument]:
+    """Keep the documents that are new or whose content hash differs from the stored one."""
+    batch = {doc.metadata["product_id"]: doc for doc in docs}
+    stored = docsearch.get(ids=list(batch), include=["metadatas"])
+    stored_hashes = {
+        doc_id: (metadata or {}).get("content_hash")
+        for doc_id, metadata in zip(stored["ids"], stored["metadatas"])
+    }
+    changed = []
+    for product_id, doc in batch.items():
+        if product_id not in stored_hashes:
+            report.added += 1
+        elif stored_hashes[product_id] != doc.metadata["content_hash"]:
+            report.updated += 1
+        else:
+            report.unchanged += 1
+            continue
+        changed.append(doc)
+    return changed
+
+
+def _upsert_batch(
+    docsearch: Union[Chroma, NumpyVectorStore],
+    docs: List[LangchainDocument],
+    embeddings: Optional[Future],
+):
+    if embeddings is None:
+        return
+    # Chroma only takes precomputed embeddings through its collection.
+    target = docsearch._collection if isinstance(docsearch, Chroma) else docsearch
+    target.upsert(
+        ids=[doc.metadata["product_id"] for doc in docs],
+        embeddings=embeddings.result(),
+        metadatas=[doc.metadata for doc in docs],
+        documents=[doc.page_content for doc in docs],
     )
 
-    return docs, docsearch
+
+def _prune(docsearch: Chroma, seen_ids: Set[str], page_size: int = 5000) -> int:
+    """Delete the stored products that were not in the catalog."""
+    to_delete = []
+    offset = 0
+    while True:
+        page = docsearch.get(limit=page_size, offset=offset, include=[])["ids"]
+        if not page:
+            break
+        to_delete.extend(doc_id for doc_id in page if doc_id not in seen_ids)
+        offset += page_size
+    for chunk in _batched(to_delete, page_size):
+        docsearch.delete(ids=chunk)
+    return len(to_delete)
+
+
+def ingest_catalog(
+    docsearch: Chroma,
+    filepath: str = PRODUCTS_FILE,
+    batch_size: int = 256,
+    max_workers: int = 4,
+    checkpoint_path: Optional[str] = CHECKPOINT_FILE,
+) -> IndexReport:
+    """Stream the catalog into the collection, embedding only what changed.
+
+    Lines are parsed lazily and grouped in fixed-size batches. Each batch is compared
+    with the stored content hashes, and the new or changed products are embedded in a
+    bounded thread pool, so at most ``max_workers`` batches are in memory at once.
+    Batches are written in file order and the last written line is checkpointed, so an
+    interrupted run resumes where it stopped. Products missing from the catalog are
+    deleted at the end of a full (not resumed) run.
+
+    Parameters
+    ----------
+    docsearch : Chroma
+        The persisted collection to update.
+    filepath : str
+        The catalog file.
+    batch_size : int
+        Number of products embedded per request.
+    max_workers : int
+        Number of batches embedded concurrently.
+    checkpoint_path : Optional[str]
+        Where progress is saved, None disables resuming.
+
+    Returns
+    -------
+    IndexReport
+        What changed in the collection.
+    """
+    start = time.perf_counter()
+    start_line = _read_checkpoint(checkpoint_path, filepath)
+    report = IndexReport(resumed_from_line=start_line)
+    # Deleting requires every catalog id, which a resumed run did not see.
+    seen_ids: Optional[Set[str]] = set() if start_line == 0 else None
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        documents = iter_documents(filepath, start_line, report.errors)
+        for batch in _batched(documents, batch_size):
+            docs = [doc for _, doc in batch]
+            if seen_ids is not None:
+                seen_ids.update(doc.metadata["product_id"] for doc in docs)
+            changed = _changed_documents(docsearch, docs, report)
+            embeddings = None
+            if changed:
+                embeddings = executor.submit(
+                    docsearch.embeddings.embed_documents,
+                    [doc.page_content for doc in changed],
+                )
+            pending.append((changed, embeddings, batch[-1][0]))
+            while len(pending) > max_workers:
+                changed, embeddings, last_line = pending.popleft()
+                _upsert_batch(docsearch, changed, embeddings)
+                _write_checkpoint(checkpoint_path, filepath, last_line)
+        while pending:
+            changed, embeddings, last_line = pending.popleft()
+            _upsert_batch(docsearch, changed, embeddings)
+            _write_checkpoint(checkpoint_path, filepath, last_line)
+
+    if seen_ids is not None:
+        report.removed = _prune(docsearch, seen_ids)
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    report.elapsed_seconds = time.perf_counter() - start
+    return report
+
+
+def load_data(
+    filepath: str = PRODUCTS_FILE, batch_size: int = 256, max_workers: int = 4
+) -> Tuple[Union[Chroma, NumpyVectorStore], IndexReport]:
+    index_dir = vector_store_dir()
+    docsearch = open_vector_store()
+    built_with = read_index_backend(index_dir)
+    if built_with not in (None, embedding_signature()):
+        # Vectors from another model are not comparable, everything is re-embedded.
+        logging.warning(
+            f"Index built with '{built_with}', rebuilding with '{embedding_signature()}'"
+        )
+        docsearch.delete_collection()
+        docsearch = open_vector_store()
+        if os.path.exists(CHECKPOINT_FILE):
+            os.remove(CHECKPOINT_FILE)
+    if vector_store_backend() == "numpy":
+        # The NumPy store is only written by persist, so there is no partial run to
+        # resume: an interrupted run starts over, re-embedding only what changed
+        # since the last persisted one.
+        report = ingest_catalog(docsearch, filepath, batch_size, max_workers, None)
+        docsearch.persist()
+    else:
+        report = ingest_catalog(docsearch, filepath, batch_size, max_workers)
+    record_index_backend(index_dir)
+    logging.info(f"Product index updated: {report}")
+
+    return docsearch, report
 
 
 if __name__ == "__main__":
-    load_data()
+    parser = argparse.ArgumentParser(description="Index the product catalog.")
+    parser.add_argument("--file", default=PRODUCTS_FILE)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    load_data(args.file, args.batch_size, args.workers)
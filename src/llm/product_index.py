@@ -0,0 +1,346 @@
+import math
+import re
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document as LangchainDocument
+from langchain_community.vectorstores import Chroma
+
+PRICE_PATTERN = r"(?:r\$\s*)?(\d{1,3}(?:\.\d{3})+|\d+)(?:,(\d{1,2}))?(?:\s*(mil|k)\b)?"
+MAX_PRICE_PATTERN = re.compile(
+    rf"\b(?:ate|menos de|abaixo de|no maximo|max(?:imo)?|por ate)\s*{PRICE_PATTERN}"
+)
+MIN_PRICE_PATTERN = re.compile(
+    rf"\b(?:acima de|mais de|a partir de|no minimo|min(?:imo)?)\s*{PRICE_PATTERN}"
+)
+RANGE_PRICE_PATTERN = re.compile(rf"\bentre\s*{PRICE_PATTERN}\s*e\s*{PRICE_PATTERN}")
+# Common ways the users refer to the catalog categories.
+CATEGORY_SYNONYMS = {
+    "celular": "smartphone",
+    "telefone": "smartphone",
+    "notebook": "laptop",
+    "computador": "laptop",
+    "relogio": "smartwatch",
+    "fone": "fone de ouvido",
+    "headphone": "fone de ouvido",
+    "tv": "smart tv",
+    "televisao": "smart tv",
+    "videogame": "console de videogame",
+    "console": "console de videogame",
+}
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases and strips the accents, so "Câmera" and "camera" match."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def _singular(token: str) -> str:
+    """Naive plural stripping: "celulares" -> "celular", "tablets" -> "tablet"."""
+    if len(token) > 4 and token.endswith("es") and token[-3] in "rsz":
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    return [_singular(token) for token in re.findall(r"\w+", normalize_text(text))]
+
+
+def parse_brl_price(price: str) -> float:
+    """
+    Parses a Brazilian price string into a number.
+
+    Parameters:
+        price (str): A price such as "R$ 3.499,00", "3.000" or "3 mil".
+
+    Returns:
+        float: The price, NaN when it can not be parsed.
+    """
+    match = re.search(PRICE_PATTERN, normalize_text(price))
+    if match is None:
+        return math.nan
+    return _price_from_groups(*match.groups())
+
+
+def _price_from_groups(integer: str, cents: Optional[str], thousands: Optional[str]):
+    value = float(integer.replace(".", "")) + (float(f"0.{cents}") if cents else 0.0)
+    return value * 1000 if thousands else value
+
+
+@dataclass
+class QueryFilters:
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    categories: Set[int] = field(default_factory=set)
+
+    @property
+    def active(self) -> bool:
+        return (
+            self.min_price is not None
+            or self.max_price is not None
+            or bool(self.categories)
+        )
+
+
+class ProductIndex:
+    """
+    In-process structured index of the catalog, kept next to the vector store.
+
+    Prices and categories are held as columnar NumPy arrays used to pre-filter the
+    products mentioned in the query ("celular até R$ 3.000"), and an inverted index
+    over the product names and categories gives BM25 lexical scores. A query naming a
+    product is answered from the index alone; otherwise the lexical ranking is fused
+    with the vector search ranking (reciprocal rank fusion) inside the filtered set.
+
+    Attributes:
+        documents (List[LangchainDocument]): The products, in index order.
+        prices (np.ndarray): Parsed price per product, NaN when unknown.
+        category_codes (np.ndarray): Index in `categories` of each product category.
+        categories (List[str]): The normalized category names.
+    """
+
+    def __init__(self, documents: List[LangchainDocument]):
+        self.documents = documents
+        self.prices = np.array(
+            [parse_brl_price(doc.metadata.get("price", "")) for doc in documents],
+            dtype=np.float64,
+        )
+        self.categories: List[str] = []
+        category_lookup: Dict[str, int] = {}
+        codes = []
+        for doc in documents:
+            category = normalize_text(doc.metadata.get("category", ""))
+            if category not in category_lookup:
+                category_lookup[category] = len(self.categories)
+                self.categories.append(category)
+            codes.append(category_lookup[category])
+        self.category_codes = np.array(codes, dtype=np.int32)
+        self._category_lookup = category_lookup
+
+        self._positions = {self._key(doc): i for i, doc in enumerate(documents)}
+        self._names: Dict[Tuple[str, ...], List[int]] = {}
+        postings: Dict[str, Dict[int, int]] = {}
+        lengths = []
+        for i, doc in enumerate(documents):
+            name_tokens = tokenize(doc.metadata.get("product_name", ""))
+            self._names.setdefault(tuple(name_tokens), []).append(i)
+            tokens = name_tokens + tokenize(doc.metadata.get("category", ""))
+            lengths.append(len(tokens))
+            for token in tokens:
+                postings.setdefault(token, {}).setdefault(i, 0)
+                postings[token][i] += 1
+        self._postings = {
+            token: (
+                np.fromiter(docs.keys(), dtype=np.int64),
+                np.fromiter(docs.values(), dtype=np.float64),
+            )
+            for token, docs in postings.items()
+        }
+        self._lengths = np.array(lengths, dtype=np.float64)
+        self._average_length = float(self._lengths.mean()) if documents else 0.0
+        self._max_name_tokens = max((len(name) for name in self._names), default=0)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore: Chroma) -> "ProductIndex":
+        """Builds the index from the documents stored in the collection."""
+        stored = vectorstore.get(include=["documents", "metadatas"])
+        return cls(
+            [
+                LangchainDocument(page_content=content, metadata=metadata or {})
+                for content, metadata in zip(stored["documents"], stored["metadatas"])
+            ]
+        )
+
+    def parse_query(self, query: str) -> QueryFilters:
+        """Extracts the price range and the categories mentioned in the query."""
+        text = normalize_text(query)
+        filters = QueryFilters()
+        price_range = RANGE_PRICE_PATTERN.search(text)
+        if price_range:
+            groups = price_range.groups()
+            filters.min_price = _price_from_groups(*groups[:3])
+            filters.max_price = _price_from_groups(*groups[3:])
+        else:
+            max_price = MAX_PRICE_PATTERN.search(text)
+            if max_price:
+                filters.max_price = _price_from_groups(*max_price.groups())
+            min_price = MIN_PRICE_PATTERN.search(text)
+            if min_price:
+                filters.min_price = _price_from_groups(*min_price.groups())
+
+        tokens = tokenize(query)
+        for category, code in self._category_lookup.items():
+            category_tokens = tokenize(category)
+            if category_tokens and _contains(tokens, category_tokens):
+                filters.categories.add(code)
+        for token in tokens:
+            category = CATEGORY_SYNONYMS.get(token)
+            if category in self._category_lookup:
+                filters.categories.add(self._category_lookup[category])
+        return filters
+
+    def filter_mask(self, filters: QueryFilters) -> np.ndarray:
+        mask = np.ones(len(self.documents), dtype=bool)
+        if filters.min_price is not None:
+            mask &= self.prices >= filters.min_price
+        if filters.max_price is not None:
+            mask &= self.prices <= filters.max_price
+        if filters.categories:
+            mask &= np.isin(self.category_codes, list(filters.categories))
+        return mask
+
+    def lexical_scores(self, query: str) -> np.ndarray:
+        """BM25 score of every product for the query tokens."""
+        scores = np.zeros(len(self.documents), dtype=np.float64)
+        for token in set(tokenize(query)):
+            if token not in self._postings:
+                continue
+            docs, frequencies = self._postings[token]
+            idf = math.log(
+                1 + (len(self.documents) - len(docs) + 0.5) / (len(docs) + 0.5)
+            )
+            norm = BM25_K1 * (
+                1 - BM25_B + BM25_B * self._lengths[docs] / self._average_length
+            )
+            scores[docs] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+        return scores
+
+    def exact_matches(self, query: str) -> List[int]:
+        """Products whose full name appears in the query."""
+        tokens = tokenize(query)
+        matches = []
+        for size in range(min(self._max_name_tokens, len(tokens)), 0, -1):
+            for ngram in _ngrams(tokens, size):
+                matches.extend(self._names.get(ngram, []))
+            if matches:
+                break
+        return matches
+
+    def product_names(self, text: str) -> List[str]:
+        """Names of the catalog products mentioned in the text."""
+        return [
+            self.documents[i].metadata["product_name"] for i in self.exact_matches(text)
+        ]
+
+    def search(
+        self,
+        query: str,
+        k: int = 4,
+        vector_search: Optional[Callable[[str, int], List[LangchainDocument]]] = None,
+    ) -> List[LangchainDocument]:
+        """
+        Hybrid search: metadata pre-filter, exact name lookup, then lexical and vector fusion.
+
+        Parameters:
+            query (str): The user's query.
+            k (int): Maximum number of products returned.
+            vector_search (Optional[Callable[[str, int], List[LangchainDocument]]]):
+                Runs the vector similarity search for the query and number of results.
+
+        Returns:
+            List[LangchainDocument]: The best matching products.
+        """
+        filters = self.parse_query(query)
+        mask = self.filter_mask(filters)
+
+        exact = [i for i in self.exact_matches(query) if mask[i]]
+        if exact:
+            return [self.documents[i] for i in exact[:k]]
+        candidates = np.flatnonzero(mask)
+        if filters.active and len(candidates) <= k:
+            return [
+                self.documents[i]
+                for i in candidates[np.argsort(self.prices[candidates])]
+            ]
+
+        fused = np.zeros(len(self.documents), dtype=np.float64)
+        lexical = np.where(mask, self.lexical_scores(query), 0.0)
+        ranked = np.argsort(-lexical)[: np.count_nonzero(lexical)]
+        fused[ranked] += 1.0 / (RRF_K + np.arange(1, len(ranked) + 1))
+        if vector_search is not None:
+            # Extra candidates make up for the ones dropped by the filters.
+            size = k if not filters.active else k * 4
+            rank = 0
+            for doc in vector_search(query, size):
+                position = self._positions.get(self._key(doc))
+                if position is not None and mask[position]:
+                    rank += 1
+                    fused[position] += 1.0 / (RRF_K + rank)
+
+        scored = np.flatnonzero(fused)
+        best = scored[np.argsort(-fused[scored], kind="stable")][:k]
+        if filters.active and len(best) < k:
+            # Filter-only queries ("produtos até 3 mil") fill up with the cheapest matches.
+            rest = np.setdiff1d(candidates, best)
+            best = np.concatenate([best, rest[np.argsort(self.prices[rest])]])[:k]
+        return [self.documents[i] for i in best]
+
+    @staticmethod
+    def _key(doc: LangchainDocument) -> str:
+        return doc.metadata.get("product_id") or doc.page_content
+
+
+class RefreshingProductIndex:
+    """
+    A ProductIndex rebuilt from the vector store whenever the store fingerprint
+    changes, so a re-indexed catalog is searched without restarting the API.
+
+    The fingerprint is checked lazily on every lookup. The first caller to see a
+    change rebuilds the index, while concurrent callers keep using the previous one
+    until the new index is swapped in.
+
+    Attributes:
+        vectorstore (Chroma): The store the index is built from.
+        fingerprint (Callable[[], str]): Returns the current store fingerprint.
+        rebuilds (int): How many times the index was rebuilt after startup.
+    """
+
+    def __init__(self, vectorstore: Chroma, fingerprint: Callable[[], str]):
+        self.vectorstore = vectorstore
+        self.fingerprint = fingerprint
+        self.rebuilds = 0
+        self._lock = threading.Lock()
+        self._fingerprint = fingerprint()
+        self._index = ProductIndex.from_vectorstore(vectorstore)
+
+    @property
+    def current(self) -> ProductIndex:
+        """The index of the current store contents."""
+        fingerprint = self.fingerprint()
+        if fingerprint != self._fingerprint and self._lock.acquire(blocking=False):
+            try:
+                if fingerprint != self._fingerprint:
+                    self._index = ProductIndex.from_vectorstore(self.vectorstore)
+                    self._fingerprint = fingerprint
+                    self.rebuilds += 1
+            finally:
+                self._lock.release()
+        return self._index
+
+    def product_names(self, text: str) -> List[str]:
+        return self.current.product_names(text)
+
+    def search(
+        self,
+        query: str,
+        k: int = 4,
+        vector_search: Optional[Callable[[str, int], List[LangchainDocument]]] = None,
+    ) -> List[LangchainDocument]:
+        return self.current.search(query, k, vector_search)
+
+
+def _ngrams(tokens: List[str], size: int) -> Iterator[Tuple[str, ...]]:
+    return zip(*(tokens[offset:] for offset in range(size)))
+
+
+def _contains(tokens: List[str], sequence: List[str]) -> bool:
+    return tuple(sequence) in set(_ngrams(tokens, len(sequence)))
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from langchain.docstore.document import Document as LangchainDocument
+
+from src.llm.retrieval_cache import LRUCache, normalize_query
+
+
+class ResponseCache:
+    """
+    Caches the answers of the states whose answer does not depend on the conversation,
+    like the greeting of Welcome or the sign-off of ThankYou, and coalesces identical
+    concurrent calls.
+
+    Answers are keyed by model, state, normalized question and the ids of the products
+    retrieved for the question, with their content hash, so a catalog change never
+    serves an outdated answer. Only the
+    states opted in are cached: the history of the turn is not part of the key. While
+    an answer is being generated, identical requests wait for it instead of calling the
+    LLM again (single flight).
+
+    Attributes:
+        states (frozenset): The states whose answers are cached.
+        ttl_seconds (float): How long an answer is served from the cache.
+        stats (Dict[str, int]): Hits, misses and coalesced calls.
+    """
+
+    def __init__(
+        self,
+        states: Iterable[str] = (),
+        max_size: int = 1024,
+        ttl_seconds: float = 3600.0,
+    ):
+        self.states = frozenset(states)
+        self.ttl_seconds = ttl_seconds
+        self._answers = LRUCache(max_size)
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    def enabled_for(self, state: str) -> bool:
+        return state in self.states
+
+    @staticmethod
+    def key(
+        model: str,
+        state: str,
+        question: str,
+        documents: Union[str, List[LangchainDocument]],
+    ) -> str:
+        """
+        The key of an answer. `documents` are the retrieved documents sent with the
+        question, or "" for the states that use none.
+        """
+        if isinstance(documents, str):
+            ids = [documents]
+        else:
+            ids = sorted(_document_id(doc) for doc in documents)
+        digest = hashlib.sha256("\n".join(ids).encode("utf-8")).hexdigest()
+        return f"{model}|{state}|{normalize_query(question)}|{digest}"
+
+    def get(self, key: str, allow_stale: bool = False) -> Optional[Dict]:
+        """
+        The cached answer, None when missing or, unless `allow_stale`, past its TTL.
+        Stale answers stay cached until evicted by the LRU or replaced.
+        """
+        entry = self._answers.get(key)
+        if entry is None or (entry[0] < time.monotonic() and not allow_stale):
+            return None
+        return entry[1]
+
+    def lookup(self, key: str) -> Optional[Dict]:
+        """Same as get, counted in the stats, for callers that do not coalesce."""
+        response = self.get(key)
+        with self._lock:
+            self.stats["hits" if response is not None else "misses"] += 1
+        return response
+
+    def put(self, key: str, response: Dict):
+        self._answers.set(key, (time.monotonic() + self.ttl_seconds, response))
+
+    def get_or_call(self, key: str, call: Callable[[], Dict]) -> Dict:
+        """
+        Returns the cached answer, or the answer of `call`, which runs once for all
+        the concurrent callers of the same key.
+
+        Parameters:
+            key (str): The key built by ResponseCache.key.
+            call (Callable[[], Dict]): Generates the answer on a miss.
+
+        Returns:
+            Dict: The answer, with its "text".
+        """
+        response, future, leader = self._lookup(key)
+        if response is not None:
+            return response
+        if not leader:
+            return future.result()
+        try:
+            response = call()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._done(key, future, response)
+        return response
+
+    async def aget_or_call(self, key: str, call: Callable[[], Awaitable[Dict]]) -> Dict:
+        """Async counterpart of get_or_call, waiting without blocking the event loop."""
+        response, future, leader = self._lookup(key)
+        if response is not None:
+            return response
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            response = await call()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._done(key, future, response)
+        return response
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["inflight"] = len(self._inflight)
+        stats["entries"] = len(self._answers)
+        return stats
+
+    def _lookup(self, key: str):
+        with self._lock:
+            response = self.get(key)
+            if response is not None:
+                self.stats["hits"] += 1
+                return response, None, False
+            future = self._inflight.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return None, future, False
+            self.stats["misses"] += 1
+            future = self._inflight[key] = Future()
+            return None, future, True
+
+    def _done(self, key: str, future: Future, response: Dict):
+        # Cached before leaving the in-flight map, so no caller can miss both.
+        self.put(key, response)
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(response)
+
+    def _fail(self, key: str, future: Future, error: BaseException):
+        with self._lock:
+            del self._inflight[key]
+        if not isinstance(error, Exception):
+            error = RuntimeError("The coalesced LLM call was cancelled")
+        future.set_exception(error)
+
+
+def _document_id(doc: LangchainDocument) -> str:
+    # Indexed products carry their id and content hash, other documents are hashed.
+    metadata = doc.metadata
+    if metadata.get("product_id") and metadata.get("content_hash"):
+        return f"{metadata['product_id']}:{metadata['content_hash']}"
+    return hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
@@ -0,0 +1,219 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from langchain.docstore.document import Document as LangchainDocument
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes a query so trivial variations ("Oi", " oi! ") share a cache entry."""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = re.sub(r"\s+", " ", query)
+    return query.strip(" \t\n.,;:!?")
+
+
+def collection_fingerprint(persist_directory: str) -> str:
+    """
+    Fingerprints a persisted Chroma collection by the modification time and size of its
+    SQLite file, which changes whenever documents are added, updated or deleted.
+
+    Parameters
+    ----------
+    persist_directory : str
+        The Chroma persist directory.
+
+    Returns
+    -------
+    str
+        The fingerprint, empty when the collection does not exist yet.
+    """
+    try:
+        stat = os.stat(os.path.join(persist_directory, "chroma.sqlite3"))
+    except FileNotFoundError:
+        return ""
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+class LRUCache:
+    """A thread safe, size bounded mapping that evicts the least recently used key."""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RetrievalCache:
+    """
+    Two level cache for product retrieval: normalized query -> embedding and
+    normalized query -> top-k documents.
+
+    The first level is an in-memory LRU and the optional second level is a SQLite file
+    shared across restarts and workers. Embeddings only depend on the query, while the
+    retrieved documents depend on the collection contents, so the result entries are
+    dropped whenever the collection fingerprint changes.
+
+    Attributes:
+        fingerprint (Callable[[], str]): Returns the current collection fingerprint.
+        db_path (Optional[str]): Path of the SQLite layer, None keeps the cache in memory only.
+        namespace (str): Prefix of the embedding keys, identifying the embedding backend
+            so embeddings from different models are never mixed.
+        stats (Dict[str, int]): Hit and miss counters per cache level.
+    """
+
+    def __init__(
+        self,
+        fingerprint: Callable[[], str],
+        max_size: int = 1024,
+        db_path: Optional[str] = None,
+        namespace: str = "",
+    ):
+        self.fingerprint = fingerprint
+        self.db_path = db_path
+        self.namespace = namespace
+        self._embeddings = LRUCache(max_size)
+        self._results = LRUCache(max_size)
+        self._current_fingerprint = fingerprint()
+        self._lock = threading.Lock()
+        self.stats = {
+            "embedding_hits": 0,
+            "embedding_disk_hits": 0,
+            "embedding_misses": 0,
+            "result_hits": 0,
+            "result_disk_hits": 0,
+            "result_misses": 0,
+            "invalidations": 0,
+        }
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (query TEXT PRIMARY KEY, embedding TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(query TEXT, fingerprint TEXT, documents TEXT, PRIMARY KEY (query, fingerprint))"
+            )
+            self._db.commit()
+
+    def get_embedding(self, query: str) -> Optional[List[float]]:
+        key = self._embedding_key(query)
+        embedding = self._embeddings.get(key)
+        if embedding is not None:
+            self._count("embedding_hits")
+            return embedding
+        row = self._fetch("SELECT embedding FROM embeddings WHERE query = ?", (key,))
+        if row is not None:
+            embedding = json.loads(row[0])
+            self._embeddings.set(key, embedding)
+            self._count("embedding_disk_hits")
+            return embedding
+        self._count("embedding_misses")
+        return None
+
+    def set_embedding(self, query: str, embedding: List[float]):
+        key = self._embedding_key(query)
+        self._embeddings.set(key, embedding)
+        self._store(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+            (key, json.dumps(embedding)),
+        )
+
+    def get_results(self, query: str) -> Optional[List[LangchainDocument]]:
+        self._check_fingerprint()
+        key = normalize_query(query)
+        documents = self._results.get(key)
+        if documents is not None:
+            self._count("result_hits")
+            return documents
+        row = self._fetch(
+            "SELECT documents FROM results WHERE query = ? AND fingerprint = ?",
+            (key, self._current_fingerprint),
+        )
+        if row is not None:
+            documents = [LangchainDocument(**doc) for doc in json.loads(row[0])]
+            self._results.set(key, documents)
+            self._count("result_disk_hits")
+            return documents
+        self._count("result_misses")
+        return None
+
+    def set_results(self, query: str, documents: List[LangchainDocument]):
+        key = normalize_query(query)
+        self._results.set(key, documents)
+        serialized = [
+            {"page_content": doc.page_content, "metadata": doc.metadata}
+            for doc in documents
+        ]
+        self._store(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+            (key, self._current_fingerprint, json.dumps(serialized)),
+        )
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["embedding_entries"] = len(self._embeddings)
+        stats["result_entries"] = len(self._results)
+        return stats
+
+    def _embedding_key(self, query: str) -> str:
+        return f"{self.namespace}|{normalize_query(query)}"
+
+    def _check_fingerprint(self):
+        fingerprint = self.fingerprint()
+        if fingerprint == self._current_fingerprint:
+            return
+        with self._lock:
+            self._current_fingerprint = fingerprint
+            self.stats["invalidations"] += 1
+            self._results.clear()
+            if self._db is not None:
+                self._db.execute(
+                    "DELETE FROM results WHERE fingerprint != ?", (fingerprint,)
+                )
+                self._db.commit()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _fetch(self, sql: str, params: tuple) -> Optional[tuple]:
+        if self._db is None:
+            return None
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
+
+    def _store(self, sql: str, params: tuple):
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute(sql, params)
+            self._db.commit()
@@ -0,0 +1,145 @@
+import re
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+STATES = [
+    "Welcome",
+    "ProductSearch",
+    "ProductQA",
+    "CollectInfo",
+    "ConfirmPurchase",
+    "ThankYou",
+]
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+PHONE_PATTERN = re.compile(r"(?:\+?55\s?)?\(?\d{2}\)?\s?9?\d{4}[-\s]?\d{4}")
+NAME_PATTERN = re.compile(
+    r"(?:meu nome é|meu nome e|me chamo|nome completo:?|nome:)\s*"
+    r"([A-Za-zÀ-ÿ]+(?:\s+[A-Za-zÀ-ÿ]+){1,3})",
+    re.IGNORECASE,
+)
+GREETING_PATTERN = re.compile(
+    r"^\s*(oi+|olá|ola|bom dia|boa tarde|boa noite|e aí|eai|hello|hi)\b[\s!.,?]*$",
+    re.IGNORECASE,
+)
+THANKS_PATTERN = re.compile(
+    r"\b(obrigad[oa]|valeu|agradeço|tchau|até mais|ate mais)\b", re.IGNORECASE
+)
+
+
+@dataclass
+class StatePrediction:
+    state: str
+    confidence: float
+    rule: str
+
+
+def extract_contact_info(text: str) -> Dict[str, str]:
+    """
+    Extracts the contact details the user may have typed in a message.
+
+    Parameters:
+        text (str): The user's message.
+
+    Returns:
+        Dict[str, str]: The found fields among "name", "email" and "phone".
+    """
+    info = {}
+    email = EMAIL_PATTERN.search(text)
+    if email:
+        info["email"] = email.group(0)
+    phone = PHONE_PATTERN.search(EMAIL_PATTERN.sub(" ", text))
+    if phone:
+        info["phone"] = phone.group(0).strip()
+    name = NAME_PATTERN.search(text)
+    if name:
+        info["name"] = name.group(1).strip()
+    elif email and phone:
+        # A message carrying both email and phone is a contact form answer, so the
+        # leftover words before them are taken as the name.
+        leftover = PHONE_PATTERN.sub(" ", EMAIL_PATTERN.sub(" ", text))
+        words = re.findall(r"[A-Za-zÀ-ÿ]{2,}", leftover)
+        if len(words) >= 2:
+            info["name"] = " ".join(words[:4])
+    return info
+
+
+class RuleBasedStateClassifier:
+    """
+    Decides the obvious conversation state transitions locally, without calling the LLM.
+
+    Each rule returns a prediction with a confidence, and StateController only trusts it
+    when the confidence reaches its threshold. The instance is stateless apart from
+    the hit counters, so one classifier is shared by every session.
+
+    Attributes:
+        local_hits (int): Turns decided by the rules.
+        fallbacks (int): Turns where the rules were not confident and the LLM was used.
+    """
+
+    def __init__(self):
+        self.local_hits = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def predict(
+        self,
+        messages: List[BaseMessage],
+        current_state: str,
+        visited_states: List[str],
+    ) -> Optional[StatePrediction]:
+        """
+        Predicts the state from the conversation messages.
+
+        Parameters:
+            messages (List[BaseMessage]): The conversation messages, last one being the user's.
+            current_state (str): The state of the conversation before this turn.
+            visited_states (List[str]): The states the conversation has already visited.
+
+        Returns:
+            Optional[StatePrediction]: The prediction, or None when no rule applies.
+        """
+        user_messages = [m.content for m in messages if isinstance(m, HumanMessage)]
+        if not user_messages:
+            return None
+        last_message = user_messages[-1]
+        has_ai_answer = any(isinstance(m, AIMessage) for m in messages)
+
+        if not has_ai_answer and GREETING_PATTERN.match(last_message):
+            return StatePrediction("Welcome", 0.95, "first_turn_greeting")
+
+        contact_info = {}
+        for message in user_messages:
+            contact_info.update(extract_contact_info(message))
+        if current_state == "CollectInfo" and {"name", "email", "phone"} <= (
+            contact_info.keys()
+        ):
+            return StatePrediction("ConfirmPurchase", 0.9, "contact_info_complete")
+
+        if "ConfirmPurchase" in visited_states and THANKS_PATTERN.search(last_message):
+            return StatePrediction("ThankYou", 0.9, "thanks_after_purchase")
+
+        return None
+
+    def record(self, local_hit: bool):
+        with self._lock:
+            if local_hit:
+                self.local_hits += 1
+            else:
+                self.fallbacks += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.local_hits + self.fallbacks
+        return self.local_hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "local_hits": self.local_hits,
+                "fallbacks": self.fallbacks,
+                "hit_rate": self.hit_rate,
+            }
@@ -0,0 +1,64 @@
+from typing import Any, Callable, Dict, List
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from src.llm.history import count_tokens
+from src.llm.instrumentation import LLM_CALLS, record_tokens
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """
+    Counts the tokens of every call of the chat model it is attached to.
+
+    The usage reported by the API is used when present; streamed responses carry no
+    usage, so the tokens are then counted with the model tokenizer.
+
+    Attributes:
+        model (str): Model name used when the response does not report one.
+        state (Callable[[], str]): Returns the conversation state the call belongs to.
+        chain (str): Name of the chain the model serves, e.g. "main".
+    """
+
+    def __init__(self, model: str, state: Callable[[], str], chain: str = "main"):
+        self.model = model
+        self.state = state
+        self.chain = chain
+        self._prompt_tokens: Dict[UUID, int] = {}
+
+    def on_chat_model_start(
+        self,
+        serialized: Dict[str, Any],
+        messages: List[List[BaseMessage]],
+        *,
+        run_id: UUID,
+        **kwargs: Any,
+    ):
+        self._prompt_tokens[run_id] = sum(
+            count_tokens(str(message.content), self.model)
+            for batch in messages
+            for message in batch
+        )
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        estimated_prompt = self._prompt_tokens.pop(run_id, 0)
+        llm_output = response.llm_output or {}
+        usage = llm_output.get("token_usage") or {}
+        model = llm_output.get("model_name") or self.model
+        if usage.get("prompt_tokens") is not None:
+            prompt_tokens = usage["prompt_tokens"]
+            completion_tokens = usage.get("completion_tokens", 0)
+        else:
+            prompt_tokens = estimated_prompt
+            completion_tokens = sum(
+                count_tokens(generation.text, self.model)
+                for generations in response.generations
+                for generation in generations
+            )
+        LLM_CALLS.inc(model=model, chain=self.chain)
+        record_tokens(model, self.state(), prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._prompt_tokens.pop(run_id, None)
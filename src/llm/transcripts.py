@@ -0,0 +1,160 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+TRANSCRIPTS_DB = "data/07_model_output/transcripts.sqlite3"
+
+_CLOSE = object()
+
+
+class TranscriptSink:
+    """
+    Append-only store of every conversation message, written in the background.
+
+    Messages are queued with the time they happened and a background thread writes
+    them to a single SQLite database in batches, so recording a message never blocks a
+    request on disk I/O. Each message is stored under a unique message id and never
+    replaced, so a session id reused after the end of its session keeps the messages of
+    both conversations.
+
+    Attributes:
+        db_path (str): The SQLite database file.
+        batch_size (int): Maximum number of messages written per transaction.
+        flush_interval (float): Maximum time, in seconds, a queued message waits.
+    """
+
+    def __init__(
+        self,
+        db_path: str = TRANSCRIPTS_DB,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+    ):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue" = queue.Queue()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with sqlite3.connect(db_path) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "message_id TEXT PRIMARY KEY, session_id TEXT, seq INTEGER, "
+                "timestamp TEXT, sender TEXT, message TEXT, state TEXT)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS messages_session "
+                "ON messages (session_id, timestamp, seq)"
+            )
+        self._thread = threading.Thread(
+            target=self._run, name="transcript-sink", daemon=True
+        )
+        self._thread.start()
+
+    def record(
+        self,
+        session_id: str,
+        seq: int,
+        sender: str,
+        message: str,
+        state: Optional[str] = None,
+        message_id: Optional[str] = None,
+        timestamp: Optional[str] = None,
+    ):
+        """
+        Queues a message to be stored.
+
+        Parameters:
+            session_id (str): The session the message belongs to.
+            seq (int): Position of the message in the session.
+            sender (str): "Human" or "AI".
+            message (str): The message content.
+            state (Optional[str]): The conversation state when the message happened.
+            message_id (Optional[str]): Unique id of the message, generated when None.
+            timestamp (Optional[str]): When the message happened, ISO formatted, now
+            when None.
+        """
+        self._queue.put(
+            (
+                message_id or uuid.uuid4().hex,
+                session_id,
+                seq,
+                timestamp or datetime.now().isoformat(),
+                sender,
+                message,
+                state,
+            )
+        )
+
+    def flush(self):
+        """Blocks until every queued message is written."""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def _run(self):
+        connection = sqlite3.connect(self.db_path)
+        closing = False
+        while not closing:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            while True:
+                if item is _CLOSE:
+                    closing = True
+                    self._queue.task_done()
+                else:
+                    batch.append(item)
+                if closing or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        batch,
+                    )
+            except sqlite3.Error as e:
+                logging.error(f"Failed to write {len(batch)} transcript messages: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        connection.close()
+
+
+def load_transcripts(
+    db_path: str = TRANSCRIPTS_DB, session_id: Optional[str] = None
+) -> List[Dict[str, str]]:
+    """
+    Reads the stored messages, in conversation order.
+
+    Parameters:
+        db_path (str): The SQLite database file.
+        session_id (Optional[str]): Only this session, all sessions when None.
+
+    Returns:
+        List[Dict[str, str]]: One dict per message with the message_id, session_id,
+        seq, timestamp, sender, message and state.
+    """
+    query = "SELECT * FROM messages"
+    params: tuple = ()
+    if session_id is not None:
+        query += " WHERE session_id = ?"
+        params = (session_id,)
+    with sqlite3.connect(db_path) as connection:
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute(
+            query + " ORDER BY session_id, timestamp, seq", params
+        )
+        return [dict(row) for row in rows]
@@ -0,0 +1,412 @@
+import json
+import os
+import threading
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document as LangchainDocument
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+INDEX_FILE = "index.json"
+# The files of one generation of the store, named "<name>-<generation><extension>".
+GENERATION_FILES = (("vectors", ".f32"), ("centroids", ".npy"), ("ivf_offsets", ".npy"))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.float32(1e-12))
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, best first, without sorting every score."""
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def _spherical_kmeans(
+    vectors: np.ndarray, n_lists: int, iterations: int = 10, chunk_size: int = 65536
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Clusters normalized vectors by cosine similarity.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The normalized centroids and the list of each
+        vector.
+    """
+    rng = np.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int32)
+    for _ in range(iterations):
+        for start in range(0, len(vectors), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            assignments[chunk] = np.argmax(vectors[chunk] @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        filled = np.bincount(assignments, minlength=n_lists) > 0
+        # An empty list keeps its previous centroid.
+        centroids[filled] = _normalize(sums[filled])
+    return centroids, assignments
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    A vector store kept in a memory-mapped float32 NumPy file, for catalogs small
+    enough that an exact search is cheaper than a Chroma query.
+
+    The embeddings are normalized when stored, so the cosine similarity of a query with
+    every product is a single matrix-vector product and the top k are taken with
+    argpartition. The file is opened read-only by every worker process, which share
+    its pages through the OS page cache instead of each loading a copy. With
+    `ivf_lists`, the vectors are also clustered into inverted lists (IVF), stored one
+    list after the other, and only the `ivf_probe` lists closest to the query are
+    scored, an approximate search for very large catalogs.
+
+    Writes (add_texts, upsert, delete) are staged in memory and only reach the disk on
+    persist, which writes a new generation of the files and then swaps the index file,
+    so readers never see a half written store. A store opened read-only reloads itself
+    when another process persisted a new generation.
+
+    Attributes:
+        persist_directory (str): Where the files are stored.
+        ivf_lists (int): Number of IVF lists built on persist, 0 for exact search.
+        ivf_probe (int): Number of IVF lists scored per query.
+    """
+
+    def __init__(
+        self,
+        persist_directory: str,
+        embedding_function: Embeddings,
+        ivf_lists: int = 0,
+        ivf_probe: int = 8,
+    ):
+        self.persist_directory = persist_directory
+        self._embedding_function = embedding_function
+        self.ivf_lists = ivf_lists
+        self.ivf_probe = ivf_probe
+        self._lock = threading.RLock()
+        self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    @property
+    def count(self) -> int:
+        return len(self._ids)
+
+    def fingerprint(self) -> str:
+        """Changes on every persist, empty when the store was never persisted."""
+        return self.fingerprint_of(self.persist_directory)
+
+    @staticmethod
+    def fingerprint_of(persist_directory: str) -> str:
+        try:
+            stat = os.stat(os.path.join(persist_directory, INDEX_FILE))
+        except FileNotFoundError:
+            return ""
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def _load(self):
+        self._loaded = self.fingerprint()
+        self._dirty = False
+        # The IVF centroids and the rows of each list.
+        self._ivf: Optional[Tuple[np.ndarray, List[slice]]] = None
+        path = os.path.join(self.persist_directory, INDEX_FILE)
+        if not os.path.exists(path):
+            self._generation = 0
+            self._ids: List[str] = []
+            self._documents: List[str] = []
+            self._metadatas: List[Dict] = []
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+            self._rows: Dict[str, int] = {}
+            return
+        with open(path, "r", encoding="utf-8") as file:
+            index = json.load(file)
+        self._generation = index["generation"]
+        self._ids = index["ids"]
+        self._documents = index["documents"]
+        self._metadatas = index["metadatas"]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        shape = (len(self._ids), index["dim"])
+        if shape[0]:
+            self._vectors = np.memmap(
+                self._path("vectors", ".f32"), dtype=np.float32, mode="r", shape=shape
+            )
+        else:
+            self._vectors = np.zeros(shape, dtype=np.float32)
+        if index.get("ivf_lists"):
+            offsets = np.load(self._path("ivf_offsets", ".npy")).tolist()
+            self._ivf = (
+                np.load(self._path("centroids", ".npy")),
+                [slice(start, end) for start, end in zip(offsets, offsets[1:])],
+            )
+
+    def _path(self, name: str, extension: str, generation: Optional[int] = None) -> str:
+        generation = self._generation if generation is None else generation
+        return os.path.join(self.persist_directory, f"{name}-{generation}{extension}")
+
+    def _refresh(self):
+        """Reloads the store when another process persisted a new generation."""
+        if not self._dirty and self.fingerprint() != self._loaded:
+            with self._lock:
+                if not self._dirty and self.fingerprint() != self._loaded:
+                    self._load()
+
+    def _writable(self):
+        """Swaps the read-only mapping for an in-memory copy before the first write."""
+        if not self._dirty:
+            self._vectors = self._buffer = np.array(self._vectors, dtype=np.float32)
+            self._ivf = None
+            self._dirty = True
+
+    def _append(self, vectors: np.ndarray):
+        """Appends rows to the in-memory buffer, doubling its capacity when full."""
+        size, added = len(self._vectors), len(vectors)
+        if size + added > len(self._buffer):
+            buffer = np.empty(
+                (max(size + added, 2 * len(self._buffer)), vectors.shape[1]),
+                dtype=np.float32,
+            )
+            buffer[:size] = self._vectors
+            self._buffer = buffer
+        end = size + added
+        self._buffer[size:end] = vectors
+        self._vectors = self._buffer[:end]
+
+    def upsert(
+        self,
+        ids: Sequence[str],
+        embeddings: Sequence[Sequence[float]],
+        metadatas: Optional[Sequence[Dict]] = None,
+        documents: Optional[Sequence[str]] = None,
+    ):
+        """
+        Adds the products, or replaces the stored ones with the same ids, with their
+        precomputed embeddings. Staged in memory until persist.
+        """
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+        metadatas = metadatas or [{} for _ in ids]
+        documents = documents or ["" for _ in ids]
+        with self._lock:
+            self._writable()
+            if self._vectors.shape[1] == 0:
+                self._vectors = self._buffer = np.zeros(
+                    (0, vectors.shape[1]), dtype=np.float32
+                )
+            elif vectors.shape[1] != self._vectors.shape[1]:
+                raise ValueError(
+                    f"Embedding dimension {vectors.shape[1]} does not match the "
+                    f"store's {self._vectors.shape[1]}"
+                )
+            new_rows = []
+            for doc_id, vector, metadata, document in zip(
+                ids, vectors, metadatas, documents
+            ):
+                row = self._rows.get(doc_id)
+                if row is None:
+                    self._rows[doc_id] = len(self._ids)
+                    new_rows.append(vector)
+                    self._ids.append(doc_id)
+                    self._documents.append(document)
+                    self._metadatas.append(dict(metadata or {}))
+                    continue
+                self._documents[row] = document
+                self._metadatas[row] = dict(metadata or {})
+                if row < len(self._vectors):
+                    self._vectors[row] = vector
+                else:
+                    new_rows[row - len(self._vectors)] = vector
+            if new_rows:
+                self._append(np.stack(new_rows))
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        self.upsert(ids, self.embeddings.embed_documents(texts), metadatas, texts)
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any):
+        with self._lock:
+            rows = [self._rows[doc_id] for doc_id in ids or [] if doc_id in self._rows]
+            if not rows:
+                return
+            self._writable()
+            keep = np.ones(len(self._ids), dtype=bool)
+            keep[rows] = False
+            self._vectors = self._buffer = self._vectors[keep]
+            self._ids = [doc_id for doc_id, kept in zip(self._ids, keep) if kept]
+            self._documents = [doc for doc, kept in zip(self._documents, keep) if kept]
+            self._metadatas = [
+                metadata for metadata, kept in zip(self._metadatas, keep) if kept
+            ]
+            self._rows = {doc_id: row for row, doc_id in enumerate(self._ids)}
+
+    def delete_collection(self):
+        """Removes every product, from memory and from the disk."""
+        with self._lock:
+            if os.path.isdir(self.persist_directory):
+                for name in os.listdir(self.persist_directory):
+                    prefix = name.split("-")[0]
+                    if name == INDEX_FILE or prefix in dict(GENERATION_FILES):
+                        os.remove(os.path.join(self.persist_directory, name))
+            self._load()
+
+    def persist(self):
+        """
+        Writes the staged changes as a new generation of the files, building the IVF
+        lists when enabled, then removes the previous generation.
+        """
+        with self._lock:
+            os.makedirs(self.persist_directory, exist_ok=True)
+            previous = self._generation
+            generation = previous + 1
+            vectors = np.ascontiguousarray(self._vectors, dtype=np.float32)
+            ivf_lists = min(self.ivf_lists, len(vectors))
+            if ivf_lists:
+                centroids, assignments = _spherical_kmeans(vectors, ivf_lists)
+                # Each list is stored as a contiguous block of rows, scored in place.
+                order = np.argsort(assignments, kind="stable")
+                vectors = vectors[order]
+                self._ids = [self._ids[row] for row in order]
+                self._documents = [self._documents[row] for row in order]
+                self._metadatas = [self._metadatas[row] for row in order]
+                offsets = np.zeros(ivf_lists + 1, dtype=np.int64)
+                np.cumsum(
+                    np.bincount(assignments, minlength=ivf_lists), out=offsets[1:]
+                )
+                np.save(self._path("centroids", ".npy", generation), centroids)
+                np.save(self._path("ivf_offsets", ".npy", generation), offsets)
+            vectors.tofile(self._path("vectors", ".f32", generation))
+            index = {
+                "generation": generation,
+                "dim": int(vectors.shape[1]),
+                "ivf_lists": ivf_lists,
+                "ids": self._ids,
+                "documents": self._documents,
+                "metadatas": self._metadatas,
+            }
+            tmp_path = os.path.join(self.persist_directory, f"{INDEX_FILE}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(index, file, ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(self.persist_directory, INDEX_FILE))
+            # Workers keep reading the mapping of the previous generation until they
+            # reload, which stays valid after its file is removed.
+            for name, extension in GENERATION_FILES:
+                path = self._path(name, extension, previous)
+                if os.path.exists(path):
+                    os.remove(path)
+            self._load()
+
+    def get(
+        self,
+        ids: Optional[Sequence[str]] = None,
+        include: Sequence[str] = ("documents", "metadatas"),
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> Dict[str, Any]:
+        """
+        The stored products, in the format of Chroma's get: their ids, and the
+        documents and metadatas when included (None otherwise).
+        """
+        self._refresh()
+        with self._lock:
+            if ids is not None:
+                rows = [self._rows[doc_id] for doc_id in ids if doc_id in self._rows]
+            else:
+                end = len(self._ids) if limit is None else offset + limit
+                rows = range(offset, min(end, len(self._ids)))
+            return {
+                "ids": [self._ids[row] for row in rows],
+                "documents": (
+                    [self._documents[row] for row in rows]
+                    if "documents" in include
+                    else None
+                ),
+                "metadatas": (
+                    [self._metadatas[row] for row in rows]
+                    if "metadatas" in include
+                    else None
+                ),
+            }
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[LangchainDocument, float]]:
+        """
+        The k products most similar to the embedding, with their cosine similarity.
+        """
+        self._refresh()
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            vectors, ivf = self._vectors, self._ivf
+            documents, metadatas = self._documents, self._metadatas
+        if len(vectors) == 0 or k <= 0:
+            return []
+        if ivf is None:
+            scores = vectors @ query
+            top = _top_k(scores, k)
+            top_scores = scores[top]
+        else:
+            centroids, lists = ivf
+            probed = [lists[i] for i in _top_k(centroids @ query, self.ivf_probe)]
+            scores = np.concatenate([vectors[rows] @ query for rows in probed])
+            rows = np.concatenate([np.arange(r.start, r.stop) for r in probed])
+            best = _top_k(scores, k)
+            top, top_scores = rows[best], scores[best]
+        return [
+            (
+                LangchainDocument(
+                    page_content=documents[row], metadata=dict(metadatas[row])
+                ),
+                float(score),
+            )
+            for row, score in zip(top.tolist(), top_scores.tolist())
+        ]
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[LangchainDocument]:
+        return [
+            doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[LangchainDocument, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self.embeddings.embed_query(query), k
+        )
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[LangchainDocument]:
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k)
+
+    def _select_relevance_score_fn(self):
+        # The scores already are cosine similarities.
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        persist_directory: str = "",
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(persist_directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        store.persist()
+        return store
@@ -1,40 +1,119 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+from typing import Optional
+
 import chainlit as cl
 import httpx
 
 API_URL = "http://localhost:8000"
 
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
 
-async def end_session_api_call():
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(f"{API_URL}/end-session")
-            response.raise_for_status()
-            response_text = "Session ended on the server."
-        except Exception as e:
-            response_text = f"Failed to end session: {str(e)}"
+
+def get_client() -> httpx.AsyncClient:
+    """
+    The keep-alive client shared by every chat of this worker.
+
+    It is created on first use, as Chainlit has no application startup hook, and bound
+    to the running event loop. A client of a previous loop is closed before it is
+    replaced, and the last one at exit. The 20s limit applies between streamed tokens,
+    not to the whole answer.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        if _client is not None:
+            _close_client(_client, _client_loop)
+        _client = httpx.AsyncClient(
+            base_url=API_URL,
+            timeout=20.0,
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+                max_keepalive_connections=int(
+                    os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")
+                ),
+                keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),
+            ),
+        )
+        _client_loop = loop
+    return _client
+
+
+def _close_client(client: httpx.AsyncClient, loop: asyncio.AbstractEventLoop):
+    """Closes the client on the loop it was created on, with its pooled connections."""
+    if client.is_closed or loop.is_closed():
+        return
+    try:
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        else:
+            loop.run_until_complete(client.aclose())
+    except Exception as e:
+        logging.warning(f"Failed to close the API client: {str(e)}")
+
+
+@atexit.register
+def _close_shared_client():
+    # Chainlit has no application shutdown hook either.
+    if _client is not None:
+        _close_client(_client, _client_loop)
+
+
+async def end_session_api_call(session_id: str):
+    try:
+        response = await get_client().post(
+            "/end-session", json={"session_id": session_id}
+        )
+        response.raise_for_status()
+        response_text = "Session ended on the server."
+    except Exception as e:
+        response_text = f"Failed to end session: {str(e)}"
     return response_text
 
 
 @cl.on_message
 async def main(message: cl.Message) -> cl.Message:
     question = message.content
-    payload = {"question": question}
+    session_id = cl.user_session.get("id")
+    payload = {"question": question, "session_id": session_id}
 
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        try:
-            response = await client.post(f"{API_URL}/query", json=payload)
-            response.raise_for_status()
-            result = response.json()
-            response_message = result["message"]
-            if result.get("end_session", False):
-                await cl.Message(
-                    content="Obrigado por usar nos serviços, até mais!"
-                ).send()
-                response_message = await end_session_api_call()
+    response_message = cl.Message(content="")
+    end_session = False
+    try:
+        async with get_client().stream(
+            "POST", "/query/stream", json=payload
+        ) as response:
+            if response.status_code == 429:
+                retry_after = response.headers.get("Retry-After", "alguns")
+                response_message.content = (
+                    "Estamos com muitos atendimentos no momento, envie a mensagem "
+                    f"novamente em {retry_after} segundos."
+                )
+                await response_message.send()
                 return
-        except httpx.HTTPStatusError as e:
-            response_message = f"Ocorreu um erro ao consultar a API: {str(e)}"
-        except httpx.RequestError as e:
-            response_message = f"Erro na requisição: {str(e)}"
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                frame = json.loads(line)
+                if "token" in frame:
+                    await response_message.stream_token(frame["token"])
+                elif "error" in frame:
+                    await response_message.stream_token(
+                        f"Ocorreu um erro ao consultar a API: {frame['error']}"
+                    )
+                else:
+                    end_session = frame.get("end_session", False)
+    except httpx.HTTPStatusError as e:
+        response_message.content = f"Ocorreu um erro ao consultar a API: {str(e)}"
+    except httpx.RequestError as e:
+        response_message.content = f"Erro na requisição: {str(e)}"
 
-    await cl.Message(content=response_message).send()
+    await response_message.send()
+    if end_session:
+        await cl.Message(content="Obrigado por usar nos serviços, até mais!").send()
+        await end_session_api_call(session_id)